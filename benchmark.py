@@ -0,0 +1,264 @@
+"""Benchmarks for ums.py.
+
+Generates synthetic festival feeds of any size, then times each stage of a
+run over them: reading the datasource, building calendars, flattening, and
+each of the writers. Google Calendar output goes to an in-memory fake of the
+API, so no network or credentials are needed.
+
+The memory stage measures how many bytes each event takes once loaded, in
+the EventStore and as Calendar views, next to the plain dicts the feed
+parses into.
+
+Results are written as JSON. Pass --baseline with an earlier result file to
+fail (exit status 1) on any stage that got slower, or bigger, by more than
+--threshold.
+"""
+import argparse
+import contextlib
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List
+
+import ums
+from fakes import FakeCalendarService
+
+
+STAGES = ('readfile', 'calendars', 'flatten', 'stdout', 'csv', 'ical', 'gcal',
+          'memory')
+
+
+def generate_records(events: int, venues: int, *,
+                     seed: int=0) -> Iterable[Dict[str, str]]:
+    """Yield a festival's worth of records: back to back 40 minute sets at
+    each venue, starting every evening at 6pm.
+    """
+    rng = random.Random(seed)
+    first = datetime(2016, 7, 27, 18, 0)
+    sets_per_night = 8
+    for i in range(events):
+        venue = i % venues
+        slot = i // venues
+        night, position = divmod(slot, sets_per_night)
+        start = first + timedelta(days=night, minutes=45 * position)
+        end = start + timedelta(minutes=40)
+        artist = 'artist{}'.format(rng.randrange(max(events // 3, 1)))
+        yield {
+            'start': start.strftime(ums.Event.DATEFMT),
+            'end': end.strftime(ums.Event.DATEFMT),
+            'venue_artist': artist,
+            'url': 'http://example.com/artists/{}'.format(artist),
+            'venue_name': 'venue{}'.format(venue),
+            'venue_url': 'http://example.com/venues/venue{}'.format(venue),
+            'description': '{} Fake Lane, Denver, CO'.format(venue),
+        }
+
+
+def write_feed(path: str, events: int, venues: int, *, seed: int=0):
+    with open(path, 'w') as fp:
+        ums.write_records(fp, {'retrieved': '2016-07-16T18:32:13'},
+                          generate_records(events, venues, seed=seed))
+
+
+def peak_rss_kb() -> int:
+    """The process's peak resident set size so far, in KiB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':  # pragma: nocover
+        peak //= 1024
+    return peak
+
+
+def measure_memory(events: int, venues: int) -> Dict[str, float]:
+    """Bytes per event for the parsed records, the EventStore built from
+    them, and per-venue calendars over that store.
+    """
+    def allocated(build):
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            result = build()
+            return result, tracemalloc.get_traced_memory()[0] - before
+        finally:
+            tracemalloc.stop()
+
+    records, dict_bytes = allocated(
+        lambda: list(generate_records(events, venues))
+    )
+    store, store_bytes = allocated(lambda: ums.EventStore.from_records(records))
+    del records
+    _, calendar_bytes = allocated(store.calendars)
+    return {
+        'dict_bytes_per_event': dict_bytes / events,
+        'bytes_per_event': store_bytes / events,
+        'calendar_bytes_per_event': calendar_bytes / events,
+    }
+
+
+def run_size(events: int, venues: int, stages: Iterable[str],
+             workdir: str) -> List[Dict[str, Any]]:
+    """Time each stage over a generated feed of the given size."""
+    feed = os.path.join(workdir, 'events.json')
+    write_feed(feed, events, venues)
+    results = []  # type: List[Dict[str, Any]]
+
+    def record(stage: str, seconds: float, **extra):
+        results.append(dict({
+            'stage': stage,
+            'events': events,
+            'venues': venues,
+            'seconds': seconds,
+            'events_per_second': events / seconds if seconds else None,
+            'peak_rss_kb': peak_rss_kb(),
+        }, **extra))
+
+    @contextlib.contextmanager
+    def timed(stage: str):
+        started = time.perf_counter()
+        yield
+        record(stage, time.perf_counter() - started)
+
+    ds = ums.DataSource(feed)
+    with timed('readfile'):
+        ds.readfile()
+    with timed('calendars'):
+        calendars = ds.calendars()
+    if 'flatten' in stages:
+        with timed('flatten'):
+            for _ in ums.Writer.flatten(calendars.values()):
+                pass
+    if 'stdout' in stages:
+        with open(os.devnull, 'w') as devnull:
+            with contextlib.redirect_stdout(devnull), timed('stdout'):
+                ums.StdoutWriter().write(calendars.values())
+    for stage, writer_cls in (('csv', ums.CSVWriter), ('ical', ums.IcalWriter)):
+        if stage in stages:
+            output = os.path.join(workdir, stage)
+            writer = writer_cls(output=output, silently_destroy_data=True)
+            with timed(stage):
+                writer.write(calendars.values())
+            shutil.rmtree(output)
+    if 'gcal' in stages:
+        writer = ums.GoogleCalendarWriter(None, service=FakeCalendarService(),
+                                          silently_destroy_data=True)
+        with open(os.devnull, 'w') as devnull:
+            with contextlib.redirect_stdout(devnull), timed('gcal'):
+                writer.write(calendars.values())
+    if 'memory' in stages:
+        del ds, calendars
+        started = time.perf_counter()
+        sizes = measure_memory(events, venues)
+        record('memory', time.perf_counter() - started, **sizes)
+    return [r for r in results if r['stage'] in stages]
+
+
+def run_size_isolated(events: int, venues: int,
+                      stages: Iterable[str]) -> List[Dict[str, Any]]:
+    """run_size() in a fresh interpreter, so peak RSS is for that size
+    alone.
+    """
+    output = subprocess.check_output([
+        sys.executable, os.path.abspath(__file__), '--single',
+        '--sizes', str(events), '--venues', str(venues),
+        '--stages'] + list(stages),
+        cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    return json.loads(output.decode('utf-8'))
+
+
+def compare(results: List[Dict[str, Any]], baseline: List[Dict[str, Any]], *,
+            threshold: float, slack: float=0.05) -> List[str]:
+    """Describe every stage that is more than threshold (a fraction) slower
+    than in the baseline. Differences under slack seconds are ignored, since
+    tiny stages are mostly noise.
+    """
+    previous = {(r['stage'], r['events'], r['venues']): r for r in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get((result['stage'], result['events'], result['venues']))
+        if before is None:
+            continue
+        if result['stage'] == 'memory':
+            # timings under tracemalloc don't mean much, but sizes do.
+            now, was = result['bytes_per_event'], before['bytes_per_event']
+            if now > was * (1 + threshold):
+                regressions.append(
+                    'memory ({events} events, {venues} venues): {now:.1f} '
+                    'bytes per event, was {was:.1f}'.format(now=now, was=was,
+                                                            **result)
+                )
+            continue
+        limit = before['seconds'] * (1 + threshold)
+        if result['seconds'] > limit and result['seconds'] - before['seconds'] > slack:
+            regressions.append(
+                '{stage} ({events} events, {venues} venues): {now:.3f}s, '
+                'was {was:.3f}s'.format(now=result['seconds'],
+                                        was=before['seconds'], **result)
+            )
+    return regressions
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000],
+                        help='The numbers of events to generate.')
+    parser.add_argument('--venues', type=int, default=20,
+                        help='The number of venues to spread them over.')
+    parser.add_argument('--stages', nargs='+', default=list(STAGES),
+                        choices=STAGES, help='The stages to time.')
+    parser.add_argument('--output', default=None,
+                        help='Where to write the JSON results (default: stdout).')
+    parser.add_argument('--baseline', default=None,
+                        help='Earlier results to check for regressions against.')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='How much slower (as a fraction) counts as a '
+                             'regression.')
+    parser.add_argument('--single', action='store_true',
+                        help=argparse.SUPPRESS)
+    return parser.parse_args(args)
+
+
+def main(args=None) -> int:
+    args = parse_args(args)
+    if args.single:
+        workdir = tempfile.mkdtemp()
+        try:
+            results = run_size(args.sizes[0], args.venues, args.stages, workdir)
+        finally:
+            shutil.rmtree(workdir)
+        print(json.dumps(results))
+        return 0
+
+    results = []  # type: List[Dict[str, Any]]
+    for size in args.sizes:
+        results.extend(run_size_isolated(size, args.venues, args.stages))
+    report = json.dumps({'python': sys.version.split()[0], 'results': results},
+                        indent=4)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(report)
+    else:
+        print(report)
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)['results']
+        regressions = compare(results, baseline, threshold=args.threshold)
+        for regression in regressions:
+            print('REGRESSION: {}'.format(regression), file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
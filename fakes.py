@@ -0,0 +1,179 @@
+"""In-memory fakes of the google calendar v3 service, shared by the tests
+and the benchmarks.
+"""
+import collections
+import types
+import uuid
+
+
+class FakeHttpError(Exception):
+    def __init__(self, status, content=b''):
+        self.resp = types.SimpleNamespace(status=status)
+        self.content = content
+        super().__init__(status)
+
+
+class FakeRequest:
+    HTTP_METHODS = {'list': 'GET', 'insert': 'POST', 'patch': 'PATCH',
+                    'delete': 'DELETE'}
+
+    def __init__(self, api, name, func):
+        self.api = api
+        self.name = name
+        self.method = self.HTTP_METHODS[name.rsplit('.', 1)[1]]
+        self.func = func
+
+    def execute(self, http=None):
+        self.api.calls[self.name] += 1
+        failures = self.api.failures.get(self.name)
+        if failures:
+            raise failures.pop(0)
+        return self.func()
+
+
+class FakeBatch:
+    def __init__(self, api, callback):
+        self.api = api
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        self.requests.append((request, callback or self.callback, request_id))
+
+    def execute(self, http=None):
+        """Run the requests. A failure queued under 'batch' is raised after
+        they have all been applied, as if the connection dropped before the
+        responses came back.
+        """
+        self.api.calls['batch'] += 1
+        self.api.batch_sizes.append(len(self.requests))
+        failures = self.api.failures.get('batch')
+        dropped = failures.pop(0) if failures else None
+        for request, callback, request_id in self.requests:
+            try:
+                response, exception = request.execute(), None
+            except FakeHttpError as exc:
+                response, exception = None, exc
+            if callback is not None and dropped is None:
+                callback(request_id, response, exception)
+        if dropped is not None:
+            raise dropped
+
+
+class FakeCollection:
+    def __init__(self, api):
+        self.api = api
+
+
+class FakeCalendars(FakeCollection):
+    def insert(self, body):
+        def func():
+            cal_id = 'cal{}'.format(len(self.api.remote_calendars))
+            self.api.remote_calendars[cal_id] = {'id': cal_id, 'summary': body['summary']}
+            self.api.remote_events[cal_id] = {}
+            return dict(self.api.remote_calendars[cal_id])
+        return FakeRequest(self.api, 'calendars.insert', func)
+
+    def delete(self, calendarId):
+        def func():
+            del self.api.remote_calendars[calendarId]
+            del self.api.remote_events[calendarId]
+        return FakeRequest(self.api, 'calendars.delete', func)
+
+
+class FakeListable(FakeCollection):
+    """Pages through list results like the real API does, in pages of at
+    most the service's page_size. Subclasses provide items().
+    """
+    name = None
+
+    def list(self, pageToken=None, maxResults=None, fields=None, **kwargs):
+        def func():
+            self.api.list_fields.append(fields)
+            items = self.items(**kwargs)
+            # tokens are opaque, and only good for the listing they came
+            # from, like the real ones.
+            start = self.api.page_tokens[pageToken] if pageToken else 0
+            size = min(maxResults or 100, self.api.page_size)
+            resp = {'items': items[start:start + size]}
+            if start + size < len(items):
+                token = uuid.uuid4().hex
+                self.api.page_tokens[token] = start + size
+                resp['nextPageToken'] = token
+            return resp
+        request = FakeRequest(self.api, self.name, func)
+        request.kwargs = dict(kwargs, maxResults=maxResults, fields=fields)
+        return request
+
+    def list_next(self, previous_request, previous_response):
+        if 'nextPageToken' not in previous_response:
+            return None
+        return self.list(pageToken=previous_response['nextPageToken'],
+                         **previous_request.kwargs)
+
+
+class FakeCalendarList(FakeListable):
+    name = 'calendarList.list'
+
+    def items(self):
+        return [dict(c) for c in self.api.remote_calendars.values()]
+
+
+class FakeEvents(FakeListable):
+    name = 'events.list'
+
+    def items(self, calendarId, showDeleted=False):
+        return [dict(e) for e in self.api.remote_events[calendarId].values()
+                if showDeleted or e['status'] != 'cancelled']
+
+    def insert(self, calendarId, body):
+        def func():
+            event = dict(body, status='confirmed')
+            event.setdefault('id', 'auto{}'.format(self.api.calls['events.insert']))
+            assert event['id'] not in self.api.remote_events[calendarId]
+            self.api.remote_events[calendarId][event['id']] = event
+            return event
+        return FakeRequest(self.api, 'events.insert', func)
+
+    def patch(self, calendarId, eventId, body):
+        def func():
+            self.api.remote_events[calendarId][eventId].update(body)
+            return self.api.remote_events[calendarId][eventId]
+        return FakeRequest(self.api, 'events.patch', func)
+
+    def delete(self, calendarId, eventId):
+        def func():
+            self.api.remote_events[calendarId][eventId]['status'] = 'cancelled'
+            return ''
+        return FakeRequest(self.api, 'events.delete', func)
+
+
+class FakeCalendarService:
+    """An in-memory stand-in for the google calendar v3 service."""
+    def __init__(self):
+        self.remote_calendars = {}
+        self.remote_events = {}
+        self.calls = collections.Counter()
+        self.failures = {}
+        self.batch_sizes = []
+        self.list_fields = []
+        self.page_tokens = {}
+        self.page_size = 1000
+
+    def calendars(self):
+        return FakeCalendars(self)
+
+    def calendarList(self):
+        return FakeCalendarList(self)
+
+    def events(self):
+        return FakeEvents(self)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self, callback)
+
+    def live_events(self, name):
+        for cal_id, cal in self.remote_calendars.items():
+            if cal['summary'] == name:
+                return {k: v for k, v in self.remote_events[cal_id].items()
+                        if v['status'] != 'cancelled'}
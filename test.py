@@ -1,12 +1,31 @@
 import ums
+import benchmark
+from fakes import FakeCalendarService, FakeHttpError
 
+import collections
+import csv
+import gzip
+import hashlib
+import http.server
+import io
+import itertools
 import json
 import os
 import shutil
+import stat
+import subprocess
+import sys
 import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
 
 from unittest import mock
 
+import httplib2
+import icalendar
 import pytest
 
 TEST_DATA = b"""{
@@ -121,6 +140,150 @@ def test_ds_get_nowrite():
         assert session.get.call_count == 1
         assert ds.cache['data'] == data
 
+class StubFeedHandler(http.server.BaseHTTPRequestHandler):
+    """Serves TEST_DATA-style events, one per venue per day, slowly."""
+    delay = 0.3
+    failures = {}  # type: dict
+    renamed = {}  # type: dict
+    requests = []  # type: list
+
+    def do_GET(self):
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        start = ums.parse_date(query['start'][0])
+        end = ums.parse_date(query['end'][0])
+        self.requests.append(query['start'][0])
+        failures = self.failures.get(query['start'][0], 0)
+        if failures:
+            self.failures[query['start'][0]] = failures - 1
+            self.send_response(500)
+            self.end_headers()
+            return
+        time.sleep(self.delay)
+        data = []
+        # overlap windows by a day so that merging has to de-duplicate
+        day = start - ums.timedelta(days=1)
+        while day < end:
+            for venue in ('venue1', 'venue2'):
+                data.append({
+                    'start': day.strftime('%Y-%m-%dT21:00:00+0000'),
+                    'end': day.strftime('%Y-%m-%dT21:40:00+0000'),
+                    'venue_artist': self.renamed.get(
+                        day.isoformat(), 'artist@{}'.format(venue)
+                    ),
+                    'url': 'http://example.com/artists/artist',
+                    'venue_name': venue,
+                    'venue_url': 'http://example.com/venues/' + venue,
+                    'description': '123 Fake Lane, Denver, CO',
+                })
+            day += ums.timedelta(days=1)
+        body = json.dumps(data).encode('utf-8')
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubFeedHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    finally:
+        StubFeedHandler.failures.clear()
+        StubFeedHandler.renamed.clear()
+        del StubFeedHandler.requests[:]
+        server.shutdown()
+        server.server_close()
+
+
+def test_ds_pull_windows(stub_server):
+    ds = ums.DataSource(url=stub_server, window_days=1, workers=5)
+    assert len(ds.windows()) == 5
+    started = time.monotonic()
+    data = ds.pull()
+    elapsed = time.monotonic() - started
+    # five windows of 0.3s each, fetched together
+    assert elapsed < 1.2
+    # 6 days (the stub adds the day before) x 2 venues, without duplicates
+    assert len(data) == 12
+    assert len({ums.event_key(r) for r in data}) == 12
+
+
+def test_ds_pull_retry(stub_server):
+    StubFeedHandler.failures['2016-07-27'] = 1
+    ds = ums.DataSource(url=stub_server, window_days=2, backoff=0.01)
+    assert len(ds.pull()) == 12
+
+    StubFeedHandler.failures['2016-07-27'] = 5
+    ds = ums.DataSource(url=stub_server, window_days=2, retries=1, backoff=0.01)
+    with pytest.raises(ums.requests.HTTPError):
+        ds.pull()
+
+
+def test_ds_revalidate(stub_server, tempdir):
+    path = os.path.join(tempdir, 'events.json')
+    StubFeedHandler.delay = 0
+    try:
+        ds = ums.DataSource(path, stub_server, window_days=2, max_age=60)
+        assert len(ds.get()['data']) == 12
+        assert ds.cache_stats == {'miss': 1}
+
+        # fresh enough, no requests at all
+        del StubFeedHandler.requests[:]
+        ds = ums.DataSource(path, stub_server, window_days=2, max_age=60)
+        ds.get()
+        assert ds.cache_stats == {'hit': 1}
+        assert StubFeedHandler.requests == []
+
+        # expired but unchanged: every window comes back 304
+        stat = os.stat(path)
+        with open(path) as fp:
+            retrieved = json.load(fp)['retrieved']
+        ds = ums.DataSource(path, stub_server, window_days=2, max_age=-1,
+                            streaming=True)
+        ds.get()
+        assert ds.cache_stats == {'revalidated': 1}
+        assert ds.cache is None
+        assert len(list(ds.records())) == 12
+        # only the metadata was saved, next to the untouched cache file
+        assert os.stat(path).st_mtime_ns == stat.st_mtime_ns
+        assert os.path.exists(path + '.meta')
+        with open(path + '.meta') as fp:
+            saved = json.load(fp)
+        assert saved['retrieved'] >= retrieved
+        for streaming in (False, True):
+            ds = ums.DataSource(path, stub_server, window_days=2,
+                                streaming=streaming)
+            ds.load()
+            assert ds.metadata['retrieved'] == saved['retrieved']
+            assert ds.metadata['validators'] == saved['validators']
+
+        # one window changes, the others keep their cached records
+        StubFeedHandler.renamed['2016-07-30'] = 'newartist'
+        ds = ums.DataSource(path, stub_server, window_days=2, max_age=-1)
+        ds.get()
+        assert ds.cache_stats == {'miss': 1}
+        artists = [r['venue_artist'] for r in ds.cache['data']]
+        assert len(artists) == 12
+        assert artists.count('newartist') == 2
+        assert artists.count('artist@venue1') == 5
+        assert not os.path.exists(path + '.meta')
+    finally:
+        StubFeedHandler.delay = 0.3
+
+
 def test_event_read(calendars):
     assert len(calendars) == 2
     assert len(calendars['venue1']) == 3
@@ -129,6 +292,154 @@ def test_event_read(calendars):
     assert all(isinstance(e, ums.Event) for cal in calendars.values() for e in cal)
 
 
+def test_parse_timestamps():
+    values = ['2016-07-28T21:00:00+0000', '2016-07-29T01:02:03+0000']
+    parsed = ums.parse_timestamps(values)
+    for value, ts in zip(values, parsed):
+        expected = ums.datetime.strptime(value, ums.Event.DATEFMT)
+        assert ums.EPOCH + ums.timedelta(seconds=ts) == expected
+
+
+def test_event_store_columns():
+    data = json.loads(TEST_DATA.decode('ascii'))['data']
+    store = ums.EventStore.from_records(data)
+    assert len(store) == 6
+    # venue names and addresses are stored once each
+    assert store.strings.count('venue1') == 1
+    assert store.strings.count('123 Fake Lane, Denver, CO') == 1
+    assert [e.src for e in store] == data
+    assert store[-1].artist == 'artist6'
+
+
+def test_event_store_compact():
+    data = json.loads(TEST_DATA.decode('ascii'))['data']
+    data[0] = dict(data[0], venue_artist='  artist1 ')
+    store = ums.EventStore.from_records(data)
+    other = ums.EventStore.from_records(data)
+    assert 'artist1' in store.strings and '  artist1 ' not in store.strings
+    assert store[0].artist == 'artist1'
+    assert store[0].key == ums.event_key(data[0])
+    # the same strings are shared between stores
+    assert store.strings[store.code_for('venue1')] is \
+           other.strings[other.code_for('venue1')]
+    rows = ums.EventStore()
+    rows.extend_rows([(0, 60, ' artist ', 'u', 'v', 'vu', 'a')])
+    assert rows[0].artist == 'artist'
+
+
+def test_event_standalone():
+    data = json.loads(TEST_DATA.decode('ascii'))['data']
+    event = ums.Event(data[0])
+    assert event.artist == 'artist1'
+    assert event.venue == 'venue1'
+    assert event.start == ums.datetime(2016, 7, 28, 21, 0)
+    assert event.str_with_venue() == '(Thu 09:00 PM - 09:40 PM): artist1 @ venue1'
+
+
+def test_calendars_venue_filter(jsondata):
+    ds = ums.DataSource(filepath=jsondata)
+    calendars = ds.calendars(venue='venue2')
+    assert list(calendars) == ['venue2']
+    assert [e.artist for e in calendars['venue2']] == ['artist4', 'artist5', 'artist6']
+    assert ds.calendars(venue='nowhere') == {}
+
+
+def test_index_between(jsondata):
+    ds = ums.DataSource(filepath=jsondata)
+    index = ds.index()
+    when = ums.datetime(2016, 7, 28, 21, 30)
+    # overlapping events, in start order
+    found = index.between(when, when + ums.timedelta(minutes=40))
+    assert [e.artist for e in found] == ['artist1', 'artist4', 'artist2', 'artist5']
+    assert [e.artist for e in index.between(when, venues=['venue2'])] == \
+        ['artist4', 'artist5', 'artist6']
+    assert index.between(end=ums.datetime(2016, 7, 28)) == []
+
+    calendars = ds.calendars(venue=['venue1', 'venue2'],
+                             start=ums.datetime(2016, 7, 28, 22, 30))
+    assert [e.artist for e in calendars['venue1']] == ['artist2', 'artist3']
+    assert [e.artist for e in calendars['venue2']] == ['artist5', 'artist6']
+
+
+def test_index_now_next(jsondata):
+    index = ums.DataSource(filepath=jsondata).index()
+    when = ums.datetime(2016, 7, 28, 21, 50)
+    assert index.now('venue1', when) is None
+    assert index.next('venue1', when).artist == 'artist2'
+    assert index.now('venue1', when.replace(hour=22, minute=10)).artist == 'artist2'
+    assert index.next('venue1', when.replace(hour=23)) is None
+    assert index.now('nowhere', when) is None
+
+
+def test_snapshot(jsondata):
+    snap = jsondata + '.snap'
+    try:
+        ds = ums.DataSource(filepath=jsondata, snapshot=True)
+        expected = {k: [e.src for e in v] for k, v in ds.calendars().items()}
+        assert os.path.exists(snap)
+        assert not isinstance(ds.events(), ums.SnapshotStore)
+
+        # a second run starts from the snapshot without parsing the json
+        ds = ums.DataSource(filepath=jsondata, snapshot=True)
+        with mock.patch('ums.json.load') as mock_load:
+            calendars = ds.calendars()
+        assert mock_load.call_count == 0
+        assert isinstance(ds.events(), ums.SnapshotStore)
+        assert {k: [e.src for e in v] for k, v in calendars.items()} == expected
+        assert ds.index().now('venue2', ums.datetime(2016, 7, 28, 22, 10)).artist == 'artist5'
+
+        # changing the json makes the snapshot stale
+        with open(jsondata, 'a') as fp:
+            fp.write('\n')
+        ds = ums.DataSource(filepath=jsondata, snapshot=True)
+        assert not isinstance(ds.events(), ums.SnapshotStore)
+        assert ums.SnapshotStore.is_current(snap, os.stat(jsondata))
+    finally:
+        if os.path.exists(snap):
+            os.remove(snap)
+
+
+def test_sqlite_datasource_args(jsondata):
+    assert ums.parse_args([]).datasource == 'events.json'
+    assert ums.parse_args(['--backend', 'sqlite']).datasource == 'events.db'
+    argv = ['ums.py', '--backend', 'sqlite', '--datasource', jsondata]
+    with mock.patch.object(sys, 'argv', argv):
+        with pytest.raises(SystemExit) as excinfo:
+            ums.main()
+    assert 'is not a SQLite database' in str(excinfo.value)
+
+
+def test_sqlite_datasource(tempdir):
+    path = os.path.join(tempdir, 'events.sqlite')
+    cache = json.loads(TEST_DATA.decode('ascii'))
+    ds = ums.SqliteDataSource(path)
+    ds.cache = cache
+    ds.writefile()
+
+    ds = ums.SqliteDataSource(path)
+    calendars = ds.calendars()
+    assert [e.artist for e in calendars['venue1']] == ['artist1', 'artist2', 'artist3']
+    assert [e.src for e in calendars['venue2']] == cache['data'][3:]
+    filtered = ds.calendars(venue=['venue2'], start=ums.datetime(2016, 7, 28, 22, 30))
+    assert list(filtered) == ['venue2']
+    assert [e.artist for e in filtered['venue2']] == ['artist5', 'artist6']
+
+    # change one event and drop another: only those rows are touched
+    data = [dict(r) for r in cache['data'][:-1]]
+    data[0]['end'] = '2016-07-28T21:50:00+0000'
+    ds = ums.SqliteDataSource(path)
+    ds.cache = {'retrieved': '2016-07-17T00:00:00', 'data': data}
+    ds.writefile()
+    history = ds.retrievals()
+    assert [(r['changed'], r['removed']) for r in history] == [(6, 0), (1, 1)]
+
+    ds = ums.SqliteDataSource(path)
+    assert ds.get() is None
+    assert ds.metadata['retrieved'] == '2016-07-17T00:00:00'
+    assert len(list(ds.records())) == 5
+    assert [e.artist for e in ds.calendars()['venue2']] == ['artist4', 'artist5']
+
+
 def test_event_write(jsondata):
     name = None
     try:
@@ -146,6 +457,64 @@ def test_event_write(jsondata):
             os.remove(name)
 
 
+def test_write_records_layout():
+    cache = json.loads(TEST_DATA.decode('ascii'))
+    out = io.StringIO()
+    ums.write_records(out, cache, cache['data'])
+    assert out.getvalue() == json.dumps(cache, indent=4)
+
+    out = io.StringIO()
+    ums.write_records(out, {'retrieved': 'now'}, [])
+    assert json.loads(out.getvalue()) == {'retrieved': 'now', 'data': []}
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 1 << 16])
+def test_iter_records(chunk_size):
+    doc = {'count': 12345, 'data': [{'a': 1}, {'b': [1, 2]}], 'tail': None}
+    header = {}
+    records = ums.iter_records(io.StringIO(json.dumps(doc)), header=header,
+                               chunk_size=chunk_size)
+    assert list(records) == doc['data']
+    assert header == {'count': 12345, 'tail': None}
+
+
+@pytest.mark.parametrize('chunk_size', range(1, 40))
+def test_iter_records_numbers(chunk_size):
+    text = '{"count": -1.25E+3, "data": [1.5, 2e5, 10, -0.001, 3E-2], "n": 7}'
+    header = {}
+    records = ums.iter_records(io.StringIO(text), header=header,
+                               chunk_size=chunk_size)
+    assert list(records) == [1.5, 2e5, 10, -0.001, 3E-2]
+    assert header == {'count': -1250.0, 'n': 7}
+
+
+def test_dump_json_atomically(tempdir):
+    path = os.path.join(tempdir, 'state.json')
+    assert ums._load_json(path) == {}
+    assert ums._load_json(None) == {}
+    ums._dump_json_atomically(path, {'a': [1]})
+    assert ums._load_json(path) == {'a': [1]}
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o666 & ~ums._UMASK
+
+    with pytest.raises(TypeError):
+        ums._dump_json_atomically(path, {'a': object()})
+    # the old file is untouched, and the temporary one is gone
+    assert ums._load_json(path) == {'a': [1]}
+    assert os.listdir(tempdir) == ['state.json']
+
+    with open(path, 'w') as fp:
+        fp.write('{not json')
+    assert ums._load_json(path) == {}
+
+
+def test_ds_streaming(jsondata):
+    ds = ums.DataSource(filepath=jsondata, streaming=True)
+    calendars = ds.calendars()
+    assert ds.cache is None
+    assert [e.artist for e in calendars['venue1']] == ['artist1', 'artist2', 'artist3']
+    assert [e.artist for e in calendars['venue2']] == ['artist4', 'artist5', 'artist6']
+
+
 def test_csv_dir(calendars, tempdir):
     writer = ums.CSVWriter(output=tempdir)
     writer.write(calendars.values(), flatten=False)
@@ -159,6 +528,42 @@ def test_csv_dir(calendars, tempdir):
             assert len(lines) == 4 # header + 3 entries
 
 
+def test_csv_stream(calendars, tempdir):
+    # an unsorted, ungrouped stream, through a single open file
+    events = [e for cal in calendars.values() for e in cal]
+    events = events[::2] + events[1::2]
+    writer = ums.CSVWriter(output=tempdir, max_open=1)
+    writer.write_stream(events)
+    with open(os.path.join(tempdir, 'ums - venue1.csv')) as fp:
+        rows = list(csv.reader(fp))
+    assert rows[0] == list(ums.CSVWriter.FIELDS)
+    assert [r[7] for r in rows[1:]] == ['artist1', 'artist3', 'artist2']
+    assert rows[1] == [
+        '123 Fake Lane, Denver, CO', 'venue1', '07/28/2016', '09:00 PM',
+        '07/28/2016', '0940 PM', 'False', 'artist1', 'False'
+    ]
+    with open(os.path.join(tempdir, 'ums - venue2.csv')) as fp:
+        assert len(fp.readlines()) == 4
+
+
+@pytest.mark.parametrize('writer_cls', [ums.IcalWriter, ums.CSVWriter])
+def test_directory_mixed_venues(calendars, tempdir, writer_cls):
+    plan = ums.Calendar('UMS (Everything)', items=itertools.chain.from_iterable(
+        calendars.values()
+    ))
+    assert len({e.venue for e in plan}) > 1
+    manifest = os.path.join(tempdir, 'manifest.json')
+    output = os.path.join(tempdir, 'out')
+    writer = writer_cls(output, manifest_path=manifest)
+    writer.write([plan])
+    name = writer.calendar_filename(plan)
+    assert os.listdir(output) == [name]
+    with open(manifest) as fp:
+        assert list(json.load(fp)) == [os.path.join(output, name)]
+    with open(os.path.join(output, name), 'rb') as fp:
+        assert fp.read() == writer.render(plan)
+
+
 def test_csv_file(calendars, tempdir):
     filepath = os.path.join(tempdir, 'test.csv')
     writer = ums.CSVWriter(output=filepath)
@@ -203,6 +608,127 @@ def test_csv_file_overwrite(calendars, tempdir):
 
 
 
+def ical_components(data):
+    """Parse ical data down to comparable (component, properties) pairs."""
+    components = []
+    for component in icalendar.Calendar.from_ical(data).walk():
+        props = sorted((key, value.to_ical()) for key, value in component.items())
+        components.append((component.name, props))
+    return components
+
+
+def test_ical_stream_matches_object(calendars, tempdir):
+    data = json.loads(TEST_DATA.decode('ascii'))['data']
+    data[0]['venue_artist'] = 'Ünïcødé; the band, with\na newline \\ ' * 3
+    data[1]['description'] = 'A very long address, ' * 10
+    events = ums.EventStore.from_records(data).calendars()
+    streamed = ums.IcalWriter(output=tempdir, silently_destroy_data=True)
+    objects = ums.IcalWriter(output=tempdir, serializer='object')
+    for calendar in events.values():
+        out = io.BytesIO()
+        streamed.stream_ical(out, calendar, calendar.name)
+        fast = out.getvalue()
+        slow = objects.to_ical_calendar(calendar).to_ical()
+        assert ical_components(fast) == ical_components(slow)
+        assert all(len(line) <= 75 for line in fast.split(b'\r\n'))
+
+    streamed.write(events.values(), flatten=False)
+    assert sorted(os.listdir(tempdir)) == ['ums - venue1.ical', 'ums - venue2.ical']
+
+
+class BrokenIcalWriter(ums.IcalWriter):
+    def render(self, calendar):
+        raise RuntimeError('cannot render {}'.format(calendar.name))
+
+
+@pytest.mark.parametrize('writer_cls', [ums.IcalWriter, ums.CSVWriter])
+def test_parallel_directory(calendars, tempdir, writer_cls):
+    serial_dir = os.path.join(tempdir, 'serial')
+    parallel_dir = os.path.join(tempdir, 'parallel')
+    writer_cls(output=serial_dir).write(calendars.values())
+    writer_cls(output=parallel_dir, jobs=2).write(calendars.values())
+    files = sorted(os.listdir(serial_dir))
+    assert files == sorted(os.listdir(parallel_dir)) and len(files) == 2
+    for name in files:
+        with open(os.path.join(serial_dir, name), 'rb') as fp:
+            serial = fp.read()
+        with open(os.path.join(parallel_dir, name), 'rb') as fp:
+            assert fp.read() == serial
+
+
+class TextFileWriter(ums.FileWriter):
+    """A file writer with no render() of its own."""
+    def calendar_filename(self, calendar):
+        return calendar.name + '.txt'
+
+    def write_file(self, path, calendar):
+        with open(path, 'w', encoding='utf-8') as fp:
+            fp.writelines(e.artist + '\n' for e in calendar)
+
+
+def test_render_matches_file(tempdir):
+    data = json.loads(TEST_DATA.decode('ascii'))['data']
+    data[0] = dict(data[0], venue_artist='Beyonc\u00e9')
+    calendar = ums.EventStore.from_records(data).calendars()['venue1']
+    writer = ums.CSVWriter(None)
+    path = os.path.join(tempdir, 'out.csv')
+    writer.write_file(path, calendar)
+    with open(path, 'rb') as fp:
+        written = fp.read()
+    assert writer.render(calendar) == written
+    assert 'Beyonc\u00e9'.encode('utf-8') in written
+    assert written.count(b'\r\n') == 4 and b'\r\r' not in written
+
+    rendered = TextFileWriter(tempdir).render(calendar)
+    assert rendered.decode('utf-8').splitlines() == \
+        ['Beyonc\u00e9', 'artist2', 'artist3']
+    assert os.listdir(tempdir) == ['out.csv']
+
+
+def test_parallel_directory_prompts_first(calendars, tempdir):
+    os.makedirs(tempdir, exist_ok=True)
+    existing = os.path.join(tempdir, 'ums - venue1.ical')
+    with open(existing, 'w'):
+        pass
+    writer = ums.IcalWriter(output=tempdir, jobs=2)
+    with mock.patch('ums.wait_for_response') as mock_wait, \
+            mock.patch('ums.ProcessPoolExecutor') as mock_pool:
+        mock_wait.return_value = False
+        writer.write(calendars.values())
+    assert mock_wait.call_count == 1
+    # only one calendar left to write, so no pool
+    assert mock_pool.call_count == 0
+    assert os.path.getsize(existing) == 0
+    assert os.path.getsize(os.path.join(tempdir, 'ums - venue2.ical')) > 0
+
+
+def test_parallel_directory_errors(calendars, tempdir):
+    writer = BrokenIcalWriter(output=tempdir, jobs=2)
+    with pytest.raises(RuntimeError):
+        writer.write(calendars.values())
+
+    writer = ums.IcalWriter(output=tempdir, jobs=2)
+    with mock.patch('ums.os.replace', side_effect=OSError('disk full')):
+        with pytest.raises(OSError):
+            writer.write(calendars.values())
+    assert os.listdir(tempdir) == []
+
+
+def test_parallel_main(jsondata, tempdir):
+    argv = ['ums.py', '--quiet', '--datasource', jsondata, '--jobs', '2',
+            '--googlecsv', os.path.join(tempdir, 'csv'),
+            '--ical', os.path.join(tempdir, 'ical')]
+    with mock.patch.object(sys, 'argv', argv), \
+            mock.patch('ums.ProcessPoolExecutor',
+                       wraps=ums.ProcessPoolExecutor) as mock_pool:
+        ums.main()
+    assert mock_pool.call_count == 2
+    assert sorted(os.listdir(os.path.join(tempdir, 'csv'))) == \
+        ['ums - venue1.csv', 'ums - venue2.csv']
+    assert sorted(os.listdir(os.path.join(tempdir, 'ical'))) == \
+        ['ums - venue1.ical', 'ums - venue2.ical']
+
+
 # Just make sure we don't crash, no correctness checks
 def test_stdout(calendars):
     writer = ums.StdoutWriter()
@@ -220,3 +746,868 @@ def test_gcal_events(calendars):
         'description': '[artist1](http://example.com/artists/artist1) @ [venue1](http://example.com/venues/venue1)',
         'summary': 'artist1',
     }
+
+
+def test_gcal_sync(calendars, tempdir):
+    mirror = os.path.join(tempdir, 'mirror.json')
+    api = FakeCalendarService()
+    writer = ums.GoogleCalendarWriter(None, service=api, sync=True,
+                                      mirror_path=mirror)
+    writer.write(calendars.values())
+    assert len(api.live_events('UMS - venue1')) == 3
+    assert len(api.live_events('UMS - venue2')) == 3
+    assert api.calls['events.insert'] == 6
+
+    # nothing changed: no writes, and the mirror means no event listing
+    api.calls.clear()
+    writer = ums.GoogleCalendarWriter(None, service=api, sync=True,
+                                      mirror_path=mirror)
+    writer.write(calendars.values())
+    assert set(api.calls) == {'calendarList.list'}
+
+    # drop one event and change another
+    venue1 = calendars['venue1']
+    data = [e.src for e in venue1[1:]]
+    data[0]['end'] = '2016-07-28T22:50:00+0000'
+    changed = ums.EventStore.from_records(data).calendars()
+    api.calls.clear()
+    writer = ums.GoogleCalendarWriter(None, service=api, sync=True,
+                                      mirror_path=mirror)
+    writer.write(changed.values())
+    assert writer.stats == {'patch': 1, 'delete': 1}
+    remote = api.live_events('UMS - venue1')
+    assert sorted(e['summary'] for e in remote.values()) == ['artist2', 'artist3']
+
+    # without the mirror, the remote calendar is listed, deleted ids are
+    # revived rather than re-inserted.
+    os.remove(mirror)
+    api.calls.clear()
+    writer = ums.GoogleCalendarWriter(None, service=api, sync=True,
+                                      mirror_path=mirror,
+                                      silently_destroy_data=True)
+    writer.write([venue1])
+    assert writer.stats == {'patch': 2}
+    assert api.calls['events.list'] == 1
+    assert len(api.live_events('UMS - venue1')) == 3
+
+
+def test_batch_executor_chunks_and_retries():
+    api = FakeCalendarService()
+    cal_id = api.calendars().insert(body={'summary': 'x'}).execute()['id']
+    api.failures['events.insert'] = [
+        FakeHttpError(429),
+        FakeHttpError(403, b'{"error": {"errors": [{"reason": "rateLimitExceeded"}]}}'),
+    ]
+    executor = ums.BatchExecutor(api, workers=3, backoff=0.01)
+    requests = [api.events().insert(calendarId=cal_id, body={'summary': str(i)})
+                for i in range(120)]
+    responses = executor.execute(requests)
+    assert [r['summary'] for r in responses] == [str(i) for i in range(120)]
+    assert api.batch_sizes == [50, 50, 20, 2]
+    assert executor.stats == {'requests': 120, 'batches': 4, 'retries': 2}
+
+
+def test_batch_executor_failures():
+    api = FakeCalendarService()
+    cal_id = api.calendars().insert(body={'summary': 'x'}).execute()['id']
+    api.failures['events.insert'] = [FakeHttpError(400)]
+    executor = ums.BatchExecutor(api, backoff=0.01)
+    requests = [api.events().insert(calendarId=cal_id, body={'summary': str(i)})
+                for i in range(3)]
+    with pytest.raises(ums.BatchError) as excinfo:
+        executor.execute(requests)
+    assert [index for index, _ in excinfo.value.failures] == [0]
+    # the rest still went through
+    assert len(api.remote_events[cal_id]) == 2
+
+
+@pytest.mark.parametrize('exception,retryable', [
+    (FakeHttpError(500), True),
+    (FakeHttpError(429), True),
+    (FakeHttpError(403, b'{"error": {"errors": [{"reason": "userRateLimitExceeded"}]}}'), True),
+    (FakeHttpError(403, b'{"error": {"errors": [{"reason": "forbidden"}]}}'), False),
+    (FakeHttpError(403, b'not json, rateLimitExceeded'), False),
+    (FakeHttpError(404), False),
+    (ConnectionResetError(), True),
+    (ums.httplib2.ServerNotFoundError(), True),
+    (ValueError(), False),
+])
+def test_batch_executor_retryable(exception, retryable):
+    assert ums.BatchExecutor.retryable(exception) is retryable
+
+
+def test_batch_executor_dropped_batch():
+    api = FakeCalendarService()
+    cal_id = api.calendars().insert(body={'summary': 'x'}).execute()['id']
+    api.events().insert(calendarId=cal_id, body={'id': 'a'}).execute()
+    api.failures['batch'] = [ConnectionResetError()]
+    executor = ums.BatchExecutor(api, backoff=0.01)
+    with pytest.raises(ums.BatchError) as excinfo:
+        executor.execute([
+            api.events().insert(calendarId=cal_id, body={'summary': 'b'}),
+            api.events().patch(calendarId=cal_id, eventId='a',
+                               body={'summary': 'c'}),
+        ])
+    [(index, exc)] = excinfo.value.failures
+    assert index == 0
+    assert isinstance(exc, ums.UnknownOutcomeError)
+    # the insert went through once and was not sent again; the patch was.
+    assert api.calls['events.insert'] == 2
+    assert api.calls['events.patch'] == 2
+    assert len(api.live_events('x')) == 2
+
+
+def test_token_bucket():
+    bucket = ums.TokenBucket(rate=100, capacity=1)
+    started = time.monotonic()
+    for _ in range(6):
+        bucket.acquire()
+    assert time.monotonic() - started >= 0.045
+
+
+def test_gcal_paginated_clear(calendars):
+    api = FakeCalendarService()
+    api.page_size = 2
+    for i in range(5):
+        api.calendars().insert(body={'summary': 'other{}'.format(i)}).execute()
+    cal_id = api.calendars().insert(body={'summary': 'UMS - venue1'}).execute()['id']
+    for i in range(7):
+        api.events().insert(calendarId=cal_id, body={'summary': str(i)}).execute()
+    for event_id in ('auto1', 'auto4'):
+        api.events().delete(calendarId=cal_id, eventId=event_id).execute()
+
+    writer = ums.GoogleCalendarWriter(None, service=api,
+                                      silently_destroy_data=True)
+    writer.write(calendars.values())
+    # the old events were all on later pages than the first
+    assert sorted(e['summary'] for e in api.live_events('UMS - venue1').values()) == \
+        ['artist1', 'artist2', 'artist3']
+    # only the five live events were listed and deleted
+    assert api.calls['events.list'] == 3
+    assert api.calls['events.delete'] == 2 + 5
+    assert api.calls['calendarList.list'] == 3
+    assert set(api.list_fields) == {
+        'nextPageToken,items(id,summary)', 'nextPageToken,items(id,status)'
+    }
+    # creating venue2's calendar updated the cached list instead of
+    # dropping it
+    assert 'UMS - venue2' in writer.calendar_list_cache
+    assert api.calls['calendarList.list'] == 3
+
+
+def test_gcal_discovery_cache(tempdir):
+    document = json.dumps({
+        'kind': 'discovery#restDescription',
+        'name': 'calendar',
+        'version': 'v3',
+        'rootUrl': 'https://www.googleapis.com/',
+        'servicePath': 'calendar/v3/',
+        'baseUrl': 'https://www.googleapis.com/calendar/v3/',
+        'batchPath': 'batch/calendar/v3',
+        'resources': {'events': {'methods': {}}},
+    }).encode('utf-8')
+    path = os.path.join(tempdir, 'discovery.json')
+    http = mock.Mock()
+    http.request.return_value = (mock.Mock(status=200), document)
+
+    fetched = ums.GoogleCalendarWriter.load_discovery(http, path)
+    assert http.request.call_count == 1
+    started = time.monotonic()
+    service = ums.GoogleCalendarWriter.build_service(http, path)
+    startup = time.monotonic() - started
+    assert http.request.call_count == 1
+    assert hasattr(service, 'events')
+    assert startup < 1.0
+
+    # expired, and the refetch fails: fall back on the stale copy
+    http.request.side_effect = httplib2.HttpLib2Error('offline')
+    assert ums.GoogleCalendarWriter.load_discovery(http, path, ttl=0) == fetched
+    assert http.request.call_count == 2
+
+
+def test_gcal_credentials_expiring():
+    now = ums.datetime.utcnow()
+    expiring = ums.GoogleCalendarWriter.expiring
+    assert expiring(mock.Mock(token_expiry=now + ums.timedelta(minutes=1)))
+    assert not expiring(mock.Mock(token_expiry=now + ums.timedelta(minutes=30)))
+    assert not expiring(mock.Mock(token_expiry=None))
+
+
+HEAVY_MODULES = ('icalendar', 'requests', 'httplib2', 'apiclient',
+                 'googleapiclient', 'oauth2client')
+
+
+def imported_modules(*args):
+    """Run main() in a fresh interpreter and return the heavy modules that
+    ended up imported.
+    """
+    script = (
+        'import sys, json\n'
+        'sys.argv = ["ums.py"] + json.loads(sys.argv[1])\n'
+        'import ums\n'
+        'if sys.argv[1:]:\n'
+        '    ums.main()\n'
+        'print(json.dumps([m for m in {!r} if m in sys.modules]))\n'
+    ).format(HEAVY_MODULES)
+    output = subprocess.check_output(
+        [sys.executable, '-c', script, json.dumps(list(args))],
+        cwd=os.path.dirname(os.path.abspath(ums.__file__))
+    )
+    return json.loads(output.decode('utf-8').splitlines()[-1])
+
+
+def test_lazy_imports(jsondata, tempdir):
+    assert imported_modules() == []
+    csv_run = imported_modules('--quiet', '--datasource', jsondata,
+                               '--googlecsv', tempdir)
+    assert csv_run == []
+    assert len(os.listdir(tempdir)) == 2
+    ical_run = imported_modules('--datasource', jsondata, '--ical', tempdir,
+                                '--silently-destroy-data',
+                                '--ical-serializer', 'object')
+    assert ical_run == ['icalendar']
+
+
+def test_writer_registry():
+    args = ums.parse_args(['--quiet', '--googlecsv', 'out', '--ical', 'out2'])
+    writers = ums.make_writers(args)
+    assert [type(w) for w in writers] == [ums.CSVWriter, ums.IcalWriter]
+    try:
+        ums.register_writer('extra', '{}:BrokenIcalWriter'.format(__name__))
+        assert ums.writer_class('extra') is BrokenIcalWriter
+    finally:
+        del ums.WRITERS['extra']
+
+
+def test_benchmark(tempdir):
+    results = benchmark.run_size(200, 5, benchmark.STAGES, tempdir)
+    assert [r['stage'] for r in results] == list(benchmark.STAGES)
+    assert all(r['events'] == 200 and r['peak_rss_kb'] > 0 for r in results)
+
+    memory = results[-1]
+    assert memory['bytes_per_event'] < memory['dict_bytes_per_event'] / 4
+
+    slower = [dict(r, seconds=r['seconds'] + 1) for r in results]
+    assert benchmark.compare(results, results, threshold=0.25) == []
+    regressions = benchmark.compare(slower, results, threshold=0.25)
+    assert len(regressions) == len(benchmark.STAGES) - 1
+    assert regressions[0].startswith('readfile (200 events, 5 venues)')
+    bigger = [dict(memory, bytes_per_event=memory['bytes_per_event'] * 2)]
+    assert len(benchmark.compare(bigger, results, threshold=0.25)) == 1
+
+
+def test_metrics_disabled():
+    metrics = ums.Metrics()
+    with metrics.timer('stage'):
+        metrics.count('things')
+    assert metrics.as_dict() == {'timings': {}, 'counters': {}}
+
+
+def test_profile(jsondata, tempdir, stub_server, capsys):
+    metrics_path = os.path.join(tempdir, 'metrics.json')
+    argv = ['ums.py', '--quiet', '--datasource', jsondata, '--flatten',
+            '--googlecsv', os.path.join(tempdir, 'out'), '--profile',
+            '--metrics-out', metrics_path]
+    try:
+        with mock.patch.object(sys, 'argv', argv):
+            ums.main()
+        with open(metrics_path) as fp:
+            metrics = json.load(fp)
+        assert set(metrics['timings']) == {
+            'total', 'parse', 'events', 'calendars', 'flatten', 'export',
+            'write.CSVWriter'
+        }
+        assert metrics['counters'] == {'events': 6, 'cache.hit': 1}
+        assert 'export' in capsys.readouterr().err
+
+        ums.METRICS.reset()
+        calendars = ums.DataSource(jsondata).calendars().values()
+        ums.asyncio.run(ums.export_async(calendars, [
+            ums.StdoutWriter(), ums.IcalWriter(os.path.join(tempdir, 'ical'),
+                                               serializer='object'),
+        ]))
+        assert {'write.StdoutWriter', 'write.IcalWriter'} <= \
+            set(ums.METRICS.timings)
+        capsys.readouterr()
+
+        ums.METRICS.reset()
+        argv = ['ums.py', '--quiet', '--datasource', jsondata, '--gcal',
+                '--profile']
+        with mock.patch.object(sys, 'argv', argv), \
+                mock.patch.object(ums.GoogleCalendarWriter,
+                                  'get_credentials'), \
+                mock.patch.object(ums.GoogleCalendarWriter, 'build_service',
+                                  return_value=FakeCalendarService()):
+            ums.main()
+        assert ums.METRICS.timings['google.startup'][0] == 1
+        assert ums.METRICS.timings['google.batch'][0] >= 1
+        assert 'google.startup' in capsys.readouterr().err
+
+        ums.METRICS.reset()
+        ums.DataSource(url=stub_server, window_days=2).pull()
+        assert ums.METRICS.counters['http.requests'] == 3
+        assert ums.METRICS.counters['http.bytes'] > 0
+        assert ums.METRICS.timings['pull'][0] == 1
+        assert ums.METRICS.counters['cache.miss'] == 1
+    finally:
+        ums.METRICS.enabled = False
+        ums.METRICS.reset()
+
+
+def fetch(url, headers=None):
+    request = urllib.request.Request(url, headers=headers or {})
+    try:
+        with urllib.request.urlopen(request) as resp:
+            return resp.status, resp.headers, resp.read()
+    except urllib.error.HTTPError as exc:
+        return exc.code, exc.headers, b''
+
+
+def test_feed_server(jsondata):
+    sources = []
+
+    def source():
+        sources.append(ums.DataSource(jsondata))
+        return sources[-1]
+
+    feeds = ums.FeedServer(source, check_interval=0, workers=2)
+    server = feeds.make_server('127.0.0.1', 0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    try:
+        status, _, body = fetch(base + '/')
+        paths = body.decode('utf-8').splitlines()
+        assert status == 200
+        assert len(paths) == 6
+        venue1 = base + '/ums%20-%20venue1.ical'
+        assert venue1[len(base):] in paths
+
+        status, headers, body = fetch(venue1)
+        assert status == 200
+        assert headers['Content-Type'] == 'text/calendar; charset=utf-8'
+        assert body.count(b'BEGIN:VEVENT') == 3
+        etag = headers['ETag']
+
+        status, headers, zipped = fetch(venue1, {'Accept-Encoding': 'gzip'})
+        assert headers['Content-Encoding'] == 'gzip'
+        assert gzip.decompress(zipped) == body
+        status, _, _ = fetch(venue1, {'If-None-Match': etag})
+        assert status == 304
+        assert feeds.reloads == 1
+        assert fetch(base + '/nothing.ical')[0] == 404
+
+        # only venue2 changes, so venue1 keeps its rendered body
+        rendered = feeds._rendered[unquote_path(venue1, base)]
+        venue2 = base + '/ums%20-%20venue2.csv'
+        old_etag = fetch(venue2)[1]['ETag']
+        with open(jsondata, 'wb') as fp:
+            fp.write(TEST_DATA.replace(b'artist6', b'newartist'))
+        status, headers, body = fetch(venue2, {'If-None-Match': old_etag})
+        assert status == 200
+        assert b'newartist' in body
+        assert feeds.reloads == 2
+        assert feeds._rendered[unquote_path(venue1, base)] is rendered
+        assert fetch(venue1, {'If-None-Match': etag})[0] == 304
+        # the file hasn't changed, so it wasn't read again
+        assert sources[-1].cache is None and sources[-1].header is None
+
+        # more subscribers at once than there are workers
+        with ums.ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(pool.map(lambda _: fetch(venue1)[0], range(16)))
+        assert results == [200] * 16
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def unquote_path(url, base):
+    return urllib.parse.unquote(url[len(base):])
+
+
+class RecordingWriter(ums.Writer):
+    def __init__(self, fail=0):
+        self.written = []
+        self.fail = fail
+
+    def write(self, calendars, *, flatten=False):
+        if self.fail:
+            self.fail -= 1
+            raise RuntimeError('broken')
+        self.written.append([c.name for c in calendars])
+
+
+def test_watcher(jsondata, tempdir):
+    output = os.path.join(tempdir, 'out')
+    state = os.path.join(tempdir, 'state.json')
+    recorder = RecordingWriter()
+    flaky = RecordingWriter(fail=1)
+    csv_writer = ums.CSVWriter(output)
+    watcher = ums.Watcher(lambda: ums.DataSource(jsondata),
+                          [recorder, flaky, csv_writer], state_path=state)
+    with pytest.raises(RuntimeError):
+        watcher.poll()
+    assert recorder.written == [['UMS - venue1', 'UMS - venue2']]
+    assert flaky.written == []
+    assert len(os.listdir(output)) == 2
+
+    # only the writer that failed goes again
+    assert watcher.poll() == {
+        'RecordingWriter-2': ['UMS - venue1', 'UMS - venue2']
+    }
+    assert watcher.poll() == {}
+    with open(jsondata, 'wb') as fp:
+        fp.write(TEST_DATA.replace(b'artist6', b'newartist'))
+    written = watcher.poll()
+    assert written == {'RecordingWriter': ['UMS - venue2'],
+                       'RecordingWriter-2': ['UMS - venue2'],
+                       'CSVWriter': ['UMS - venue2']}
+    assert recorder.written[-1] == flaky.written[-1] == ['UMS - venue2']
+
+    # a restart picks up where it left off
+    restarted = ums.Watcher(lambda: ums.DataSource(jsondata),
+                            [RecordingWriter()], state_path=state)
+    assert restarted.poll() == {}
+    flat = ums.Watcher(lambda: ums.DataSource(jsondata), [RecordingWriter()],
+                       flatten=True)
+    assert flat.poll() == {'RecordingWriter': ['UMS - venue1', 'UMS - venue2']}
+
+
+def test_watcher_owned(jsondata, tempdir):
+    output = os.path.join(tempdir, 'out')
+    state = os.path.join(tempdir, 'state.json')
+    data = json.loads(TEST_DATA.decode('ascii'))
+
+    def save(records):
+        with open(jsondata, 'w') as fp:
+            json.dump(dict(data, data=records), fp)
+
+    def watcher():
+        return ums.Watcher(lambda: ums.DataSource(jsondata),
+                           [ums.CSVWriter(output)], state_path=state)
+
+    watcher().poll()
+    # a new venue whose file was already there, from someone else
+    venue3 = os.path.join(output, 'ums - venue3.csv')
+    with open(venue3, 'w') as fp:
+        fp.write('not ours')
+    records = data['data'] + [dict(data['data'][0], venue_name='venue3')]
+    records[5] = dict(records[5], venue_artist='newartist')
+    save(records)
+    with mock.patch('ums.wait_for_response') as mock_wait:
+        mock_wait.return_value = False
+        assert watcher().poll() == {
+            'CSVWriter': ['UMS - venue2', 'UMS - venue3']
+        }
+    # only asked about the file it didn't write
+    assert mock_wait.call_count == 1
+    assert 'venue3' in mock_wait.call_args[0][0]
+    with open(venue3) as fp:
+        assert fp.read() == 'not ours'
+
+    # venues that go away are taken down, unless they weren't ours
+    save([r for r in records if r['venue_name'] == 'venue2'])
+    assert watcher().poll() == {'CSVWriter': []}
+    assert sorted(os.listdir(output)) == ['ums - venue2.csv',
+                                          'ums - venue3.csv']
+    with open(state) as fp:
+        assert list(json.load(fp)['published']['CSVWriter']) == \
+            ['UMS - venue2']
+
+    save(data['data'])
+    api = FakeCalendarService()
+    api.calendars().insert(body={'summary': 'UMS - venue1'}).execute()
+    watcher = ums.Watcher(lambda: ums.DataSource(jsondata),
+                          [ums.GoogleCalendarWriter(None, service=api)])
+    with mock.patch('ums.wait_for_response') as mock_wait:
+        mock_wait.return_value = False
+        watcher.poll()
+    save([r for r in data['data'] if r['venue_name'] == 'venue1'])
+    watcher.poll()
+    # venue2 was ours to take down, venue1 never was
+    assert sorted(c['summary'] for c in api.remote_calendars.values()) == \
+        ['UMS - venue1']
+    assert api.live_events('UMS - venue1') == {}
+
+
+def test_watcher_backoff():
+    def source():
+        raise ums.requests.ConnectionError('down')
+
+    sleeps = []
+    watcher = ums.Watcher(source, [], interval=10, jitter=0.1,
+                          max_backoff=50, sleep=sleeps.append)
+    watcher.run(polls=5)
+    assert watcher.failures == 5
+    assert len(sleeps) == 4
+    for delay, expected in zip(sleeps, [20, 40, 50, 50]):
+        assert expected * 0.9 <= delay <= expected * 1.1
+
+
+@pytest.mark.parametrize('writer_cls', [ums.IcalWriter, ums.CSVWriter])
+def test_render_manifest(jsondata, tempdir, writer_cls):
+    output = os.path.join(tempdir, 'out')
+    manifest = os.path.join(tempdir, 'manifest.json')
+
+    def write(flatten=False):
+        writer = writer_cls(output, silently_destroy_data=True,
+                            manifest_path=manifest)
+        calendars = ums.DataSource(jsondata).calendars()
+        if flatten:
+            writer.to_file(writer.flatten(calendars.values()),
+                           path=os.path.join(tempdir, 'flat'))
+        else:
+            writer.write(calendars.values())
+        return +writer.stats
+
+    assert write() == {'written': 2}
+    mtimes = {f: os.stat(os.path.join(output, f)).st_mtime_ns
+              for f in os.listdir(output)}
+    assert write() == {'skipped': 2}
+    assert {f: os.stat(os.path.join(output, f)).st_mtime_ns
+            for f in os.listdir(output)} == mtimes
+
+    with open(jsondata, 'wb') as fp:
+        fp.write(TEST_DATA.replace(b'artist6', b'newartist'))
+    assert write() == {'written': 1, 'skipped': 1}
+    os.remove(os.path.join(output, sorted(mtimes)[0]))
+    assert write() == {'written': 1, 'skipped': 1}
+    assert sorted(os.listdir(output)) == sorted(mtimes)
+
+    assert write(flatten=True) == {'written': 1}
+    assert write(flatten=True) == {'skipped': 1}
+
+    # export() saves the manifest once, not once per calendar
+    writer = writer_cls(os.path.join(tempdir, 'exported'),
+                        manifest_path=manifest)
+    with mock.patch.object(writer, 'save_manifest',
+                           wraps=writer.save_manifest) as save:
+        ums.export(ums.DataSource(jsondata).calendars().values(), [writer])
+    assert save.call_count == 1 and writer.stats == {'written': 2}
+
+
+def test_render_manifest_shared(jsondata, tempdir):
+    manifest = os.path.join(tempdir, 'manifest.json')
+    argv = ['ums.py', '--quiet', '--datasource', jsondata,
+            '--silently-destroy-data', '--render-manifest', manifest,
+            '--googlecsv', os.path.join(tempdir, 'csv'),
+            '--ical', os.path.join(tempdir, 'ical')]
+
+    def mtimes():
+        return {(d, f): os.stat(os.path.join(tempdir, d, f)).st_mtime_ns
+                for d in ('csv', 'ical')
+                for f in os.listdir(os.path.join(tempdir, d))}
+
+    with mock.patch.object(sys, 'argv', argv):
+        ums.main()
+    with open(manifest) as fp:
+        assert len(json.load(fp)) == 4
+    written = mtimes()
+    assert len(written) == 4
+    with mock.patch.object(sys, 'argv', argv):
+        ums.main()
+    assert mtimes() == written
+
+
+def test_flatten_merge(calendars):
+    flat = ums.Writer.flatten(calendars.values())
+    expected = sorted(itertools.chain(*calendars.values()),
+                      key=lambda e: e.start)
+    assert len(flat) == 6
+    assert [e.key for e in flat] == [e.key for e in expected]
+    # iterable again, without having copied anything
+    assert [e.key for e in flat] == [e.key for e in expected]
+    assert all(source is cal for source, cal in
+               zip(flat.sources, calendars.values()))
+
+    shuffled = [ums.Calendar(c.name, items=reversed(c))
+                for c in calendars.values()]
+    assert [e.key for e in ums.Writer.flatten(shuffled)] == \
+           [e.key for e in expected]
+    with mock.patch.object(ums.Writer, 'SPILL_SIZE', 2):
+        # calendars in memory are sorted there, only iterators are spilled
+        assert not any(isinstance(source, ums.SpilledEvents) for source in
+                       ums.Writer.flatten(shuffled).sources)
+        spilled = ums.Writer.flatten(iter(c) for c in shuffled)
+        assert isinstance(spilled.sources[0], ums.SpilledEvents)
+        assert len(spilled.sources[0].runs) == 2
+        assert [e.key for e in spilled] == [e.key for e in expected]
+        assert spilled.digest() == flat.digest()
+
+    files = [fp for fp, _ in spilled.sources[0].runs]
+    with spilled.sources[0]:
+        pass
+    assert all(fp.closed for fp in files) and spilled.sources[0].runs == []
+    files = [fp for fp, _ in spilled.sources[1].runs]
+    del spilled
+    assert all(fp.closed for fp in files)
+
+
+@pytest.mark.parametrize('flatten', [False, True])
+def test_export_single_pass(calendars, tempdir, capsys, flatten):
+    def make_writers(name):
+        api = FakeCalendarService()
+        return api, [
+            ums.StdoutWriter(),
+            ums.GoogleCalendarWriter(None, service=api, sync=True),
+            ums.CSVWriter(os.path.join(tempdir, name, 'out.csv' if flatten else 'csv')),
+            ums.IcalWriter(os.path.join(tempdir, name, 'out.ical' if flatten else 'ical')),
+        ]
+
+    os.makedirs(os.path.join(tempdir, 'separate'))
+    separate_api, writers = make_writers('separate')
+    for writer in writers:
+        writer.write(calendars.values(), flatten=flatten)
+    separate_out = capsys.readouterr().out
+
+    os.makedirs(os.path.join(tempdir, 'fused'))
+    fused_api, writers = make_writers('fused')
+    description = ums.Event.description
+    calls = collections.Counter()
+
+    def counting(event):
+        calls[event.key] += 1
+        return description.fget(event)
+
+    with mock.patch.object(ums.Event, 'description', property(counting)):
+        ums.export(calendars.values(), writers, flatten=flatten)
+    # the same lines, with google's progress now between the calendars
+    def lines(out):
+        return sorted(l for l in out.splitlines()
+                      if not l.startswith('Google Calendar:'))
+
+    assert lines(capsys.readouterr().out) == lines(separate_out)
+    # shared by the iCal and google outputs, but only worked out once
+    assert len(calls) == 6 and set(calls.values()) == {1}
+
+    assert fused_api.remote_events == separate_api.remote_events
+    for name in ('out.csv', 'out.ical') if flatten else ('csv', 'ical'):
+        separate = os.path.join(tempdir, 'separate', name)
+        fused = os.path.join(tempdir, 'fused', name)
+        if flatten:
+            pairs = [(separate, fused)]
+        else:
+            assert sorted(os.listdir(separate)) == sorted(os.listdir(fused))
+            pairs = [(os.path.join(separate, f), os.path.join(fused, f))
+                     for f in os.listdir(separate)]
+        for left, right in pairs:
+            with open(left, 'rb') as lfp, open(right, 'rb') as rfp:
+                assert lfp.read() == rfp.read()
+
+
+def test_pull_async(stub_server):
+    ds = ums.DataSource(url=stub_server, window_days=1, workers=5)
+    expected = ds.pull()
+    ds = ums.DataSource(url=stub_server, window_days=1, workers=5)
+    started = time.monotonic()
+    data = ums.asyncio.run(ds.pull_async(queue_size=1))
+    assert time.monotonic() - started < 1.2
+    assert data == expected
+    assert [e.key for e in ds.events()] == \
+           [e.key for e in ums.EventStore.from_records(expected)]
+
+    StubFeedHandler.failures['2016-07-29'] = 5
+    ds = ums.DataSource(url=stub_server, window_days=1, retries=0)
+    with pytest.raises(ums.requests.HTTPError):
+        ums.asyncio.run(ds.pull_async())
+
+
+def test_export_async_failure(calendars, tempdir):
+    class BrokenSink(ums.Sink):
+        def begin(self, calendar):
+            return True
+
+        def add(self, event):
+            raise RuntimeError('disk full')
+
+    class BrokenWriter(ums.Writer):
+        def write(self, calendars, *, flatten=False):
+            pass
+
+        def sink(self, *, flatten=False):
+            return BrokenSink()
+
+    output = os.path.join(tempdir, 'ical')
+    writers = [ums.IcalWriter(output), BrokenWriter()]
+    with pytest.raises(RuntimeError, match='disk full'):
+        ums.asyncio.run(ums.asyncio.wait_for(
+            ums.export_async(calendars.values(), writers, queue_size=1), 5
+        ))
+    assert not [f for f in os.listdir(output) if f.endswith('.tmp')]
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'jobs': 2}, {'serializer': 'object'}])
+def test_export_async_prompts_first(calendars, tempdir, kwargs):
+    api = FakeCalendarService()
+    api.calendars().insert(body={'summary': 'UMS - venue1'}).execute()
+    output = os.path.join(tempdir, 'ical')
+    os.makedirs(output)
+    with open(os.path.join(output, 'ums - venue2.ical'), 'w'):
+        pass
+    writers = [ums.IcalWriter(output, **kwargs),
+               ums.GoogleCalendarWriter(None, service=api)]
+    assert (writers[0].sink() is None) == bool(kwargs)
+    asked = []
+
+    def answer(question):
+        # nothing has been written to either output yet
+        assert api.calls['events.insert'] == 0
+        assert os.listdir(output) == ['ums - venue2.ical']
+        assert threading.current_thread() is threading.main_thread()
+        asked.append(question)
+        return 'google' in question
+
+    with mock.patch('ums.wait_for_response', side_effect=answer):
+        ums.asyncio.run(ums.export_async(calendars.values(), writers))
+    assert len(asked) == 2
+    assert 'google calendar "UMS - venue1"' in asked[1]
+    assert len(api.live_events('UMS - venue1')) == 3
+    assert os.path.getsize(os.path.join(output, 'ums - venue2.ical')) == 0
+    assert sorted(os.listdir(output)) == ['ums - venue1.ical', 'ums - venue2.ical']
+
+
+def test_async_main(stub_server, tempdir):
+    outputs = {}
+    for mode in ('sync', 'async'):
+        output = os.path.join(tempdir, mode)
+        argv = ['ums.py', '--quiet', '--url', stub_server,
+                '--datasource', os.path.join(tempdir, mode + '.json'),
+                '--window-days', '2', '--googlecsv', output + '-csv',
+                '--ical', output + '-ical']
+        if mode == 'async':
+            argv.append('--async')
+        with mock.patch.object(sys, 'argv', argv):
+            ums.main()
+        outputs[mode] = {}
+        for kind in ('csv', 'ical'):
+            directory = '{}-{}'.format(output, kind)
+            for name in os.listdir(directory):
+                with open(os.path.join(directory, name), 'rb') as fp:
+                    outputs[mode][kind, name] = fp.read()
+        with open(os.path.join(tempdir, mode + '.json')) as fp:
+            outputs[mode]['datasource'] = json.load(fp)['data']
+    assert len(outputs['async']) == 5
+    assert outputs['async'] == outputs['sync']
+
+
+def test_async_sqlite_main(stub_server, tempdir):
+    output = os.path.join(tempdir, 'csv')
+    argv = ['ums.py', '--quiet', '--url', stub_server, '--backend', 'sqlite',
+            '--datasource', os.path.join(tempdir, 'events.db'),
+            '--window-days', '2', '--googlecsv', output, '--async',
+            '--silently-destroy-data']
+    for _ in range(2):
+        # a pull the first time, and a cache hit the second
+        with mock.patch.object(sys, 'argv', argv):
+            ums.main()
+        assert sorted(os.listdir(output)) == \
+            ['ums - venue1.csv', 'ums - venue2.csv']
+
+
+def random_store(count, venues, seed):
+    rng = ums.random.Random(seed)
+    first = ums.datetime(2016, 7, 28, 18, 0)
+    records = []
+    for i in range(count):
+        start = first + ums.timedelta(minutes=5 * rng.randrange(48))
+        end = start + ums.timedelta(minutes=5 * rng.randrange(1, 16))
+        records.append({
+            'start': start.strftime(ums.Event.DATEFMT),
+            'end': end.strftime(ums.Event.DATEFMT),
+            'venue_artist': 'artist{}'.format(i),
+            'url': '', 'venue_name': 'venue{}'.format(i % venues),
+            'venue_url': '', 'description': '',
+        })
+    return ums.EventStore.from_records(records)
+
+
+def test_overlaps(calendars):
+    events = itertools.chain.from_iterable(calendars.values())
+    assert [(a.artist, b.artist) for a, b in ums.overlaps(events)] == [
+        ('artist1', 'artist4'), ('artist2', 'artist5'),
+        ('artist3', 'artist6'),
+    ]
+
+    store = random_store(60, 4, seed=1)
+    expected = {
+        frozenset((a.index, b.index)) for a, b in
+        itertools.combinations(store, 2)
+        if a.venue != b.venue and a.start_ts < b.end_ts and
+        b.start_ts < a.end_ts
+    }
+    found = [frozenset((a.index, b.index)) for a, b in ums.overlaps(store)]
+    assert len(found) == len(expected) and set(found) == expected
+
+
+def test_plan_itinerary(calendars):
+    events = list(itertools.chain.from_iterable(calendars.values()))
+    weights = {'artist1': 1, 'artist4': 3, 'artist2': 2, 'artist6': 1}
+    plan = ums.plan_itinerary(events, weights)
+    assert plan.name == 'UMS - Itinerary'
+    assert [e.artist for e in plan] == ['artist4', 'artist2', 'artist6']
+    # 20 minutes between sets isn't enough to change venue
+    plan = ums.plan_itinerary(events, weights, travel=30 * 60)
+    assert [e.artist for e in plan] == ['artist4', 'artist6']
+    assert [e.artist for e in ums.plan_itinerary(events, {})] == []
+
+    def compatible(a, b, travel):
+        a, b = sorted((a, b), key=lambda e: e.end_ts)
+        gap = travel if a.venue != b.venue else 0
+        return a.end_ts + gap <= b.start_ts
+
+    for seed in range(5):
+        store = list(random_store(12, 3, seed))
+        weights = {e.artist: (e.index * 7) % 5 + 1 for e in store}
+        for travel in (0, 600):
+            best = 0
+            for size in range(1, len(store) + 1):
+                for chosen in itertools.combinations(store, size):
+                    if all(compatible(a, b, travel) for a, b in
+                           itertools.combinations(chosen, 2)):
+                        best = max(best, sum(weights[e.artist]
+                                             for e in chosen))
+            plan = ums.plan_itinerary(store, weights, travel=travel)
+            assert sum(weights[e.artist] for e in plan) == best
+            assert all(compatible(a, b, travel) for a, b in zip(plan, plan[1:]))
+
+
+def test_analysis_main(jsondata, tempdir, capsys):
+    favourites = os.path.join(tempdir, 'favourites.txt')
+    with open(favourites, 'w') as fp:
+        fp.write('# favourites\nArtist1\nartist4, 3\nartist2,2\n\nartist6\n'
+                 '311\n, 5\nBand, The\n')
+    assert ums.load_favourites(favourites) == {
+        'artist1': 1, 'artist4': 3, 'artist2': 2, 'artist6': 1,
+        '311': 1, ', 5': 1, 'band, the': 1,
+    }
+
+    argv = ['ums.py', '--datasource', jsondata, '--conflicts',
+            '--favourites', favourites]
+    with mock.patch.object(sys, 'argv', argv):
+        ums.main()
+    out = capsys.readouterr().out
+    assert out.startswith('1 conflicts:\n')
+    assert 'artist1 @ venue1' in out and 'artist4 @ venue2' in out
+    assert os.listdir(tempdir) == ['favourites.txt']
+
+    argv = ['ums.py', '--datasource', jsondata, '--itinerary', '--quiet',
+            '--favourites', favourites, '--travel', '30',
+            '--ical', os.path.join(tempdir, 'ical')]
+    with mock.patch.object(sys, 'argv', argv):
+        ums.main()
+    assert os.listdir(os.path.join(tempdir, 'ical')) == \
+        ['ums - itinerary.ical']
+    with open(os.path.join(tempdir, 'ical', 'ums - itinerary.ical'), 'rb') as fp:
+        cal = icalendar.Calendar.from_ical(fp.read())
+    assert [str(e['summary']) for e in cal.walk('vevent')] == \
+        ['artist4', 'artist6']
+
+
+@pytest.mark.parametrize('flag', ['--conflicts', '--itinerary'])
+@pytest.mark.parametrize('mode', [['--now'], ['--serve', '8080'],
+                                  ['--watch', '60'], ['--async']])
+def test_analysis_modes_rejected(flag, mode, capsys):
+    with pytest.raises(SystemExit):
+        ums.parse_args([flag] + mode)
+    assert '{} can not be used with {}'.format(flag, mode[0]) in \
+        capsys.readouterr().err
@@ -4,27 +4,223 @@ Converts the UMS calendar data to either direct google calendar imports,
 google-calendar valid CSV files, and google-calendar valid iCal files.
 """
 import argparse
+import asyncio
+import bisect
 import csv
+import functools
+import gzip
+import hashlib
+import heapq
+import importlib
+import io
+import itertools
 import json
+import mmap
 import os
+import pickle
+import random
+import sqlite3
+import struct
 import sys
+import tempfile
+import threading
+import time
+import weakref
 
 from abc import ABCMeta, abstractmethod
-from datetime import datetime, date
-from typing import List, Dict, Iterable, Any, Tuple, Optional
+from array import array
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, date, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import (List, Dict, Iterable, Any, Tuple, Optional, Sequence, Set,
+                    Callable)
+from urllib.parse import quote, unquote
 
-import icalendar
-import requests
+
+
+class _LazyModule:
+    """Stands in for a module, importing it the first time it is used.
+
+    The third party libraries are slow to import, and most runs only need a
+    few of them, if any.
+    """
+    def __init__(self, name: str) -> None:
+        object.__setattr__(self, '_name', name)
+        object.__setattr__(self, '_module', None)
+
+    def _load(self):
+        if self._module is None:
+            object.__setattr__(self, '_module',
+                               importlib.import_module(self._name))
+        return self._module
+
+    def __getattr__(self, attr: str):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr: str, value):
+        setattr(self._load(), attr, value)
+
+    def __delattr__(self, attr: str):
+        delattr(self._load(), attr)
+
+    def __repr__(self) -> str:
+        return '<lazy module {!r}>'.format(self._name)
+
+
+icalendar = _LazyModule('icalendar')
+requests = _LazyModule('requests')
 
 # these all come in with the google stuff
-import pytz
-import httplib2
-from apiclient import discovery
-import oauth2client
-from oauth2client import client
-from oauth2client import tools
+httplib2 = _LazyModule('httplib2')
+discovery = _LazyModule('apiclient.discovery')
+client = _LazyModule('oauth2client.client')
+tools = _LazyModule('oauth2client.tools')
+oauth2_file = _LazyModule('oauth2client.file')
+
+
+class _Timer:
+    __slots__ = ('metrics', 'stage', 'started')
+
+    def __init__(self, metrics: 'Metrics', stage: str) -> None:
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.metrics.add_time(self.stage, time.perf_counter() - self.started)
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Metrics:
+    """Timers and counters for the stages of a run.
+
+    Disabled by default, in which case timer() hands back a shared timer that
+    does nothing and count() returns straight away, so the calls can stay in
+    the hot paths. Timers are inclusive of anything timed inside them.
+    """
+    def __init__(self) -> None:
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        self.timings = OrderedDict()  # type: OrderedDict
+        self.counters = Counter()  # type: Counter
+
+    def timer(self, stage: str):
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, stage)
+
+    def add_time(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            calls, total = self.timings.get(stage, (0, 0.0))
+            self.timings[stage] = (calls + 1, total + seconds)
+
+    def count(self, name: str, value: int=1) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] += value
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'timings': {
+                stage: {'calls': calls, 'seconds': seconds}
+                for stage, (calls, seconds) in self.timings.items()
+            },
+            'counters': dict(sorted(self.counters.items())),
+        }
+
+    def report(self) -> str:
+        lines = ['{:<24}{:>8}{:>12}'.format('stage', 'calls', 'seconds')]
+        for stage, (calls, seconds) in self.timings.items():
+            lines.append('{:<24}{:>8}{:>12.3f}'.format(stage, calls, seconds))
+        if self.counters:
+            lines.append('')
+            lines.append('{:<24}{:>20}'.format('counter', 'value'))
+            for name, value in sorted(self.counters.items()):
+                lines.append('{:<24}{:>20}'.format(name, value))
+        return '\n'.join(lines)
+
+    def write(self, path: str) -> None:
+        with open(path, 'w') as fp:
+            json.dump(self.as_dict(), fp, indent=4)
+
+
+METRICS = Metrics()
+
+
+def _load_json(path: Optional[str]) -> Any:
+    """The JSON stored at path, or {} if there is no path, or nothing
+    readable at it."""
+    if not path:
+        return {}
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except (ValueError, EnvironmentError):
+        return {}
+
+
+# read once, while nothing else can be creating files.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def _temp_path(path: str) -> str:
+    """A new, empty temporary file next to path, for writing something that
+    will be renamed over it."""
+    fd, tmppath = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)),
+        prefix=os.path.basename(path) + '.', suffix='.tmp'
+    )
+    os.close(fd)
+    # mkstemp files are private; give it the mode open() would have.
+    os.chmod(tmppath, 0o666 & ~_UMASK)
+    return tmppath
+
+
+def _replace_file(path: str, write: Callable[[Any], None], *, mode='w'):
+    """Call write() with a temporary file next to path, then rename it over
+    path, so readers only ever see the old file or the new one. The
+    temporary file is removed if anything goes wrong.
+    """
+    fp = tempfile.NamedTemporaryFile(
+        mode, dir=os.path.dirname(os.path.abspath(path)),
+        prefix=os.path.basename(path) + '.', suffix='.tmp', delete=False
+    )
+    try:
+        with fp:
+            os.chmod(fp.name, 0o666 & ~_UMASK)
+            write(fp)
+        os.replace(fp.name, path)
+    except BaseException:
+        try:
+            os.remove(fp.name)
+        except FileNotFoundError:
+            pass
+        raise
 
 
+def _dump_json_atomically(path: str, obj: Any):
+    _replace_file(path, functools.partial(json.dump, obj))
+
 
 def wait_for_response(question: str) -> bool: #  pragma: nocover
     while True:
@@ -35,38 +231,329 @@ def wait_for_response(question: str) -> bool: #  pragma: nocover
             return False
 
 
+EPOCH = datetime(1970, 1, 1)
+_EPOCH_ORDINAL = EPOCH.toordinal()
+
+
+def parse_timestamps(values: Iterable[str],
+                     days: Dict[str, int]=None) -> array:
+    """Parse UMS timestamps into an array of integer epoch seconds.
+
+    The feed only ever uses one format, so rather than calling strptime for
+    every field, each distinct date is converted once and the time of day is
+    sliced out directly. Anything unexpected goes through strptime.
+    """
+    if days is None:
+        days = {}
+    parsed = array('q')
+    for value in values:
+        if len(value) == 24 and value[19:] == '+0000' and value[10] == 'T':
+            day = days.get(value[:10])
+            if day is None:
+                day = (date(int(value[0:4]), int(value[5:7]),
+                            int(value[8:10])).toordinal() - _EPOCH_ORDINAL)
+                day = days[value[:10]] = day * 86400
+            parsed.append(day + int(value[11:13]) * 3600 +
+                          int(value[14:16]) * 60 + int(value[17:19]))
+        else:
+            when = datetime.strptime(value, Event.DATEFMT)
+            parsed.append(int((when - EPOCH).total_seconds()))
+    return parsed
+
+
+class EventStore:
+    """Columnar storage for a set of events.
+
+    Start and end times are kept as arrays of epoch seconds, and the string
+    fields are dictionary-encoded against a single string table, so repeated
+    venues, addresses and artists are only stored once. Table strings are
+    interned, so stores built from the same feed share them too. Artists are
+    stored stripped.
+    """
+    FIELDS = (
+        ('artist', 'venue_artist'),
+        ('artist_url', 'url'),
+        ('venue', 'venue_name'),
+        ('venue_url', 'venue_url'),
+        ('address', 'description'),
+    )
+
+    def __init__(self) -> None:
+        self.start = array('q')
+        self.end = array('q')
+        self.strings = []  # type: List[str]
+        self.columns = {
+            name: array('I') for name, _ in self.FIELDS
+        }  # type: Dict[str, array]
+        self.partitions = {}  # type: Dict[int, array]
+        self._codes = {}  # type: Dict[str, int]
+        self._days = {}  # type: Dict[str, int]
+
+    def __len__(self) -> int:
+        return len(self.start)
+
+    def __iter__(self):
+        return (Event(store=self, index=i) for i in range(len(self)))
+
+    def __getitem__(self, index: int) -> 'Event':
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('event index out of range')
+        return Event(store=self, index=index)
+
+    def encode(self, value: str) -> int:
+        code = self._codes.get(value)
+        if code is None:
+            value = sys.intern(value)
+            code = self._codes[value] = len(self.strings)
+            self.strings.append(value)
+        return code
+
+    def code_for(self, value: str) -> Optional[int]:
+        return self._codes.get(value)
+
+    def value(self, name: str, index: int) -> str:
+        return self.strings[self.columns[name][index]]
+
+    def _partition(self, first: int) -> None:
+        venues = self.columns['venue']
+        for index in range(first, len(venues)):
+            code = venues[index]
+            partition = self.partitions.get(code)
+            if partition is None:
+                partition = self.partitions[code] = array('I')
+            partition.append(index)
+
+    def append(self, src: Dict[str, str]) -> int:
+        """Add a single record, returning its row index."""
+        self.extend([src])
+        return len(self.start) - 1
+
+    def extend(self, records: Sequence[Dict[str, str]]) -> None:
+        """Add many records, parsing their timestamps in bulk."""
+        first = len(self.start)
+        self.start.extend(
+            parse_timestamps([r['start'] for r in records], self._days)
+        )
+        self.end.extend(
+            parse_timestamps([r['end'] for r in records], self._days)
+        )
+        encode = self.encode
+        for name, key in self.FIELDS:
+            if name == 'artist':
+                values = (r[key].strip() for r in records)
+            else:
+                values = (r[key] for r in records)
+            self.columns[name].extend(encode(value) for value in values)
+        self._partition(first)
+
+    def extend_rows(self, rows: Iterable[Tuple[Any, ...]]) -> None:
+        """Add rows in the compact form Event.row gives."""
+        first = len(self.start)
+        columns = [self.columns[name] for name, _ in self.FIELDS]
+        encode = self.encode
+        for row in rows:
+            self.start.append(row[0])
+            self.end.append(row[1])
+            # artist comes first; rows from a database may not be stripped.
+            columns[0].append(encode(row[2].strip()))
+            for column, value in zip(columns[1:], row[3:]):
+                column.append(encode(value))
+        self._partition(first)
+
+    def extend_stream(self, records: Iterable[Dict[str, str]], *,
+                      batch_size: int=4096) -> None:
+        """Add records from an iterable without ever holding more than
+        batch_size of them at once.
+        """
+        batch = []  # type: List[Dict[str, str]]
+        for record in records:
+            batch.append(record)
+            if len(batch) == batch_size:
+                self.extend(batch)
+                batch = []
+        if batch:
+            self.extend(batch)
+
+    @classmethod
+    def from_records(cls, records: Sequence[Dict[str, str]]) -> 'EventStore':
+        store = cls()
+        store.extend(records)
+        return store
+
+    def sorted_indices(self) -> List[int]:
+        return sorted(range(len(self)), key=self.start.__getitem__)
+
+    def calendars(self, *, venue='all') -> Dict[str, 'Calendar']:
+        """Group the events into one start-sorted Calendar per venue."""
+        if venue == 'all':
+            codes = list(self.partitions)
+        else:
+            code = self.code_for(venue)
+            if code not in self.partitions:
+                return {}
+            codes = [code]
+        key = self.start.__getitem__
+        ordered = [
+            (code, sorted(self.partitions[code], key=key)) for code in codes
+        ]
+        # venues come out in order of their first event, as a global sort
+        # followed by grouping would have produced.
+        ordered.sort(key=lambda item: (key(item[1][0]), item[1][0]))
+        result = {}  # type: Dict[str, Calendar]
+        for code, indices in ordered:
+            name = self.strings[code]
+            result[name] = Calendar(
+                VENUE_FMT.format(name),
+                items=(Event(store=self, index=i) for i in indices)
+            )
+        return result
+
+
+def event_key(src: Dict[str, str]) -> Tuple[str, ...]:
+    """A stable identity for a source record. The end time is left out so
+    that a set running longer is a change to the same event.
+    """
+    return (src['start'], src['venue_name'], src['venue_artist'].strip())
+
+
 class Event:
+    """A lightweight view of a single row in an EventStore."""
     DATEFMT = '%Y-%m-%dT%H:%M:%S+0000'
-    def __init__(self, src: Dict[str, str]) -> None:
-        self.src = src
-        self.end = datetime.strptime(self.src['end'], self.DATEFMT)
-        self.start = datetime.strptime(self.src['start'], self.DATEFMT)
+    __slots__ = ('store', 'index')
+
+    def __init__(self, src: Dict[str, str]=None, *, store: EventStore=None,
+                 index: int=0) -> None:
+        if store is None:
+            if src is None:
+                raise ValueError('Either src or store must be set')
+            store = EventStore()
+            index = store.append(src)
+        self.store = store
+        self.index = index
+
+    @property
+    def src(self) -> Dict[str, str]:
+        src = {key: self.store.value(name, self.index)
+               for name, key in EventStore.FIELDS}
+        src['start'] = self.start.strftime(self.DATEFMT)
+        src['end'] = self.end.strftime(self.DATEFMT)
+        return src
+
+    @property
+    def row(self) -> Tuple[Any, ...]:
+        """The event as a plain tuple: start and end epoch seconds, followed
+        by the EventStore.FIELDS values.
+        """
+        store, index = self.store, self.index
+        return (store.start[index], store.end[index]) + tuple(
+            store.strings[store.columns[name][index]]
+            for name, _ in EventStore.FIELDS
+        )
+
+    @property
+    def key(self) -> Tuple[str, ...]:
+        """The same identity event_key() gives the source record."""
+        return (self.format_start(self.DATEFMT), self.venue, self.artist)
+
+    @property
+    def start_ts(self) -> int:
+        return self.store.start[self.index]
+
+    @property
+    def end_ts(self) -> int:
+        return self.store.end[self.index]
+
+    @property
+    def start(self) -> datetime:
+        return EPOCH + timedelta(seconds=self.store.start[self.index])
+
+    @property
+    def end(self) -> datetime:
+        return EPOCH + timedelta(seconds=self.store.end[self.index])
+
+    def format_start(self, fmt: str) -> str:
+        return self.start.strftime(fmt)
+
+    def format_end(self, fmt: str) -> str:
+        return self.end.strftime(fmt)
+
+    @property
+    def description(self) -> str:
+        return '[{}]({}) @ [{}]({})'.format(
+            self.artist, self.artist_url, self.venue, self.venue_url
+        )
+
+    @property
+    def location(self) -> str:
+        return '{}: {}'.format(self.venue, self.address)
 
     def str_without_venue(self):
-        return '({} - {}): {}'.format(self.start.strftime("%a %I:%M %p"), self.end.strftime("%I:%M %p"), self.artist)
+        return '({} - {}): {}'.format(self.format_start("%a %I:%M %p"), self.format_end("%I:%M %p"), self.artist)
 
     def str_with_venue(self):
         return '{} @ {}'.format(self.str_without_venue(), self.venue)
 
     @property
     def address(self):
-        return self.src['description']
+        return self.store.value('address', self.index)
 
     @property
     def artist(self):
-        return self.src['venue_artist'].strip()
+        return self.store.value('artist', self.index)
 
     @property
     def artist_url(self):
-        return self.src['url']
+        return self.store.value('artist_url', self.index)
 
     @property
     def venue(self):
-        return self.src['venue_name']
+        return self.store.value('venue', self.index)
 
     @property
     def venue_url(self):
-        return self.src['venue_url']
+        return self.store.value('venue_url', self.index)
+
+
+class ProjectedEvent(Event):
+    """An Event that works out each derived field at most once, for when
+    several outputs look at the same event.
+    """
+    __slots__ = ('cache',)
+
+    def __init__(self, event: Event) -> None:
+        super().__init__(store=event.store, index=event.index)
+        self.cache = {}  # type: Dict[Any, Any]
+
+    def _get(self, name: Any, compute):
+        try:
+            return self.cache[name]
+        except KeyError:
+            value = self.cache[name] = compute()
+            return value
+
+    @property
+    def start(self) -> datetime:
+        return self._get('start', lambda: Event.start.fget(self))
+
+    @property
+    def end(self) -> datetime:
+        return self._get('end', lambda: Event.end.fget(self))
+
+    @property
+    def description(self) -> str:
+        return self._get('description', lambda: Event.description.fget(self))
+
+    @property
+    def location(self) -> str:
+        return self._get('location', lambda: Event.location.fget(self))
+
+    def format_start(self, fmt: str) -> str:
+        return self._get(('start', fmt), lambda: Event.format_start(self, fmt))
+
+    def format_end(self, fmt: str) -> str:
+        return self._get(('end', fmt), lambda: Event.format_end(self, fmt))
 
 
 class Calendar(list):
@@ -76,16 +563,541 @@ class Calendar(list):
         self.name = name
         super().__init__(items)
 
+    def digest(self) -> str:
+        """A hash of the events, which changes whenever any of them does."""
+        sha = hashlib.sha1(self.name.encode('utf-8'))
+        for event in self:
+            sha.update(repr(event.row).encode('utf-8'))
+        return sha.hexdigest()
+
+
+def _start_key(event: Event) -> int:
+    return event.start_ts
+
+
+def is_sorted(events: Iterable[Event]) -> bool:
+    previous = None
+    for event in events:
+        start = event.start_ts
+        if previous is not None and start < previous:
+            return False
+        previous = start
+    return True
+
+
+class SpilledEvents:
+    """Events sorted by start without holding them all in memory.
+
+    The events are sorted in runs of run_size, and each run is written out
+    to a temporary file as compact rows. Iterating merges the runs, reading
+    back batch_size rows from each at a time. The files are closed (and so
+    deleted) by close(), on leaving a with block, or when this is garbage
+    collected, whichever comes first.
+    """
+    def __init__(self, events: Iterable[Event], *, run_size: int=1 << 18,
+                 batch_size: int=1024) -> None:
+        self.runs = []  # type: List[Tuple[Any, List[int]]]
+        self.length = 0
+        self._finalizer = weakref.finalize(self, self._close_runs, self.runs)
+        events = iter(events)
+        while True:
+            run = sorted(itertools.islice(events, run_size), key=_start_key)
+            if not run:
+                break
+            fp = tempfile.TemporaryFile()
+            offsets = []
+            for i in range(0, len(run), batch_size):
+                offsets.append(fp.tell())
+                pickle.dump([e.row for e in run[i:i + batch_size]], fp,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            fp.flush()
+            self.runs.append((fp, offsets))
+            self.length += len(run)
+
+    def __len__(self) -> int:
+        return self.length
+
+    @staticmethod
+    def _read_run(fp, offsets: List[int]) -> Iterable[Event]:
+        # seek before every batch, so several iterations can share the file.
+        for offset in offsets:
+            fp.seek(offset)
+            store = EventStore()
+            store.extend_rows(pickle.load(fp))
+            yield from store
+
+    def __iter__(self):
+        return heapq.merge(*(self._read_run(fp, offsets)
+                             for fp, offsets in self.runs), key=_start_key)
+
+    @staticmethod
+    def _close_runs(runs: List[Tuple[Any, List[int]]]):
+        for fp, _ in runs:
+            fp.close()
+        del runs[:]
+
+    def close(self):
+        self._finalizer()
+
+    def __enter__(self) -> 'SpilledEvents':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class FlatCalendar:
+    """Several calendars as one, in start order.
+
+    Nothing is copied: each iteration is a fresh lazy k-way merge over the
+    source calendars, so it only holds one event per source at a time.
+    Sources must already be sorted by start; Writer.flatten() takes care of
+    any that aren't.
+    """
+    def __init__(self, name: str, sources: Sequence[Iterable[Event]]) -> None:
+        self.name = name
+        self.sources = sources
+
+    def __iter__(self):
+        return heapq.merge(*self.sources, key=_start_key)
+
+    def __len__(self) -> int:
+        return sum(len(source) for source in self.sources)
+
+    def __bool__(self) -> bool:
+        return any(len(source) for source in self.sources)
+
+    digest = Calendar.digest
+
+
+def _padded(data: bytes) -> bytes:
+    return data + b'\0' * (-len(data) % 8)
+
+
+class _StringTable:
+    """A read-only string table over an offsets array and a UTF-8 buffer,
+    decoding each string the first time it is used.
+    """
+    def __init__(self, offsets: Sequence[int], data: memoryview) -> None:
+        self.offsets = offsets
+        self.data = data
+        self._decoded = {}  # type: Dict[int, str]
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, code: int) -> str:
+        value = self._decoded.get(code)
+        if value is None:
+            if not 0 <= code < len(self):
+                raise IndexError('string code out of range')
+            start, end = self.offsets[code], self.offsets[code + 1]
+            value = self._decoded[code] = str(self.data[start:end], 'utf-8')
+        return value
+
+    def __iter__(self):
+        return (self[code] for code in range(len(self)))
+
+
+class SnapshotStore(EventStore):
+    """A read-only EventStore backed by a memory-mapped snapshot file.
+
+    The file is a header, followed by the string table, the start and end
+    columns, the string code columns, and an index of where each venue's
+    rows are. Rows are laid out grouped by venue and sorted by start. The
+    header records the size and mtime of the JSON file the snapshot was
+    made from, so a stale snapshot can be spotted without reading the rest.
+    """
+    MAGIC = b'UMSSNAP\0'
+    # 2: artists are stored stripped
+    VERSION = 2
+    # magic, version, little endian, source size, source mtime_ns,
+    # rows, strings, venues
+    HEADER = struct.Struct('<8sIIqqIII')
+
+    def __init__(self, path: str) -> None:
+        with open(path, 'rb') as fp:
+            self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._mmap)
+        (_, _, _, _, _, rows, strings, venues) = self.HEADER.unpack_from(view)
+        self._pos = self.HEADER.size
+
+        offsets = self._section(view, 'Q', strings + 1)
+        data = self._section(view, 'B', offsets[-1])
+        self.strings = _StringTable(offsets, data)  # type: ignore
+        self.start = self._section(view, 'q', rows)  # type: ignore
+        self.end = self._section(view, 'q', rows)  # type: ignore
+        self.columns = {
+            name: self._section(view, 'I', rows) for name, _ in self.FIELDS
+        }
+        codes = self._section(view, 'I', venues)
+        bounds = self._section(view, 'Q', venues + 1)
+        self.partitions = {  # type: ignore
+            codes[i]: range(bounds[i], bounds[i + 1]) for i in range(venues)
+        }
+        self._codes = None  # type: ignore
+
+    def _section(self, view: memoryview, fmt: str, count: int) -> memoryview:
+        size = struct.calcsize(fmt) * count
+        section = view[self._pos:self._pos + size].cast(fmt)
+        self._pos += size + (-size % 8)
+        return section
+
+    def code_for(self, value: str) -> Optional[int]:
+        if self._codes is None:
+            self._codes = {s: code for code, s in enumerate(self.strings)}
+        return self._codes.get(value)
+
+    def encode(self, value: str) -> int:
+        raise TypeError('Snapshots are read-only')
+
+    def extend(self, records: Sequence[Dict[str, str]]) -> None:
+        raise TypeError('Snapshots are read-only')
+
+    def extend_rows(self, rows: Iterable[Tuple[Any, ...]]) -> None:
+        raise TypeError('Snapshots are read-only')
+
+    @classmethod
+    def is_current(cls, path: str, source: os.stat_result) -> bool:
+        """Whether the snapshot at path was made from the file source is
+        the stat of.
+        """
+        try:
+            with open(path, 'rb') as fp:
+                header = fp.read(cls.HEADER.size)
+            magic, version, little, size, mtime_ns, _, _, _ = \
+                cls.HEADER.unpack(header)
+        except (EnvironmentError, struct.error):
+            return False
+        return (magic == cls.MAGIC and version == cls.VERSION and
+                bool(little) == (sys.byteorder == 'little') and
+                size == source.st_size and mtime_ns == source.st_mtime_ns)
+
+    @classmethod
+    def write(cls, store: EventStore, path: str, source: os.stat_result):
+        key = store.start.__getitem__
+        order = []  # type: List[int]
+        codes = array('I')
+        bounds = array('Q', [0])
+        for code, partition in store.partitions.items():
+            order.extend(sorted(partition, key=key))
+            codes.append(code)
+            bounds.append(len(order))
+        encoded = [value.encode('utf-8') for value in store.strings]
+        offsets = array('Q', [0])
+        for value in encoded:
+            offsets.append(offsets[-1] + len(value))
+
+        def write(fp):
+            fp.write(cls.HEADER.pack(
+                cls.MAGIC, cls.VERSION, sys.byteorder == 'little',
+                source.st_size, source.st_mtime_ns,
+                len(order), len(encoded), len(codes)
+            ))
+            fp.write(_padded(offsets.tobytes()))
+            fp.write(_padded(b''.join(encoded)))
+            for column in (store.start, store.end):
+                fp.write(_padded(array('q', (column[i] for i in order)).tobytes()))
+            for name, _ in cls.FIELDS:
+                column = store.columns[name]
+                fp.write(_padded(array('I', (column[i] for i in order)).tobytes()))
+            fp.write(_padded(codes.tobytes()))
+            fp.write(_padded(bounds.tobytes()))
+        _replace_file(path, write, mode='wb')
+
+
+def to_timestamp(when: datetime) -> int:
+    """Convert a naive datetime to the epoch seconds used by EventStore."""
+    return int((when - EPOCH).total_seconds())
+
+
+class EventIndex:
+    """Sorted indexes over an EventStore for time and venue lookups.
+
+    Events are kept sorted by start, both globally and per venue. Since no
+    event lasts longer than the longest one in the store, everything
+    overlapping [start, end) lies between two bisections of the start
+    arrays, so lookups are logarithmic plus the size of the answer.
+    """
+    def __init__(self, store: EventStore) -> None:
+        self.store = store
+        self.order = array('I', store.sorted_indices())
+        self.starts = array('q', (store.start[i] for i in self.order))
+        self.max_duration = max(
+            (e - s for s, e in zip(store.start, store.end)), default=0
+        )
+        key = store.start.__getitem__
+        self.venues = {}  # type: Dict[int, Tuple[array, array]]
+        for code, partition in store.partitions.items():
+            order = array('I', sorted(partition, key=key))
+            self.venues[code] = (array('q', (key(i) for i in order)), order)
+
+    def _codes(self, venues) -> Optional[List[int]]:
+        if venues is None or venues == 'all':
+            return None
+        if isinstance(venues, str):
+            venues = [venues]
+        codes = (self.store.code_for(venue) for venue in venues)
+        return [code for code in codes if code in self.venues]
+
+    def _overlapping(self, starts: array, order: array, start: Optional[int],
+                     end: Optional[int]) -> Iterable[int]:
+        lo = 0
+        if start is not None:
+            lo = bisect.bisect_right(starts, start - self.max_duration)
+        hi = len(starts)
+        if end is not None:
+            hi = bisect.bisect_left(starts, end, lo)
+        ends = self.store.end
+        for position in range(lo, hi):
+            index = order[position]
+            if start is None or ends[index] > start:
+                yield index
+
+    def indices(self, *, venues=None, start: int=None,
+                end: int=None) -> Iterable[int]:
+        """Row indices of the events overlapping [start, end) at the given
+        venues, in start order.
+        """
+        codes = self._codes(venues)
+        if codes is None:
+            return self._overlapping(self.starts, self.order, start, end)
+        key = self.store.start.__getitem__
+        return heapq.merge(*(
+            self._overlapping(*self.venues[code], start, end)
+            for code in codes
+        ), key=key)
+
+    def between(self, start: datetime=None, end: datetime=None, *,
+                venues=None) -> List['Event']:
+        """The events overlapping [start, end), in start order."""
+        return [
+            Event(store=self.store, index=index)
+            for index in self.indices(
+                venues=venues,
+                start=None if start is None else to_timestamp(start),
+                end=None if end is None else to_timestamp(end),
+            )
+        ]
+
+    def now(self, venue: str, when: datetime) -> Optional['Event']:
+        """The event on at venue at the given time, if any."""
+        code = self.store.code_for(venue)
+        if code not in self.venues:
+            return None
+        starts, order = self.venues[code]
+        ts = to_timestamp(when)
+        position = bisect.bisect_right(starts, ts) - 1
+        ends = self.store.end
+        while position >= 0 and starts[position] > ts - self.max_duration:
+            if ends[order[position]] > ts:
+                return Event(store=self.store, index=order[position])
+            position -= 1
+        return None
+
+    def next(self, venue: str, when: datetime) -> Optional['Event']:
+        """The first event at venue starting after the given time."""
+        code = self.store.code_for(venue)
+        if code not in self.venues:
+            return None
+        starts, order = self.venues[code]
+        position = bisect.bisect_right(starts, to_timestamp(when))
+        if position == len(starts):
+            return None
+        return Event(store=self.store, index=order[position])
+
+    def calendars(self, *, venues=None, start: datetime=None,
+                  end: datetime=None) -> Dict[str, 'Calendar']:
+        """Like EventStore.calendars(), but for any number of venues and an
+        optional time range.
+        """
+        result = {}  # type: Dict[str, Calendar]
+        venue_col = self.store.columns['venue']
+        for event in self.between(start, end, venues=venues):
+            name = self.store.strings[venue_col[event.index]]
+            calendar = result.get(name)
+            if calendar is None:
+                calendar = result[name] = Calendar(VENUE_FMT.format(name))
+            calendar.append(event)
+        return result
+
+
+class _JsonStream:
+    """Just enough of an incremental JSON reader to walk a document's
+    top-level object without loading it all.
+    """
+    WHITESPACE = ' \t\n\r'
+    NUMBER_CHARS = '0123456789+-.eE'
+
+    def __init__(self, fp, chunk_size: int) -> None:
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self) -> bool:
+        if self.eof:
+            return False
+        chunk = self.fp.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        while True:
+            while self.pos < len(self.buf):
+                if self.buf[self.pos] not in self.WHITESPACE:
+                    return self.buf[self.pos]
+                self.pos += 1
+            if not self._fill():
+                return ''
+
+    def next_char(self) -> str:
+        char = self.peek()
+        self.pos += len(char)
+        return char
+
+    def expect(self, expected: str) -> None:
+        char = self.next_char()
+        if char != expected:
+            raise ValueError('Expected {!r} at offset {}, got {!r}'.format(
+                expected, self.pos, char
+            ))
+
+    def value(self) -> Any:
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if not self._fill():
+                    raise
+                continue
+            # a number that runs up to the end of the buffer might continue
+            # in the next chunk, even if it stopped decoding short of it
+            # ('1.' decodes as 1).
+            tail = end
+            if isinstance(value, (int, float)):
+                while tail < len(self.buf) and self.buf[tail] in self.NUMBER_CHARS:
+                    tail += 1
+            if tail == len(self.buf) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_records(fp, *, key: str='data', header: Dict[str, Any]=None,
+                 chunk_size: int=1 << 16) -> Iterable[Dict[str, str]]:
+    """Yield the items of the array stored under key in the JSON object
+    read from fp, one at a time.
+
+    Any other top-level values are stored in header, if it is given.
+    """
+    stream = _JsonStream(fp, chunk_size)
+    stream.expect('{')
+    if stream.peek() == '}':
+        return
+    while True:
+        name = stream.value()
+        stream.expect(':')
+        if name == key:
+            stream.expect('[')
+            if stream.peek() == ']':
+                stream.next_char()
+            else:
+                while True:
+                    yield stream.value()
+                    char = stream.next_char()
+                    if char == ']':
+                        break
+                    elif char != ',':
+                        raise ValueError('Malformed array under {!r}'.format(key))
+        else:
+            value = stream.value()
+            if header is not None:
+                header[name] = value
+        char = stream.next_char()
+        if char == '}':
+            return
+        elif char != ',':
+            raise ValueError('Malformed JSON object')
+
+
+def read_header(fp, *, key: str='data') -> Dict[str, Any]:
+    """Read the top-level values that come before key in the JSON object
+    read from fp.
+    """
+    header = {}  # type: Dict[str, Any]
+    for _ in iter_records(fp, key=key, header=header):
+        break
+    return header
+
+
+def window_key(window: Tuple[date, date]) -> str:
+    return '{}/{}'.format(window[0].isoformat(), window[1].isoformat())
+
+
+def write_records(fp, header: Dict[str, Any],
+                  records: Iterable[Dict[str, str]], *, key: str='data'):
+    """Write header and records to fp as a single JSON object, laid out like
+    json.dump(..., indent=4), one record at a time.
+    """
+    fp.write('{')
+    for name, value in header.items():
+        if name == key:
+            continue
+        fp.write('\n    {}: {},'.format(
+            json.dumps(name),
+            json.dumps(value, indent=4).replace('\n', '\n    ')
+        ))
+    fp.write('\n    {}: ['.format(json.dumps(key)))
+    sep = '\n        '
+    for record in records:
+        fp.write(sep)
+        fp.write(json.dumps(record, indent=4).replace('\n', '\n        '))
+        sep = ',\n        '
+    if sep == '\n        ':
+        fp.write(']\n}')
+    else:
+        fp.write('\n    ]\n}')
+
 
 class DataSource:
-    def __init__(self, filepath=None, url=None) -> None:
+    START = date(2016, 7, 27)
+    END = date(2016, 8, 1)
+
+    def __init__(self, filepath=None, url=None, *, streaming=False,
+                 start: date=None, end: date=None, window_days: int=None,
+                 workers: int=4, retries: int=2, backoff: float=1.0,
+                 timeout: float=30.0, max_age: float=None,
+                 snapshot=False) -> None:
         self.filepath = os.path.realpath(filepath) if filepath else None
         self.url = url
+        self.streaming = streaming
+        self.snapshot = snapshot
+        self.start = start or self.START
+        self.end = end or self.END
+        self.window_days = window_days
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.max_age = max_age
+        self.cache_stats = Counter()  # type: Counter
+        self.checked = False
+        self.header = None  # type: Optional[Dict[str, Any]]
+        self._store = None  # type: Optional[EventStore]
+        self._index = None  # type: Optional[EventIndex]
         self._session = None  # type: requests.Session
         self.cache = None  # type: Dict[str, Any]
 
     @property
-    def session(self) -> requests.Session:  # pragma: nocover
+    def session(self) -> 'requests.Session':  # pragma: nocover
         if not self._session:
             self._session = requests.session()
             self._session.headers.update({
@@ -97,317 +1109,2659 @@ class DataSource:
                 'X-Requested-With': 'XMLHTTPRequest',
                 'Connection': 'keep-alive',
             })
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=self.workers
+            )
+            self._session.mount('http://', adapter)
+            self._session.mount('https://', adapter)
         return self._session
 
-    def pull(self) -> List[Dict[str, str]]:
-        if not self.url:
-            raise ValueError('URL not set, cannot pull')
+    def windows(self, start: date=None,
+                end: date=None) -> List[Tuple[date, date]]:
+        """Split [start, end) into windows of window_days days each."""
+        start = start or self.start
+        end = end or self.end
+        if end <= start:
+            raise ValueError('End date must be after start date')
+        if not self.window_days:
+            return [(start, end)]
+        step = timedelta(days=self.window_days)
+        windows = []
+        while start < end:
+            windows.append((start, min(start + step, end)))
+            start += step
+        return windows
+
+    def _fetch_window(self, window: Tuple[date, date],
+                      validator: Dict[str, str]=None
+                      ) -> Tuple[Optional[List[Dict[str, str]]], Dict[str, str]]:
+        """Fetch a single window, returning its data (or None if the server
+        says it has not changed) and its new cache validator.
+        """
         datefmt = '%Y-%m-%d'
-        now = int((datetime.utcnow() - datetime(1970, 1, 1)).total_seconds())
-        start = date(2016, 7, 27)
-        end = date(2016, 8, 1)
-        resp = self.session.get('{url}?start={start}&end={end}&_={now}'.format(
-            url=self.url,
-            start=start.strftime(datefmt),
-            end=end.strftime(datefmt),
-            now=now
-        ))
+        start, end = window
+        headers = {}
+        if validator:
+            if 'etag' in validator:
+                headers['If-None-Match'] = validator['etag']
+            if 'last_modified' in validator:
+                headers['If-Modified-Since'] = validator['last_modified']
+        attempt = 0
+        while True:
+            now = int((datetime.utcnow() - datetime(1970, 1, 1)).total_seconds())
+            url = '{url}?start={start}&end={end}&_={now}'.format(
+                url=self.url,
+                start=start.strftime(datefmt),
+                end=end.strftime(datefmt),
+                now=now
+            )
+            try:
+                METRICS.count('http.requests')
+                resp = self.session.get(url, headers=headers,
+                                        timeout=self.timeout)
+                if resp.status_code == 304:
+                    METRICS.count('http.not_modified')
+                    return None, validator or {}
+                resp.raise_for_status()
+                if METRICS.enabled:
+                    METRICS.count('http.bytes', len(resp.content))
+                new_validator = {}
+                if 'ETag' in resp.headers:
+                    new_validator['etag'] = resp.headers['ETag']
+                if 'Last-Modified' in resp.headers:
+                    new_validator['last_modified'] = resp.headers['Last-Modified']
+                return resp.json(), new_validator
+            except (requests.RequestException, ValueError):
+                if attempt >= self.retries:
+                    raise
+            METRICS.count('http.retries')
+            time.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
+
+    def _fetch(self, windows: List[Tuple[date, date]],
+               validators: Dict[str, Dict[str, str]]):
+        workers = max(1, min(self.workers, len(windows)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(self._fetch_window, window,
+                                validators.get(window_key(window)))
+                for window in windows
+            ]
+            return [f.result() for f in futures]
+
+    def _set_data(self, windows: List[Tuple[date, date]],
+                  chunks: Iterable[List[Dict[str, str]]],
+                  validators: Dict[str, Dict[str, str]]) -> None:
+        data = []  # type: List[Dict[str, str]]
+        seen = set()  # type: Set[Tuple[str, ...]]
+        for chunk in chunks:
+            for record in chunk:
+                key = event_key(record)
+                if key not in seen:
+                    seen.add(key)
+                    data.append(record)
+        self.header = None
+        self._store = None
+        self.checked = True
         self.cache = {
             'retrieved': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S'),
-            'data': resp.json()
+            'validators': {
+                window_key(w): validators[window_key(w)] for w in windows
+                if validators.get(window_key(w))
+            },
+            'data': data
         }
 
-    def writefile(self):
-        if not self.cache or not self.filepath:  # pragma: nocover
-            raise ValueError("Data and filepath must both be set")
-        with open(self.filepath, 'w') as fp:
-            json.dump(self.cache, fp, indent=4)
+    def pull(self, start: date=None, end: date=None) -> List[Dict[str, str]]:
+        """Fetch [start, end) from the url, one request per window, with up to
+        `workers` windows in flight at once.
+        """
+        if not self.url:
+            raise ValueError('URL not set, cannot pull')
+        windows = self.windows(start, end)
+        with METRICS.timer('pull'):
+            results = self._fetch(windows, {})
+        self._cache_stat('miss')
+        self._set_data(
+            windows,
+            (data for data, _ in results),
+            {window_key(w): v for w, (_, v) in zip(windows, results)}
+        )
+        return self.cache['data']
 
-    def readfile(self):
-        if not self.filepath:  # pragma: nocover
-            raise ValueError("Filepath must be set")
-        with open(self.filepath) as fp:
-            self.cache = json.load(fp)
-        return self.cache
+    async def pull_async(self, start: date=None, end: date=None, *,
+                         queue_size: int=4) -> List[Dict[str, str]]:
+        """pull(), with the events store built up as the windows arrive.
 
-    def get(self):
+        Windows are fetched in up to `workers` threads and handed over a
+        queue of queue_size; fetches wait while the queue is full. Windows
+        are added in order however they arrive, so the result is the same
+        as pull()'s.
+        """
+        if not self.url:
+            raise ValueError('URL not set, cannot pull')
+        loop = asyncio.get_running_loop()
+        windows = self.windows(start, end)
+        queue = asyncio.Queue(maxsize=queue_size)  # type: asyncio.Queue
+        executor = ThreadPoolExecutor(
+            max_workers=max(1, min(self.workers, len(windows)))
+        )
+
+        async def fetch(index, window):
+            try:
+                result = await loop.run_in_executor(
+                    executor, self._fetch_window, window, None
+                )
+            except Exception as exc:
+                result = exc
+            await queue.put((index, result))
+
+        fetches = [asyncio.ensure_future(fetch(i, w))
+                   for i, w in enumerate(windows)]
+        store = EventStore()
+        seen = set()  # type: Set[Tuple[str, ...]]
+        data = []  # type: List[Dict[str, str]]
+        validators = {}  # type: Dict[str, Dict[str, str]]
+        arrived = {}  # type: Dict[int, Any]
+        position = 0
         try:
-            self.readfile()
-        except (ValueError, EnvironmentError):
+            for _ in windows:
+                index, result = await queue.get()
+                if isinstance(result, Exception):
+                    raise result
+                arrived[index] = result
+                while position in arrived:
+                    chunk, validator = arrived.pop(position)
+                    validators[window_key(windows[position])] = validator
+                    position += 1
+                    fresh = []
+                    for record in chunk:
+                        key = event_key(record)
+                        if key not in seen:
+                            seen.add(key)
+                            fresh.append(record)
+                    store.extend(fresh)
+                    data.extend(fresh)
+        finally:
+            for future in fetches:
+                future.cancel()
+            executor.shutdown(wait=False)
+        self._cache_stat('miss')
+        self._set_data(windows, [data], validators)
+        self._store = store
+        return self.cache['data']
+
+    def refresh(self) -> bool:
+        """Revalidate the cache against the url.
+
+        Windows the server reports as unchanged keep their cached records.
+        Returns whether anything changed.
+        """
+        if not self.url:
+            raise ValueError('URL not set, cannot refresh')
+        validators = self.metadata.get('validators', {})
+        windows = self.windows()
+        with METRICS.timer('refresh'):
+            results = self._fetch(windows, validators)
+        new_validators = {
+            window_key(w): v for w, (_, v) in zip(windows, results)
+        }
+        if all(data is None for data, _ in results):
+            self._cache_stat('revalidated')
+            self.metadata['retrieved'] = \
+                datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S')
+            self.metadata['validators'] = new_validators
+            self.save_metadata()
+            return False
+
+        self._cache_stat('miss')
+        unchanged = {i for i, (data, _) in enumerate(results) if data is None}
+        kept = {i: [] for i in unchanged}  # type: Dict[int, List[Dict[str, str]]]
+        if unchanged:
+            ends = [w[1].strftime('%Y-%m-%d') for w in windows]
+            for record in self.raw_records():
+                index = min(bisect.bisect_right(ends, record['start'][:10]),
+                            len(windows) - 1)
+                if index in kept:
+                    kept[index].append(record)
+        self._set_data(
+            windows,
+            (kept[i] if data is None else data
+             for i, (data, _) in enumerate(results)),
+            new_validators
+        )
+        self._save()
+        return True
+
+    @property
+    def metadata(self) -> Optional[Dict[str, Any]]:
+        """The top level of the cache file, which may or may not include the
+        data itself.
+        """
+        if self.cache is not None:
+            return self.cache
+        return self.header
+
+    def _cache_stat(self, kind: str) -> None:
+        self.cache_stats[kind] += 1
+        METRICS.count('cache.' + kind)
+
+    def expired(self) -> bool:
+        if self.max_age is None or not self.metadata:
+            return False
+        try:
+            retrieved = datetime.strptime(self.metadata['retrieved'],
+                                          '%Y-%m-%dT%H:%M:%S')
+        except (KeyError, ValueError):
+            return True
+        age = (datetime.utcnow() - retrieved).total_seconds()
+        return age > self.max_age
+
+    @property
+    def metadata_path(self) -> Optional[str]:
+        return self.filepath + '.meta' if self.filepath else None
+
+    def save_metadata(self):
+        """Save just the metadata, after a revalidation left the records as
+        they were.
+
+        Rewriting the whole cache file just for a new retrieved time and
+        validators would cost as much as the download that was avoided, so
+        they go in a small file alongside it instead. That file is only
+        used while the cache file is exactly as it was when it was written.
+        """
+        try:
+            stat = os.stat(self.filepath)
+            _dump_json_atomically(self.metadata_path, {
+                'retrieved': self.metadata['retrieved'],
+                'validators': self.metadata.get('validators', {}),
+                'source': [stat.st_size, stat.st_mtime_ns],
+            })
+        except (TypeError, EnvironmentError):  # pragma: no cover
+            pass
+
+    def _apply_metadata(self, metadata: Dict[str, Any]):
+        """Update metadata read from the cache file with anything newer
+        from save_metadata()."""
+        try:
+            stat = os.stat(self.filepath)
+        except EnvironmentError:
+            return
+        saved = _load_json(self.metadata_path)
+        if saved.get('source') == [stat.st_size, stat.st_mtime_ns]:
+            metadata['retrieved'] = saved['retrieved']
+            metadata['validators'] = saved['validators']
+
+    def writefile(self):
+        with METRICS.timer('save'):
+            self._writefile()
+
+    def _writefile(self):
+        if not self.filepath:  # pragma: nocover
+            raise ValueError("Filepath must be set")
+        if self.cache:
+            with open(self.filepath, 'w') as fp:
+                write_records(fp, self.cache, self.cache['data'])
+        elif self.header is not None:
+            # streaming mode: copy the records over into a new file.
+            _replace_file(self.filepath, lambda fp: write_records(
+                fp, self.header, self.iter_file()
+            ))
+        else:  # pragma: nocover
+            raise ValueError("Data and filepath must both be set")
+        # the file has the latest metadata itself now.
+        try:
+            os.remove(self.metadata_path)
+        except FileNotFoundError:
+            pass
+
+    def _save(self):
+        try:
+            self.writefile()
+        except (ValueError, EnvironmentError):  # pragma: no cover
+            pass
+
+    def readfile(self):
+        if not self.filepath:  # pragma: nocover
+            raise ValueError("Filepath must be set")
+        with open(self.filepath) as fp, METRICS.timer('parse'):
+            self.cache = json.load(fp)
+        self._apply_metadata(self.cache)
+        return self.cache
+
+    def readheader(self):
+        """Read everything in the cache file up to the data itself."""
+        if not self.filepath:  # pragma: nocover
+            raise ValueError("Filepath must be set")
+        with open(self.filepath) as fp:
+            self.header = read_header(fp)
+        self._apply_metadata(self.header)
+        return self.header
+
+    def iter_file(self) -> Iterable[Dict[str, str]]:
+        """Walk the records in the datasource file without loading it."""
+        if not self.filepath:  # pragma: nocover
+            raise ValueError("Filepath must be set")
+        with open(self.filepath) as fp:
+            yield from iter_records(fp)
+
+    def raw_records(self) -> Iterable[Dict[str, str]]:
+        if self.cache is None:
+            return self.iter_file()
+        return iter(self.cache['data'])
+
+    def records(self) -> Iterable[Dict[str, str]]:
+        """The cached records, streamed from disk in streaming mode."""
+        self.get()
+        return self.raw_records()
+
+    def load(self):
+        if self.metadata is not None:
+            return
+        try:
+            if self.streaming or self.snapshot:
+                self.readheader()
+            else:
+                self.readfile()
+        except (ValueError, EnvironmentError):
             pass
-        if not self.cache:
+
+    def get(self):
+        """Make sure the cache is usable, fetching or revalidating it if
+        necessary.
+        """
+        if self.checked:
+            return self.cache
+        self.load()
+        if not self.metadata:
             self.pull()
+            self._save()
+        elif self.expired():
+            self.refresh()
+        else:
+            self._cache_stat('hit')
+        self.checked = True
+        return self.cache
+
+    @property
+    def snapshot_path(self) -> Optional[str]:
+        if not self.snapshot or not self.filepath:
+            return None
+        return self.filepath + '.snap'
+
+    def _load_snapshot(self) -> Optional[EventStore]:
+        try:
+            source = os.stat(self.filepath)
+        except EnvironmentError:
+            return None
+        if SnapshotStore.is_current(self.snapshot_path, source):
+            with METRICS.timer('snapshot.load'):
+                return SnapshotStore(self.snapshot_path)
+        return None
+
+    def _save_snapshot(self, store: EventStore):
+        try:
+            source = os.stat(self.filepath)
+            with METRICS.timer('snapshot.save'):
+                SnapshotStore.write(store, self.snapshot_path, source)
+        except EnvironmentError:  # pragma: no cover
+            pass
+
+    def events(self) -> EventStore:
+        records = self.records()
+        if self._store is None and self.cache is None and self.snapshot_path:
+            self._store = self._load_snapshot()
+        if self._store is None:
+            store = EventStore()
+            # in streaming mode this includes parsing the file.
+            with METRICS.timer('events'):
+                if self.cache is None:
+                    store.extend_stream(records)
+                else:
+                    store.extend(self.cache['data'])
+            METRICS.count('events', len(store))
+            if self.snapshot_path:
+                self._save_snapshot(store)
+            self._store = store
+        return self._store
+
+    def index(self) -> EventIndex:
+        store = self.events()
+        if self._index is None or self._index.store is not store:
+            with METRICS.timer('index'):
+                self._index = EventIndex(store)
+        return self._index
+
+    def calendars(self, *, venue='all', start: datetime=None,
+                  end: datetime=None) -> Dict[str, Calendar]:
+        """One Calendar per venue. venue may be a single name, 'all', or a
+        list of names; start and end limit it to the events overlapping that
+        time range.
+        """
+        if isinstance(venue, str) and start is None and end is None:
+            store = self.events()
+            with METRICS.timer('calendars'):
+                return store.calendars(venue=venue)
+        index = self.index()
+        with METRICS.timer('calendars'):
+            return index.calendars(venues=venue, start=start, end=end)
+
+
+class DatasourceError(Exception):
+    """Raised when the datasource file can't be used at all."""
+
+
+class SqliteDataSource(DataSource):
+    """A DataSource stored in a SQLite database instead of a JSON file.
+
+    Events are keyed by event_key(), and every write is recorded as a
+    retrieval. Only new or changed events are written; events that drop out
+    of the feed are marked inactive rather than deleted, so the history of
+    every retrieval is kept.
+    """
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS retrievals (
+        id INTEGER PRIMARY KEY,
+        retrieved TEXT NOT NULL,
+        validators TEXT NOT NULL DEFAULT '{}',
+        changed INTEGER NOT NULL DEFAULT 0,
+        removed INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS events (
+        key TEXT PRIMARY KEY,
+        start INTEGER NOT NULL,
+        end INTEGER NOT NULL,
+        artist TEXT NOT NULL,
+        artist_url TEXT NOT NULL,
+        venue TEXT NOT NULL,
+        venue_url TEXT NOT NULL,
+        address TEXT NOT NULL,
+        record TEXT NOT NULL,
+        hash TEXT NOT NULL,
+        active INTEGER NOT NULL DEFAULT 1,
+        first_seen INTEGER NOT NULL REFERENCES retrievals (id),
+        last_changed INTEGER NOT NULL REFERENCES retrievals (id)
+    );
+    CREATE INDEX IF NOT EXISTS events_venue_start ON events (venue, start);
+    CREATE INDEX IF NOT EXISTS events_start ON events (start);
+    """
+    UPSERT = """
+    INSERT INTO events (key, start, end, artist, artist_url, venue,
+                        venue_url, address, record, hash, active,
+                        first_seen, last_changed)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 1, ?, ?)
+    ON CONFLICT (key) DO UPDATE SET
+        start = excluded.start, end = excluded.end,
+        artist = excluded.artist, artist_url = excluded.artist_url,
+        venue = excluded.venue, venue_url = excluded.venue_url,
+        address = excluded.address, record = excluded.record,
+        hash = excluded.hash, active = 1,
+        last_changed = excluded.last_changed
+    """
+    COLUMNS = 'start, end, artist, artist_url, venue, venue_url, address'
+
+    def __init__(self, filepath=None, url=None, **kwargs) -> None:
+        kwargs.pop('snapshot', None)
+        super().__init__(filepath, url, **kwargs)
+        self._conn = None  # type: Optional[sqlite3.Connection]
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            if not self.filepath:  # pragma: nocover
+                raise ValueError("Filepath must be set")
+            conn = sqlite3.connect(self.filepath)
             try:
-                self.writefile()
-            except (ValueError, EnvironmentError):  # pragma: no cover
-                pass
+                conn.executescript(self.SCHEMA)
+            except sqlite3.DatabaseError as exc:
+                conn.close()
+                raise DatasourceError('{} is not a SQLite database ({})'
+                                      .format(self.filepath, exc))
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def record_key(record: Dict[str, str]) -> str:
+        return '\0'.join(event_key(record))
+
+    def readheader(self):
+        row = self.conn.execute(
+            'SELECT retrieved, validators FROM retrievals ORDER BY id DESC LIMIT 1'
+        ).fetchone()
+        if row is None:
+            self.header = {}
+        else:
+            self.header = {'retrieved': row[0], 'validators': json.loads(row[1])}
+        return self.header
+
+    def readfile(self):
+        header = self.readheader()
+        with METRICS.timer('parse'):
+            self.cache = dict(header, data=list(self.iter_file()))
         return self.cache
 
-    def calendars(self, *, venue='all') -> Dict[str, Calendar]:
-        self.get()
-        events = [Event(e) for e in self.cache['data']]
-        events.sort(key=lambda e: e.start)
-        events_map = {}  # type: Dict[str, Calendar]
-        for event in events:
-            if venue == 'all' or venue == event.venue:
-                events_map.setdefault(
-                    event.venue,
-                    Calendar(VENUE_FMT.format(event.venue))
-                ).append(event)
-        return events_map
+    def iter_file(self) -> Iterable[Dict[str, str]]:
+        rows = self.conn.execute(
+            'SELECT record FROM events WHERE active = 1 ORDER BY rowid'
+        )
+        for (record,) in rows:
+            yield json.loads(record)
+
+    def load(self):
+        if self.metadata is None:
+            self.readheader()
+
+    def save_metadata(self):
+        # with no data to look at, this only records the retrieval.
+        self._save()
+
+    def _writefile(self):
+        """Record a retrieval, writing only the events that changed."""
+        meta = self.metadata
+        if not meta:  # pragma: nocover
+            raise ValueError("Nothing to write")
+        with self.conn as conn:
+            retrieval = conn.execute(
+                'INSERT INTO retrievals (retrieved, validators) VALUES (?, ?)',
+                (meta['retrieved'], json.dumps(meta.get('validators', {})))
+            ).lastrowid
+            if self.cache is None:
+                # revalidated without changes, so no data to look at.
+                return
+            existing = dict(conn.execute(
+                'SELECT key, hash FROM events WHERE active = 1'
+            ))
+            seen = set()  # type: Set[str]
+            changed = 0
+            days = {}  # type: Dict[str, int]
+            for record in self.cache['data']:
+                key = self.record_key(record)
+                seen.add(key)
+                content = json.dumps(record, sort_keys=True)
+                digest = hashlib.sha1(content.encode('utf-8')).hexdigest()
+                if existing.get(key) == digest:
+                    continue
+                start, end = parse_timestamps([record['start'], record['end']], days)
+                conn.execute(self.UPSERT, (
+                    key, start, end,
+                    record['venue_artist'], record['url'],
+                    record['venue_name'], record['venue_url'],
+                    record['description'], content, digest,
+                    retrieval, retrieval
+                ))
+                changed += 1
+            removed = [key for key in existing if key not in seen]
+            conn.executemany(
+                'UPDATE events SET active = 0, last_changed = ? WHERE key = ?',
+                ((retrieval, key) for key in removed)
+            )
+            conn.execute(
+                'UPDATE retrievals SET changed = ?, removed = ? WHERE id = ?',
+                (changed, len(removed), retrieval)
+            )
+
+    def retrievals(self) -> List[Dict[str, Any]]:
+        """Every recorded retrieval, oldest first."""
+        rows = self.conn.execute(
+            'SELECT id, retrieved, changed, removed FROM retrievals ORDER BY id'
+        )
+        return [
+            {'id': r[0], 'retrieved': r[1], 'changed': r[2], 'removed': r[3]}
+            for r in rows
+        ]
+
+    def _query(self, where: List[str], params: List[Any]) -> EventStore:
+        store = EventStore()
+        with METRICS.timer('events'):
+            store.extend_rows(self.conn.execute(
+                'SELECT {} FROM events WHERE {} ORDER BY start, rowid'.format(
+                    self.COLUMNS, ' AND '.join(['active = 1'] + where)
+                ),
+                params
+            ))
+        METRICS.count('events', len(store))
+        return store
+
+    def events(self) -> EventStore:
+        self.get()
+        if self._store is None:
+            self._store = self._query([], [])
+        return self._store
+
+    def calendars(self, *, venue='all', start: datetime=None,
+                  end: datetime=None) -> Dict[str, Calendar]:
+        """Like DataSource.calendars(), with the filtering done in SQL."""
+        self.get()
+        where = []  # type: List[str]
+        params = []  # type: List[Any]
+        if venue != 'all':
+            venues = [venue] if isinstance(venue, str) else list(venue)
+            where.append('venue IN ({})'.format(', '.join('?' * len(venues))))
+            params.extend(venues)
+        if start is not None:
+            where.append('end > ?')
+            params.append(to_timestamp(start))
+        if end is not None:
+            where.append('start < ?')
+            params.append(to_timestamp(end))
+        store = self._query(where, params)
+        with METRICS.timer('calendars'):
+            return store.calendars()
+
+
+#Writers, for outputting data.
+class Writer(metaclass=ABCMeta):
+    # events from one-shot iterators are sorted on disk in runs this big.
+    SPILL_SIZE = 1 << 18
+
+    @classmethod
+    def flatten(cls, calendars: Iterable[Iterable[Event]]) -> FlatCalendar:
+        with METRICS.timer('flatten'):
+            sources = []  # type: List[Iterable[Event]]
+            for cal in calendars:
+                if iter(cal) is cal:
+                    # can only be read once, and might not fit in memory.
+                    sources.append(SpilledEvents(cal, run_size=cls.SPILL_SIZE))
+                elif is_sorted(cal):
+                    sources.append(cal)
+                else:
+                    # already in memory, so sorting only adds references.
+                    sources.append(sorted(cal, key=_start_key))
+        return FlatCalendar(FLAT_NAME, sources)
+
+    @classmethod
+    def from_args(cls, args: argparse.Namespace) -> Optional['Writer']:
+        """Build the writer the command line asks for, or return None if it
+        doesn't want this one.
+        """
+        return None
+
+    def sink(self, *, flatten=False) -> Optional['Sink']:
+        """A Sink that does what write() would, a single event at a time,
+        or None if this writer can't work that way.
+        """
+        return None
+
+    def confirm_write(self, calendars: Sequence[Calendar], *, flatten=False):
+        """Ask, up front, anything the next write() of these calendars would
+        ask, so that it can run on another thread without prompting.
+        """
+
+    def remove(self, names: Iterable[str]):
+        """Take down the calendars with these names, which have gone from
+        the source. Writers that keep an `owned` set only take down what is
+        in it.
+        """
+
+    @abstractmethod
+    def write(self, calendars: List[Calendar], *, flatten=False):
+        """Do whatever the output thing is."""
+
+
+def _render_rows(writer: 'FileWriter', name: str,
+                 rows: List[Tuple[Any, ...]]) -> bytes:
+    """Render a calendar from its compact rows, in a worker process."""
+    store = EventStore()
+    store.extend_rows(rows)
+    return writer.render(Calendar(name, items=store))
+
+
+class FileWriter(Writer):
+    """Write Calendars out to a filetype.
+
+    With jobs > 1, writing a directory renders the calendars in a pool of
+    that many processes. Each worker gets the calendar as compact rows and
+    sends back the rendered bytes, which are written out in order.
+
+    With a manifest_path, the writer remembers a hash of what it rendered
+    into each file (the calendar's digest plus format_id()). Calendars whose
+    file still matches are skipped without rendering or writing anything.
+    Several writers can share a manifest; each only saves its own entries.
+    Files are always written to a temporary file and renamed into place.
+    """
+    FORMAT_VERSION = 1
+    MANIFEST_LOCK = threading.Lock()
+
+    def __init__(self, output, *, silently_destroy_data=False,
+                 jobs: int=1, manifest_path: str=None) -> None:
+        self.output = output
+        self.silently_destroy_data = silently_destroy_data
+        self.jobs = jobs
+        self.manifest_path = manifest_path
+        self.manifest = self.load_manifest(manifest_path)
+        # entries recorded since the manifest was last saved.
+        self.recorded = {}  # type: Dict[str, dict]
+        # absolute paths this writer wrote, which it may overwrite again
+        # without asking.
+        self.owned = set()  # type: Set[str]
+        # answers from confirm_write(), each used by the next write only.
+        self._answers = {}  # type: Dict[str, bool]
+        self.stats = Counter()  # type: Counter
+
+
+    @abstractmethod
+    def calendar_filename(self, calendar: Calendar):
+        """Return a default filename creator for the given calendar."""
+
+    @abstractmethod
+    def write_file(self, filepath: str, calendar: Calendar):
+        """Write a calendar out to fp in whatever the output format is."""
+
+    def render(self, calendar: Calendar) -> bytes:
+        """Return the calendar in whatever the output format is.
+
+        This writes it to a temporary file with write_file() and reads it
+        back; writers that can render in memory should override it.
+        """
+        fd, tmppath = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            self.write_file(tmppath, calendar)
+            with open(tmppath, 'rb') as fp:
+                return fp.read()
+        finally:
+            os.remove(tmppath)
+
+    @property
+    def content_type(self) -> str:
+        """The MIME type of what render() returns."""
+        return 'application/octet-stream'
+
+    def confirm_overwrite(self, path: str) -> bool:
+        answer = self._answers.pop(os.path.abspath(path), None)
+        if answer is not None:
+            return answer
+        if self.silently_destroy_data or os.path.abspath(path) in self.owned:
+            return True
+        if os.path.exists(path):
+            question = 'Delete existing file at {}?'.format(path)
+            return wait_for_response(question)
+        return True
+
+    def confirm_write(self, calendars: Sequence[Calendar], *, flatten=False):
+        # flattening here could use up calendars write() still needs, so
+        # a flattened file is asked about even if it turns out unchanged.
+        if flatten:
+            targets = [(self.output, None)]  # type: List[Tuple[str, Optional[str]]]
+        else:
+            targets = [
+                (os.path.join(self.output, self.calendar_filename(calendar)),
+                 self.render_key(calendar))
+                for calendar in calendars
+            ]
+        answers = {}
+        for path, key in targets:
+            if not self.unchanged(path, key):
+                answers[os.path.abspath(path)] = self.confirm_overwrite(path)
+        self._answers = answers
+
+    def remove(self, names: Iterable[str]):
+        for name in names:
+            path = os.path.abspath(os.path.join(
+                self.output, self.calendar_filename(Calendar(name))
+            ))
+            if path not in self.owned:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.owned.discard(path)
+
+    def format_id(self) -> str:
+        """Everything besides the events that affects the rendered output."""
+        return '{}/{}'.format(type(self).__name__, self.FORMAT_VERSION)
+
+    @staticmethod
+    def load_manifest(path: Optional[str]) -> Dict[str, dict]:
+        return _load_json(path)
+
+    def save_manifest(self):
+        if not self.manifest_path:
+            return
+        with self.MANIFEST_LOCK:
+            # another writer may have saved to the same file since we
+            # loaded it, so merge into what is there now.
+            manifest = self.load_manifest(self.manifest_path)
+            manifest.update(self.recorded)
+            _dump_json_atomically(self.manifest_path, manifest)
+        self.manifest = manifest
+        self.recorded = {}
+
+    def render_key(self, calendar: Calendar) -> Optional[str]:
+        if not self.manifest_path:
+            return None
+        key = '{}\0{}'.format(self.format_id(), calendar.digest())
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def unchanged(self, path: str, key: Optional[str]) -> bool:
+        """Whether path still holds exactly what was rendered for key."""
+        entry = self.manifest.get(os.path.abspath(path))
+        if key is None or entry is None or entry['key'] != key:
+            return False
+        try:
+            stat = os.stat(path)
+        except EnvironmentError:
+            return False
+        return (stat.st_size, stat.st_mtime_ns) == (entry['size'], entry['mtime_ns'])
+
+    def record(self, written: Iterable[Tuple[str, Optional[str]]]):
+        """Remember what was rendered into each of the (path, key) pairs."""
+        if not self.manifest_path:
+            return
+        for path, key in written:
+            stat = os.stat(path)
+            self.recorded[os.path.abspath(path)] = {
+                'key': key, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns
+            }
+        self.manifest.update(self.recorded)
+        self.save_manifest()
+
+    def _changed(self, calendars: Iterable[Calendar], path: str=None
+                 ) -> List[Tuple[Calendar, str, Optional[str]]]:
+        """The calendars that need writing, with their paths and keys."""
+        changed = []
+        for calendar in calendars:
+            target = path
+            if target is None:
+                target = os.path.join(self.output,
+                                      self.calendar_filename(calendar))
+            key = self.render_key(calendar)
+            if self.unchanged(target, key):
+                self.stats['skipped'] += 1
+            else:
+                changed.append((calendar, target, key))
+        return changed
+
+    def write_atomically(self, path: str, calendar: Calendar=None, *,
+                         data: bytes=None):
+        """Write the calendar, or already rendered data, to path through a
+        temporary file, which is removed if anything goes wrong."""
+        tmppath = _temp_path(path)
+        try:
+            if data is None:
+                self.write_file(tmppath, calendar)
+            else:
+                with open(tmppath, 'wb') as fp:
+                    fp.write(data)
+            os.replace(tmppath, path)
+        except BaseException:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+            raise
+        self.owned.add(os.path.abspath(path))
+        self.stats['written'] += 1
+
+    def to_file(self, calendar: Calendar, *, path: str=None):
+        if path is None:
+            path = self.output
+
+        changed = self._changed([calendar], path)
+        if not changed or not self.confirm_overwrite(path):
+            return
+
+        self.write_atomically(path, calendar)
+        self.record([(path, changed[0][2])])
+
+    def _render_parallel(self, targets: List[Tuple[Calendar, str]]):
+        with ProcessPoolExecutor(max_workers=self.jobs) as pool:
+            futures = [
+                pool.submit(_render_rows, self, calendar.name,
+                            [event.row for event in calendar])
+                for calendar, _ in targets
+            ]
+            try:
+                for (_, path), future in zip(targets, futures):
+                    self.write_atomically(path, data=future.result())
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+
+    def to_directory(self, calendars: Iterable[Calendar]):
+        """Write out the calendars to a directory, one per calendar."""
+        os.makedirs(self.output, exist_ok=True)
+        # ask about every overwrite before any work starts
+        targets = []  # type: List[Tuple[Calendar, str]]
+        keys = []  # type: List[Optional[str]]
+        for calendar, path, key in self._changed(calendars):
+            if self.confirm_overwrite(path):
+                targets.append((calendar, path))
+                keys.append(key)
+
+        if self.jobs > 1 and len(targets) > 1:
+            self._render_parallel(targets)
+        else:
+            for calendar, path in targets:
+                self.write_atomically(path, calendar)
+        self.record((path, key) for (_, path), key in zip(targets, keys))
+
+    def write(self, calendars: Iterable[Calendar], *, flatten=False):
+        if flatten:
+            self.to_file(self.flatten(calendars))
+        else:
+            self.to_directory(calendars)
+
+
+class StreamingFileWriter(FileWriter):
+    """A FileWriter that can write a file one event at a time, which lets
+    export() share a single pass over the events with other outputs.
+    """
+    # the mode files are opened in for open_stream().
+    FILE_MODE = 'w'
+
+    def open_file(self, path: str, mode: str=None):
+        return open(path, mode or self.FILE_MODE)
+
+    @abstractmethod
+    def open_stream(self, fp, name: str) -> Any:
+        """Start the file fp, returning what stream_event() writes to."""
+
+    @abstractmethod
+    def stream_event(self, stream, event: Event):
+        """Write the next event."""
+
+    def close_stream(self, stream):
+        pass
+
+    def sink(self, *, flatten=False) -> Optional['Sink']:
+        # a pool renders whole calendars, so it can't share the pass.
+        if self.jobs > 1 and not flatten:
+            return None
+        return FileSink(self, flatten=flatten)
+
+
+class CSVWriter(StreamingFileWriter):
+    """Write the calendar out to a csv file.
+
+    Rows are written as plain tuples. Writing a directory writes one file
+    per calendar; write_stream() takes an ungrouped stream of events
+    instead, and routes each row to its venue's file in a single pass.
+    """
+    FIELDS = ('Location', 'Description', 'Start Date', 'Start Time',
+              'End Date', 'End Time', 'All Day Event', 'Subject', 'Private')
+    # the same bytes whatever the platform and locale; the csv module
+    # writes its own line endings.
+    ENCODING = 'utf-8'
+
+    def __init__(self, output, *, silently_destroy_data=False, jobs: int=1,
+                 max_open: int=256, manifest_path: str=None) -> None:
+        super().__init__(output, silently_destroy_data=silently_destroy_data,
+                         jobs=jobs, manifest_path=manifest_path)
+        self.max_open = max_open
+
+    @classmethod
+    def from_args(cls, args: argparse.Namespace) -> Optional[Writer]:
+        if not args.googlecsv:
+            return None
+        return cls(
+            output=args.googlecsv,
+            silently_destroy_data=args.silently_destroy_data,
+            jobs=args.jobs,
+            manifest_path=args.render_manifest,
+        )
+
+    def to_csvrow(self, event: Event) -> Tuple[str, ...]:
+        start_date, start_time = event.format_start('%m/%d/%Y|%I:%M %p').split('|')
+        end_date, end_time = event.format_end('%m/%d/%Y|%I%M %p').split('|')
+        return (event.address, event.venue, start_date, start_time, end_date,
+                end_time, 'False', event.artist, 'False')
+
+    def to_csvdict(self, event: Event) -> Dict[str, str]:
+        return dict(zip(self.FIELDS, self.to_csvrow(event)))
+
+    def filename(self, name: str) -> str:
+        return name.lower().replace('(', '').replace(')', '')\
+               .replace('@', 'at')+'.csv'
+
+    def calendar_filename(self, calendar: Calendar) -> str:
+            return self.filename(calendar.name)
+
+    def write_csv(self, fp, calendar: Iterable[Event]):
+        writer = self.open_stream(fp, '')
+        writer.writerows(self.to_csvrow(e) for e in calendar)
+
+    def open_stream(self, fp, name: str) -> Any:
+        writer = csv.writer(fp)
+        writer.writerow(self.FIELDS)
+        return writer
+
+    def stream_event(self, stream, event: Event):
+        stream.writerow(self.to_csvrow(event))
+
+    def open_file(self, path: str, mode: str=None):
+        return open(path, mode or self.FILE_MODE, encoding=self.ENCODING,
+                    newline='')
+
+    def write_file(self, path: str, calendar: Calendar):
+        with self.open_file(path) as fp:
+            self.write_csv(fp, calendar)
+
+    def render(self, calendar: Calendar) -> bytes:
+        fp = io.StringIO(newline='')
+        self.write_csv(fp, calendar)
+        return fp.getvalue().encode(self.ENCODING)
+
+    @property
+    def content_type(self) -> str:
+        return 'text/csv; charset={}'.format(self.ENCODING)
+
+    def write_stream(self, events: Iterable[Event]) -> List[str]:
+        """Write each event to its venue's file under the output directory,
+        in a single pass, returning the paths written.
+
+        At most max_open files are kept open at once; the least recently
+        used one is closed (and later reopened for appending) when needed.
+        Each file is written under a temporary name and only renamed into
+        place once every event has been written.
+        """
+        os.makedirs(self.output, exist_ok=True)
+        handles = OrderedDict()  # type: OrderedDict
+        paths = {}  # type: Dict[str, Optional[str]]
+        # the temporary file each path is being written to.
+        started = OrderedDict()  # type: OrderedDict
+        try:
+            for event in events:
+                venue = event.venue
+                path = paths.get(venue, '')
+                if path == '':
+                    path = os.path.join(
+                        self.output, self.filename(VENUE_FMT.format(venue))
+                    )
+                    if not self.confirm_overwrite(path):
+                        path = None
+                    paths[venue] = path
+                if path is None:
+                    continue
+
+                handle = handles.get(path)
+                if handle is None:
+                    if len(handles) >= self.max_open:
+                        handles.popitem(last=False)[1][0].close()
+                    reopen = path in started
+                    if not reopen:
+                        started[path] = _temp_path(path)
+                    fp = self.open_file(started[path], 'a' if reopen else 'w')
+                    handle = handles[path] = (fp, csv.writer(fp))
+                    if not reopen:
+                        handle[1].writerow(self.FIELDS)
+                else:
+                    handles.move_to_end(path)
+                handle[1].writerow(self.to_csvrow(event))
+        except BaseException:
+            for fp, _ in handles.values():
+                fp.close()
+            for tmppath in started.values():
+                os.remove(tmppath)
+            raise
+        for fp, _ in handles.values():
+            fp.close()
+        for path, tmppath in started.items():
+            os.replace(tmppath, path)
+            self.owned.add(os.path.abspath(path))
+        self.stats['written'] += len(started)
+        return list(started)
+
+
+def ical_escape(value: str) -> str:
+    """Escape a TEXT value per RFC 5545 section 3.3.11."""
+    return value.replace('\\', '\\\\').replace(';', '\\;')\
+        .replace(',', '\\,').replace('\r\n', '\\n').replace('\n', '\\n')
+
+
+def ical_fold(line: str) -> bytes:
+    """Encode a content line, folded so that no line is over 75 octets and
+    no UTF-8 sequence is split across lines.
+    """
+    data = line.encode('utf-8')
+    if len(data) <= 75:
+        return data + b'\r\n'
+    parts = []
+    limit = 75
+    while len(data) > limit:
+        cut = limit
+        # back up to the start of a multi-byte character
+        while data[cut] & 0xC0 == 0x80:
+            cut -= 1
+        parts.append(data[:cut])
+        data = data[cut:]
+        limit = 74
+    parts.append(data)
+    return b'\r\n '.join(parts) + b'\r\n'
+
+
+class IcalWriter(StreamingFileWriter):
+    """Write the calendar out to an ical file.
+
+    By default events are serialized straight to the file as they are read.
+    Passing serializer='object' builds the whole icalendar object tree first
+    instead.
+    """
+    PRODID = "-//Jakes awesome ums converter//Jacob Beck//"
+    SERIALIZERS = ('stream', 'object')
+    ICAL_DATEFMT = '%Y%m%dT%H%M%S'
+
+    def __init__(self, output, *, silently_destroy_data=False, jobs: int=1,
+                 serializer: str='stream', manifest_path: str=None) -> None:
+        if serializer not in self.SERIALIZERS:
+            raise ValueError('Unknown serializer {!r}'.format(serializer))
+        super().__init__(output, silently_destroy_data=silently_destroy_data,
+                         jobs=jobs, manifest_path=manifest_path)
+        self.serializer = serializer
+
+    @classmethod
+    def from_args(cls, args: argparse.Namespace) -> Optional[Writer]:
+        if not args.ical:
+            return None
+        return cls(
+            output=args.ical,
+            silently_destroy_data=args.silently_destroy_data,
+            jobs=args.jobs,
+            serializer=args.ical_serializer,
+            manifest_path=args.render_manifest,
+        )
+
+    def calendar_filename(self, calendar: Calendar) -> str:
+            return calendar.name.lower().replace('(', '').replace(')', '')\
+                   .replace('@', 'at')+'.ical'
+
+    def format_id(self) -> str:
+        return '{}/{}'.format(super().format_id(), self.serializer)
+
+    def to_ical_event(self, event: Event) -> 'icalendar.Event':
+        e = icalendar.Event()
+        e.add('dtstart', event.start)
+        e.add('dtend', event.end)
+        e.add('summary', event.artist)
+        e.add('location', icalendar.prop.vText(event.location))
+        e.add('description', event.description)
+        return e
+
+    def to_ical_calendar(self, calendar: Calendar) -> 'icalendar.Calendar':
+        c = icalendar.Calendar()
+        c.add('prodid', self.PRODID)
+        c.add('version', '1.0')
+        c.add('name', calendar.name)
+        for event in calendar:
+            c.add_component(self.to_ical_event(event))
+        return c
+
+    def ical_event_lines(self, event: Event) -> List[str]:
+        # event times are naive, so they are written as floating times just
+        # like icalendar does for the object path.
+        return [
+            'BEGIN:VEVENT',
+            'SUMMARY:' + ical_escape(event.artist),
+            'DTSTART:' + event.format_start(self.ICAL_DATEFMT),
+            'DTEND:' + event.format_end(self.ICAL_DATEFMT),
+            'DESCRIPTION:' + ical_escape(event.description),
+            'LOCATION:' + ical_escape(event.location),
+            'END:VEVENT',
+        ]
+
+    FILE_MODE = 'wb'
+
+    def stream_ical(self, fp, calendar: Iterable[Event], name: str):
+        """Write the calendar to the binary file fp, one event at a time."""
+        self.open_stream(fp, name)
+        for event in calendar:
+            self.stream_event(fp, event)
+        self.close_stream(fp)
+
+    def open_stream(self, fp, name: str) -> Any:
+        header = [
+            'BEGIN:VCALENDAR',
+            'VERSION:1.0',
+            'PRODID:' + self.PRODID,
+            'NAME:' + ical_escape(name),
+        ]
+        fp.write(b''.join(ical_fold(line) for line in header))
+        return fp
+
+    def stream_event(self, stream, event: Event):
+        stream.write(b''.join(
+            ical_fold(line) for line in self.ical_event_lines(event)
+        ))
+
+    def close_stream(self, stream):
+        stream.write(ical_fold('END:VCALENDAR'))
+
+    def sink(self, *, flatten=False) -> Optional['Sink']:
+        if self.serializer != 'stream':
+            return None
+        return super().sink(flatten=flatten)
+
+    def write_file(self, path: str, calendar: Calendar):
+        with open(path, 'wb') as fp:
+            if self.serializer == 'stream':
+                self.stream_ical(fp, calendar, calendar.name)
+            else:
+                fp.write(self.to_ical_calendar(calendar).to_ical())
+
+    def render(self, calendar: Calendar) -> bytes:
+        if self.serializer == 'stream':
+            fp = io.BytesIO()
+            self.stream_ical(fp, calendar, calendar.name)
+            return fp.getvalue()
+        return self.to_ical_calendar(calendar).to_ical()
+
+    @property
+    def content_type(self) -> str:
+        return 'text/calendar; charset=utf-8'
+
+
+class TokenBucket:
+    """A thread-safe token bucket, refilled at `rate` tokens per second."""
+    def __init__(self, rate: float, capacity: float=None) -> None:
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens: float=1) -> None:
+        tokens = min(tokens, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class UnknownOutcomeError(Exception):
+    """The batch a request was in failed part way through, so it may or may
+    not have been applied."""
+
+
+class BatchError(Exception):
+    """Raised when google API requests still fail after every retry."""
+    def __init__(self, failures: List[Tuple[int, Exception]]) -> None:
+        self.failures = failures
+        super().__init__('{} requests failed, first error: {}'.format(
+            len(failures), failures[0][1]
+        ))
+
+
+class BatchExecutor:
+    """Runs google API requests as batch requests, several batches at a time,
+    no faster than the given rate.
+
+    Sub-requests that fail with a rate limit or server error are retried, on
+    their own, with exponential backoff. Anything still failing at the end is
+    raised as a BatchError, so events are never silently dropped.
+
+    If the connection fails in the middle of a batch, the requests without a
+    response may already have been applied, so only those that are safe to
+    send twice are retried; inserts are failed instead.
+    """
+    MAX_BATCH = 50
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+    RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+    RESENDABLE_METHODS = {'GET', 'PATCH', 'PUT', 'DELETE'}
+
+    def __init__(self, service, *, http_factory=None, workers: int=4,
+                 rate: float=None, batch_size: int=MAX_BATCH,
+                 retries: int=5, backoff: float=1.0) -> None:
+        self.service = service
+        self.http_factory = http_factory
+        self.workers = workers
+        self.batch_size = min(batch_size, self.MAX_BATCH)
+        self.bucket = TokenBucket(rate, max(rate, self.batch_size)) if rate else None
+        self.retries = retries
+        self.backoff = backoff
+        self.stats = Counter()  # type: Counter
+        self.elapsed = 0.0
+        self._local = threading.local()
+
+    def _http(self):
+        if self.http_factory is None:
+            return None
+        if not hasattr(self._local, 'http'):
+            self._local.http = self.http_factory()
+        return self._local.http
+
+    @staticmethod
+    def error_reasons(content: bytes) -> Set[str]:
+        """The reasons given in a google API error response body."""
+        try:
+            errors = json.loads(content.decode('utf-8'))['error']['errors']
+            return {error['reason'] for error in errors}
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return set()
+
+    @classmethod
+    def retryable(cls, exception: Exception) -> bool:
+        resp = getattr(exception, 'resp', None)
+        if resp is None:
+            # not an HttpError, so only a connection problem is worth retrying.
+            return isinstance(exception, (OSError, httplib2.HttpLib2Error))
+        status = int(getattr(resp, 'status', 0))
+        if status == 403:
+            content = getattr(exception, 'content', b'')
+            return bool(cls.error_reasons(content) & cls.RATE_LIMIT_REASONS)
+        return status in cls.RETRY_STATUSES
+
+    @classmethod
+    def resendable(cls, request) -> bool:
+        return getattr(request, 'method', None) in cls.RESENDABLE_METHODS
+
+    def _run_batch(self, chunk: List[Tuple[int, Any]]) -> Dict[int, Tuple[Any, Optional[Exception]]]:
+        if self.bucket is not None:
+            self.bucket.acquire(len(chunk))
+        results = {}  # type: Dict[int, Tuple[Any, Optional[Exception]]]
+
+        def callback(request_id, response, exception):
+            results[int(request_id)] = (response, exception)
+
+        batch = self.service.new_batch_http_request(callback=callback)
+        for index, request in chunk:
+            batch.add(request, request_id=str(index))
+        METRICS.count('google.batches')
+        METRICS.count('google.batched_requests', len(chunk))
+        try:
+            with METRICS.timer('google.batch'):
+                batch.execute(http=self._http())
+        except Exception as exc:
+            unknown = UnknownOutcomeError(
+                'batch failed after sending: {}'.format(exc)
+            )
+            unknown.__cause__ = exc
+            for index, request in chunk:
+                results.setdefault(
+                    index, (None, exc if self.resendable(request) else unknown)
+                )
+        self.stats['batches'] += 1
+        return results
+
+    def execute(self, requests: List[Any]) -> List[Any]:
+        """Run all the requests, returning their responses in order."""
+        started = time.monotonic()
+        responses = [None] * len(requests)  # type: List[Any]
+        pending = list(enumerate(requests))
+        failures = []  # type: List[Tuple[int, Exception]]
+        attempt = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while pending:
+                chunks = [pending[i:i + self.batch_size]
+                          for i in range(0, len(pending), self.batch_size)]
+                retry = []
+                for results in executor.map(self._run_batch, chunks):
+                    for index, (response, exception) in results.items():
+                        if exception is None:
+                            responses[index] = response
+                            self.stats['requests'] += 1
+                        elif self.retryable(exception) and attempt < self.retries:
+                            retry.append((index, requests[index]))
+                            self.stats['retries'] += 1
+                        else:
+                            failures.append((index, exception))
+                            self.stats['errors'] += 1
+                pending = sorted(retry, key=lambda item: item[0])
+                if pending:
+                    time.sleep(self.backoff * 2 ** attempt *
+                               random.uniform(1, 1.5))
+                    attempt += 1
+        self.elapsed += time.monotonic() - started
+        if failures:
+            raise BatchError(sorted(failures, key=lambda item: item[0]))
+        return responses
+
+    def summary(self) -> str:
+        rate = self.stats['requests'] / self.elapsed if self.elapsed else 0.0
+        return ('{} requests in {} batches ({:.1f}/s), {} retried, '
+                '{} failed'.format(self.stats['requests'],
+                                   self.stats['batches'], rate,
+                                   self.stats['retries'],
+                                   self.stats['errors']))
+
+
+class GoogleCalendarWriter(Writer):
+    """A little wrapper for a google calendar service to skip all the boring
+    stuff.
+
+    Warning: If you pass or set silently_destroy_data, you will not be
+    prompted before calendars are deleted!
+
+    In sync mode, calendars are not emptied and refilled. Instead each event
+    gets an id derived from its source record and a hash of its contents,
+    and only the inserts, patches and deletes needed to match the source are
+    sent. The ids and hashes last written are kept in a local mirror file so
+    that an unchanged calendar costs no API calls to check.
+    """
+    SCOPE = 'https://www.googleapis.com/auth/calendar'
+    DISCOVERY_URL = 'https://www.googleapis.com/discovery/v1/apis/calendar/v3/rest'
+    DISCOVERY_TTL = 24 * 60 * 60
+    REFRESH_MARGIN = timedelta(minutes=5)
+    HASH_PROPERTY = 'umsHash'
+    # the largest pages the API allows, and only the fields we look at.
+    EVENT_PAGE_SIZE = 2500
+    CALENDAR_PAGE_SIZE = 250
+    CALENDAR_FIELDS = 'nextPageToken,items(id,summary)'
+    SYNC_FIELDS = 'nextPageToken,items(id,status,extendedProperties/private)'
+
+    def __init__(self, secrets: str, *, silently_destroy_data=False,
+                 sync=False, mirror_path: str=None, service=None,
+                 workers: int=4, rate: float=None) -> None:
+        http_factory = None
+        if service is None:
+            with METRICS.timer('google.startup'):
+                credentials = self.get_credentials(secrets,
+                                                   appname='UMS Calendar app')
+                http_factory = lambda: credentials.authorize(httplib2.Http())
+                service = self.build_service(http_factory())
+        self.service = service
+        self.executor = BatchExecutor(service, http_factory=http_factory,
+                                      workers=workers, rate=rate)
+
+        self.calsvc = self.service.calendars()
+        self.esvc = self.service.events()
+        self.calendar_list = self.service.calendarList()
+
+        self._calendar_list_cache = None  #  type: Optional[Dict[str, dict]]
+        self._answers = {}  # type: Dict[str, bool]
+        # names of the calendars this writer wrote, which it may overwrite
+        # again without asking.
+        self.owned = set()  # type: Set[str]
+        self.silently_destroy_data = silently_destroy_data
+        self.sync = sync
+        self.mirror_path = mirror_path
+        self.mirror = self.load_mirror(mirror_path) if sync else {}
+        self.stats = Counter()  # type: Counter
+
+    @classmethod
+    def from_args(cls, args: argparse.Namespace) -> Optional[Writer]:
+        if not args.gcal:
+            return None
+        return cls(
+            secrets=args.gsecrets,
+            silently_destroy_data=args.silently_destroy_data,
+            sync=args.gsync,
+            mirror_path=args.gmirror,
+            workers=args.gworkers,
+            rate=args.grate,
+        )
+
+    @staticmethod
+    def credential_dir() -> str:
+        home_dir = os.path.expanduser('~')
+        credential_dir = os.path.join(home_dir, '.credentials')
+        if not os.path.exists(credential_dir):
+            os.makedirs(credential_dir)
+        return credential_dir
+
+    @classmethod
+    def get_credentials(cls, secrets: str, appname: str):
+        credential_path = os.path.join(cls.credential_dir(),
+                                       'calendar-python-quickstart.json')
+
+        store = oauth2_file.Storage(credential_path)
+        credentials = store.get()
+        if not credentials or credentials.invalid:
+            flow = client.flow_from_clientsecrets(secrets, cls.SCOPE)
+            flow.user_agent = appname
+            credentials = tools.run_flow(flow, store, None)
+        elif cls.expiring(credentials):
+            credentials.refresh(httplib2.Http())
+        return credentials
+
+    @classmethod
+    def expiring(cls, credentials) -> bool:
+        """Whether the access token runs out within REFRESH_MARGIN. Tokens
+        with more life left are used as they are.
+        """
+        expiry = getattr(credentials, 'token_expiry', None)
+        if expiry is None:
+            return False
+        return expiry - datetime.utcnow() < cls.REFRESH_MARGIN
+
+    @classmethod
+    def load_discovery(cls, http, path: str, *,
+                       ttl: float=None) -> str:
+        """Return the calendar API's discovery document, from the copy cached
+        at path if it is younger than ttl seconds.
+        """
+        if ttl is None:
+            ttl = cls.DISCOVERY_TTL
+        cached = _load_json(path)  # type: Optional[Dict[str, Any]]
+        if cached.get('url') != cls.DISCOVERY_URL:
+            cached = None
+        if cached is not None and time.time() - cached['fetched'] < ttl:
+            return cached['document']
+
+        try:
+            resp, content = http.request(cls.DISCOVERY_URL)
+            if resp.status >= 400:
+                raise ValueError('Discovery request failed: {}'.format(resp.status))
+        except (ValueError, EnvironmentError, httplib2.HttpLib2Error):
+            # a stale document beats not starting at all.
+            if cached is not None:
+                return cached['document']
+            raise
+        document = content.decode('utf-8')
+        _dump_json_atomically(path, {'url': cls.DISCOVERY_URL,
+                                     'fetched': time.time(),
+                                     'document': document})
+        return document
+
+    @classmethod
+    def build_service(cls, http, discovery_path: str=None):
+        if discovery_path is None:
+            discovery_path = os.path.join(cls.credential_dir(),
+                                          'calendar-v3-discovery.json')
+        document = cls.load_discovery(http, discovery_path)
+        return discovery.build_from_document(document, http=http)
+
+    @staticmethod
+    def to_gcal(event: Event) -> Dict[str, Any]:
+        return {
+            'start': {'dateTime': event.format_start('%Y-%m-%dT%H:%M:%S-06:00')},
+            'end': {'dateTime': event.format_end('%Y-%m-%dT%H:%M:%S-06:00')},
+            'location': event.address,
+            'description': event.description,
+            'summary': event.artist,
+        }
+
+    @staticmethod
+    def event_id(event: Event) -> str:
+        """A valid (base32hex) google event id that is stable for the
+        event's source record.
+        """
+        key = '\0'.join(event.key).encode('utf-8')
+        return 'ums' + hashlib.sha1(key).hexdigest()
+
+    @classmethod
+    def to_gcal_synced(cls, event: Event) -> Tuple[str, str, Dict[str, Any]]:
+        """Return the event's id, content hash, and body for sync mode."""
+        body = cls.to_gcal(event)
+        content = json.dumps(body, sort_keys=True).encode('utf-8')
+        digest = hashlib.sha1(content).hexdigest()
+        event_id = cls.event_id(event)
+        body['id'] = event_id
+        body['status'] = 'confirmed'
+        body['extendedProperties'] = {'private': {cls.HASH_PROPERTY: digest}}
+        return event_id, digest, body
+
+    @staticmethod
+    def load_mirror(path: Optional[str]) -> Dict[str, dict]:
+        return _load_json(path)
+
+    def save_mirror(self):
+        if not self.mirror_path:
+            return
+        _dump_json_atomically(self.mirror_path, self.mirror)
+
+    @staticmethod
+    def iter_pages(collection, request) -> Iterable[List[dict]]:
+        """Yield each page of items from a list request, following
+        nextPageToken until there are no more.
+        """
+        while request is not None:
+            METRICS.count('google.list_requests')
+            resp = request.execute()
+            yield resp.get('items', [])
+            request = collection.list_next(request, resp)
+
+    def iter_calendars(self) -> Iterable[dict]:
+        pages = self.iter_pages(self.calendar_list, self.calendar_list.list(
+            maxResults=self.CALENDAR_PAGE_SIZE, fields=self.CALENDAR_FIELDS
+        ))
+        for page in pages:
+            yield from page
+
+    def iter_event_pages(self, cal_id: str, *, fields: str,
+                         show_deleted: bool=False) -> Iterable[List[dict]]:
+        return self.iter_pages(self.esvc, self.esvc.list(
+            calendarId=cal_id, showDeleted=show_deleted,
+            maxResults=self.EVENT_PAGE_SIZE, fields=fields
+        ))
+
+    @property
+    def calendar_list_cache(self) -> Dict[str, dict] :
+        if self._calendar_list_cache is None:
+            self._calendar_list_cache = {
+                c['summary']: c for c in self.iter_calendars()
+            }
+        return self._calendar_list_cache
+
+    @calendar_list_cache.setter
+    def calendar_list_cache(self, value: Dict[str, dict]):
+        self._calendar_list_cache = value
+
+    def _new_calendar_named(self, name: str) -> str:
+        created = self.calsvc.insert(body={'summary': name}).execute()
+        if self._calendar_list_cache is not None:
+            self._calendar_list_cache[name] = {
+                'id': created['id'], 'summary': created['summary']
+            }
+        return created['id']
+
+    def _make_batch_request(self, all_requests: list) -> list:
+        return self.executor.execute(all_requests)
+
+    def _clear_calendar(self, cal_id: str):
+        # list everything before deleting anything, so the deletes can't
+        # shift later pages out from under the listing.
+        pages = self.iter_event_pages(cal_id,
+                                      fields='nextPageToken,items(id,status)')
+        event_ids = [event['id'] for page in pages for event in page
+                     if event.get('status') != 'cancelled']
+        self._make_batch_request([
+            self.esvc.delete(calendarId=cal_id, eventId=event_id)
+            for event_id in event_ids
+        ])
+
+    def _add_events(self, cal_id: str, events: Iterable[Event]):
+        self._make_batch_request([
+            self.esvc.insert(calendarId=cal_id, body=self.to_gcal(event))
+            for event in events
+        ])
+
+    def _question(self, name: str) -> Optional[str]:
+        """What to ask before writing into the calendar called name, if
+        anything."""
+        if self.silently_destroy_data or name in self.owned:
+            return None
+        existing = self.calendar_list_cache.get(name)
+        if existing is None:
+            return None
+        if not self.sync:
+            return 'About to delete existing google calendar "{}". Ok?'\
+                .format(name)
+        mirrored = self.mirror.get(name)
+        if mirrored is not None and mirrored['id'] == existing['id']:
+            return None
+        return ('About to sync existing google calendar "{}", which will '
+                'remove events not in the source. Ok?').format(name)
+
+    def confirm(self, name: str) -> bool:
+        """Whether the calendar called name may be written, asking at most
+        once."""
+        answer = self._answers.get(name)
+        if answer is None:
+            question = self._question(name)
+            answer = question is None or wait_for_response(question)
+            self._answers[name] = answer
+        return answer
+
+    def confirm_calendars(self, calendars: Iterable[Calendar]):
+        """Start writing calendars: ask everything that writing them will
+        need up front, so no prompt comes in the middle of the work."""
+        self._calendar_list_cache = None
+        self._answers = {}
+        for calendar in calendars:
+            self.confirm(calendar.name)
+
+    def _get_empty_calendar_named(self, name: str) -> Optional[str]:
+        try:
+            to_clear = self.calendar_list_cache[name]
+        except KeyError:
+            return self._new_calendar_named(name)
+
+        if not self.confirm(name):
+            return None
+
+        self._clear_calendar(cal_id=to_clear['id'])
+        return to_clear['id']
+
+    def _remote_events(self, cal_id: str) -> Dict[str, Optional[str]]:
+        """Map each event id in the calendar to its content hash, or to None
+        if the event was deleted (google keeps deleted ids reserved).
+        """
+        remote = {}  # type: Dict[str, Optional[str]]
+        pages = self.iter_event_pages(cal_id, show_deleted=True,
+                                      fields=self.SYNC_FIELDS)
+        for page in pages:
+            for item in page:
+                if item.get('status') == 'cancelled':
+                    remote[item['id']] = None
+                else:
+                    private = item.get('extendedProperties', {}).get('private', {})
+                    remote[item['id']] = private.get(self.HASH_PROPERTY, '')
+        return remote
+
+    def _sync_target(self, name: str) -> Optional[Tuple[str, Dict[str, Optional[str]]]]:
+        """Find (or create) the calendar to sync into, and what is in it."""
+        mirrored = self.mirror.get(name)
+        existing = self.calendar_list_cache.get(name)
+        if existing is None:
+            cal_id = self._new_calendar_named(name)
+            return cal_id, {}
+        if mirrored is not None and mirrored['id'] == existing['id']:
+            if mirrored['events'] is None:
+                return existing['id'], self._remote_events(existing['id'])
+            return existing['id'], mirrored['events']
+
+        if not self.confirm(name):
+            return None
+        return existing['id'], self._remote_events(existing['id'])
+
+    def _sync_calendar(self, calendar: Calendar):
+        """Reconcile a google calendar with the given calendar."""
+        target = self._sync_target(calendar.name)
+        if target is None:
+            return
+        self.owned.add(calendar.name)
+        cal_id, remote = target
+        changes = []
+        events = dict(remote)
+        seen = set()  # type: Set[str]
+        for event in calendar:
+            event_id, digest, body = self.to_gcal_synced(event)
+            if event_id in seen:
+                continue
+            seen.add(event_id)
+            if event_id not in remote:
+                changes.append(self.esvc.insert(calendarId=cal_id, body=body))
+                self.stats['insert'] += 1
+            elif remote[event_id] != digest:
+                changes.append(self.esvc.patch(calendarId=cal_id,
+                                                eventId=event_id, body=body))
+                self.stats['patch'] += 1
+            events[event_id] = digest
+        for event_id, digest in remote.items():
+            if event_id not in seen and digest is not None:
+                changes.append(self.esvc.delete(calendarId=cal_id,
+                                                 eventId=event_id))
+                self.stats['delete'] += 1
+                events[event_id] = None
+
+        if changes:
+            print('Syncing {} changes into calendar {}'.format(
+                len(changes), calendar.name
+            ))
+        try:
+            self._make_batch_request(changes)
+        except BatchError:
+            # we no longer know what made it, so list it next time.
+            self.mirror[calendar.name] = {'id': cal_id, 'events': None}
+            self.save_mirror()
+            raise
+        self.mirror[calendar.name] = {'id': cal_id, 'events': events}
+
+    def _add_calendar(self, calendar: Calendar):
+        """Add a calendar entry."""
+        cal_id = self._get_empty_calendar_named(calendar.name)
+        if cal_id is None:
+            return
+        self.owned.add(calendar.name)
+        print('Importing {} events into calendar {}'.format(len(calendar), calendar.name))
+        self._add_events(cal_id=cal_id, events=calendar)
+
+    def write_calendar(self, calendar: Calendar):
+        if self.sync:
+            self._sync_calendar(calendar)
+            self.save_mirror()
+        else:
+            self._add_calendar(calendar)
+
+    def remove(self, names: Iterable[str]):
+        for name in names:
+            existing = self.calendar_list_cache.get(name)
+            if name not in self.owned or existing is None:
+                continue
+            self.calsvc.delete(calendarId=existing['id']).execute()
+            del self.calendar_list_cache[name]
+            self.mirror.pop(name, None)
+            self.owned.discard(name)
+        self.save_mirror()
+
+    def print_summary(self):
+        if self.executor.stats['requests'] or self.executor.stats['errors']:
+            print('Google Calendar: {}'.format(self.executor.summary()))
+
+    def write(self, calendars: Iterable[Calendar], *, flatten=False):
+        if flatten:
+            calendars = [self.flatten(calendars)]
+        else:
+            calendars = list(calendars)
+        self.confirm_calendars(calendars)
+        for calendar in calendars:
+            self.write_calendar(calendar)
+        self.print_summary()
+
+    def sink(self, *, flatten=False) -> Optional['Sink']:
+        return GoogleSink(self)
+
+
+class StdoutWriter(Writer):
+    @classmethod
+    def from_args(cls, args: argparse.Namespace) -> Optional[Writer]:
+        if not args.print:
+            return None
+        return cls()
+
+    @staticmethod
+    def print_event(event: Event, flattened: bool):
+        if flattened:
+            to_print = event.str_with_venue()
+        else:
+            to_print = event.str_without_venue()
+        print('\t{}'.format(to_print))
+
+    def print_calendar(self, calendar: Calendar, flattened: bool):
+        print('{}:'.format(calendar.name))
+        for event in calendar:
+            self.print_event(event, flattened)
+        print('')
+
+    def write(self, calendars: Iterable[Calendar], *, flatten=False):
+        if flatten:
+            calendars = [self.flatten(calendars)]
+        for calendar in calendars:
+            self.print_calendar(calendar, flatten)
+
+    def sink(self, *, flatten=False) -> Optional['Sink']:
+        return StdoutSink(self, flatten=flatten)
+
+
+class Sink(metaclass=ABCMeta):
+    """One output of export().
+
+    start() gets every calendar before any events are sent, so prompts can
+    all happen up front. Then each calendar gets begin(), add() for each of
+    its events, and end(), and finally finish() is called. If anything goes
+    wrong along the way, abort() is called instead.
+    """
+    def start(self, calendars: Sequence[Calendar]):
+        pass
+
+    @abstractmethod
+    def begin(self, calendar: Calendar) -> bool:
+        """Get ready for the calendar's events, or return False to skip it."""
+
+    @abstractmethod
+    def add(self, event: Event):
+        """Take the next event of the current calendar."""
+
+    def end(self, calendar: Calendar):
+        pass
+
+    def finish(self):
+        pass
+
+    def abort(self):
+        pass
+
+
+class StdoutSink(Sink):
+    def __init__(self, writer: StdoutWriter, *, flatten=False) -> None:
+        self.writer = writer
+        self.flatten = flatten
+
+    def begin(self, calendar: Calendar) -> bool:
+        print('{}:'.format(calendar.name))
+        return True
+
+    def add(self, event: Event):
+        self.writer.print_event(event, self.flatten)
+
+    def end(self, calendar: Calendar):
+        print('')
+
+
+class FileSink(Sink):
+    """Streams each calendar into its file, through a temporary file."""
+    def __init__(self, writer: StreamingFileWriter, *, flatten=False) -> None:
+        self.writer = writer
+        self.flatten = flatten
+        self.targets = {}  # type: Dict[str, Tuple[str, Optional[str]]]
+        self.written = []  # type: List[Tuple[str, Optional[str]]]
+        self.current = None  # type: Optional[Tuple[Any, Any, str]]
+
+    def start(self, calendars: Sequence[Calendar]):
+        writer = self.writer
+        if self.flatten:
+            changed = writer._changed(calendars, writer.output)
+        else:
+            os.makedirs(writer.output, exist_ok=True)
+            changed = writer._changed(calendars)
+        for calendar, path, key in changed:
+            if writer.confirm_overwrite(path):
+                self.targets[calendar.name] = (path, key)
+
+    def begin(self, calendar: Calendar) -> bool:
+        target = self.targets.get(calendar.name)
+        if target is None:
+            return False
+        tmppath = _temp_path(target[0])
+        try:
+            fp = self.writer.open_file(tmppath)
+        except BaseException:
+            os.remove(tmppath)
+            raise
+        self.current = (fp, self.writer.open_stream(fp, calendar.name), tmppath)
+        return True
+
+    def add(self, event: Event):
+        self.writer.stream_event(self.current[1], event)
+
+    def end(self, calendar: Calendar):
+        fp, stream, tmppath = self.current
+        self.current = None
+        self.writer.close_stream(stream)
+        fp.close()
+        path, key = self.targets[calendar.name]
+        os.replace(tmppath, path)
+        self.writer.owned.add(os.path.abspath(path))
+        self.writer.stats['written'] += 1
+        self.written.append((path, key))
+
+    def finish(self):
+        self.writer.record(self.written)
+
+    def abort(self):
+        if self.current is not None:
+            fp, _, tmppath = self.current
+            self.current = None
+            fp.close()
+            os.remove(tmppath)
+        # the files already renamed into place are still good
+        self.writer.record(self.written)
+
+
+class GoogleSink(Sink):
+    """Collects each calendar's events, then sends it off in batches."""
+    def __init__(self, writer: GoogleCalendarWriter) -> None:
+        self.writer = writer
+        self.calendar = None  # type: Optional[Calendar]
+
+    def start(self, calendars: Sequence[Calendar]):
+        self.writer.confirm_calendars(calendars)
+
+    def begin(self, calendar: Calendar) -> bool:
+        self.calendar = Calendar(calendar.name)
+        return True
+
+    def add(self, event: Event):
+        self.calendar.append(event)
+
+    def end(self, calendar: Calendar):
+        self.writer.write_calendar(self.calendar)
+        self.calendar = None
+
+    def finish(self):
+        self.writer.print_summary()
+
+
+class _TimedSink(Sink):
+    """Adds up the time a sink spends on its calls, and reports it as one
+    stage when it is done. Only used while METRICS is enabled.
+    """
+    def __init__(self, sink: Sink, stage: str) -> None:
+        self.sink = sink
+        self.stage = stage
+        self.elapsed = 0.0
+
+    def _timed(self, func, *args):
+        started = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self.elapsed += time.perf_counter() - started
+
+    def start(self, calendars: Sequence[Calendar]):
+        self._timed(self.sink.start, calendars)
+
+    def begin(self, calendar: Calendar) -> bool:
+        return self._timed(self.sink.begin, calendar)
+
+    def add(self, event: Event):
+        self._timed(self.sink.add, event)
+
+    def end(self, calendar: Calendar):
+        self._timed(self.sink.end, calendar)
+
+    def finish(self):
+        self._timed(self.sink.finish)
+        METRICS.add_time(self.stage, self.elapsed)
+
+    def abort(self):
+        self._timed(self.sink.abort)
+        METRICS.add_time(self.stage, self.elapsed)
+
+
+def _write_stage(writer: Writer) -> str:
+    return 'write.{}'.format(type(writer).__name__)
+
+
+def _sink_for(writer: Writer, *, flatten=False) -> Optional[Sink]:
+    sink = writer.sink(flatten=flatten)
+    if sink is not None and METRICS.enabled:
+        sink = _TimedSink(sink, _write_stage(writer))
+    return sink
+
+
+def _write_timed(writer: Writer, calendars: List[Calendar], *,
+                 flatten=False):
+    with METRICS.timer(_write_stage(writer)):
+        writer.write(calendars, flatten=flatten)
+
+
+def export(calendars: Iterable[Calendar], writers: List[Writer], *,
+           flatten=False):
+    """Write the calendars out with every writer.
+
+    Writers with a sink() share a single pass over the events. Each event
+    is wrapped in a ProjectedEvent once and handed to every sink, so the
+    fields they have in common (formatted times, descriptions, ...) are only
+    worked out once. Any other writers get write() as usual.
+    """
+    calendars = list(calendars)
+    sinks = []  # type: List[Sink]
+    for writer in writers:
+        sink = _sink_for(writer, flatten=flatten)
+        if sink is not None:
+            sinks.append(sink)
+            continue
+        _write_timed(writer, calendars, flatten=flatten)
+    if not sinks:
+        return
+
+    with METRICS.timer('export'):
+        if flatten:
+            calendars = [Writer.flatten(calendars)]
+        try:
+            for sink in sinks:
+                sink.start(calendars)
+            for calendar in calendars:
+                active = [sink for sink in sinks if sink.begin(calendar)]
+                if len(active) == 1:
+                    add = active[0].add
+                    for event in calendar:
+                        add(event)
+                elif active:
+                    for event in calendar:
+                        projected = ProjectedEvent(event)
+                        for sink in active:
+                            sink.add(projected)
+                for sink in active:
+                    sink.end(calendar)
+        except BaseException:
+            for sink in sinks:
+                sink.abort()
+            raise
+        for sink in sinks:
+            sink.finish()
+
 
+def _sink_calendar(sink: Sink, calendar: Calendar):
+    if sink.begin(calendar):
+        for event in calendar:
+            sink.add(event)
+        sink.end(calendar)
 
-#Writers, for outputting data.
-class Writer(metaclass=ABCMeta):
-    @classmethod
-    def flatten(cls, calendars: Iterable[Calendar]) -> Calendar:
-        flat = Calendar(FLAT_NAME)
-        for cal in calendars:
-            flat.extend(cal)
-        flat.sort(key=lambda e: e.start)
-        return flat
 
-    @abstractmethod
-    def write(self, calendars: List[Calendar], *, flatten=False):
-        """Do whatever the output thing is."""
+async def export_async(calendars: Iterable[Calendar], writers: List[Writer],
+                       *, flatten=False, queue_size: int=4):
+    """export(), with every writer running at once.
 
+    Each writer gets its own thread and a queue of at most queue_size
+    calendars, which it works through one calendar at a time, so google
+    batches go out while files are still being written. Every sink's
+    start(), and confirm_write() for writers without a sink, runs first, on
+    this thread, so overwrite prompts (for files and google calendars alike)
+    all happen before anything starts.
+    """
+    loop = asyncio.get_running_loop()
+    calendars = list(calendars)
+    sources = [Writer.flatten(calendars)] if flatten else calendars
+    sinks = []  # type: List[Sink]
+    others = []  # type: List[Writer]
+    for writer in writers:
+        sink = _sink_for(writer, flatten=flatten)
+        if sink is None:
+            writer.confirm_write(calendars, flatten=flatten)
+            others.append(writer)
+        else:
+            sink.start(sources)
+            sinks.append(sink)
+    executor = ThreadPoolExecutor(max_workers=max(1, len(writers)))
+    queues = [asyncio.Queue(maxsize=queue_size) for _ in sinks]  # type: List[asyncio.Queue]
 
-class FileWriter(Writer):
-    """Write Calendars out to a filetype."""
-    def __init__(self, output, *, silently_destroy_data=False) -> None:
-        self.output = output
-        self.silently_destroy_data = silently_destroy_data
+    async def consume(sink, queue):
+        while True:
+            calendar = await queue.get()
+            if calendar is None:
+                break
+            await loop.run_in_executor(executor, _sink_calendar, sink, calendar)
+        await loop.run_in_executor(executor, sink.finish)
 
+    async def produce():
+        for calendar in sources + [None]:
+            for queue in queues:
+                await queue.put(calendar)
 
-    @abstractmethod
-    def calendar_filename(self, calendar: Calendar):
-        """Return a default filename creator for the given calendar."""
+    tasks = [asyncio.ensure_future(produce())]
+    tasks.extend(asyncio.ensure_future(consume(sink, queue))
+                 for sink, queue in zip(sinks, queues))
+    tasks.extend(
+        loop.run_in_executor(executor, functools.partial(
+            _write_timed, writer, calendars, flatten=flatten
+        ))
+        for writer in others
+    )
+    with METRICS.timer('export'):
+        try:
+            # a failed consumer stops draining its queue, which would leave
+            # the producer waiting forever, so stop everything at once.
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # let any calendar still being written finish before aborting
+            executor.shutdown(wait=True)
+    errors = [task.exception() for task in tasks
+              if not task.cancelled() and task.exception() is not None]
+    if errors:
+        for sink in sinks:
+            sink.abort()
+        raise errors[0]
 
-    @abstractmethod
-    def write_file(self, filepath: str, calendar: Calendar):
-        """Write a calendar out to fp in whatever the output format is."""
 
-    def to_file(self, calendar: Calendar, *, path: str=None):
-        if path is None:
-            path = self.output
+# Writers main() knows about, in the order they run. A writer can also be
+# registered as a 'module:Class' string, which is only imported if that
+# writer is actually looked up.
+WRITERS = OrderedDict()  # type: OrderedDict
 
-        if not self.silently_destroy_data and os.path.exists(path):
-            question = 'Delete existing file at {}?'.format(path)
-            if not wait_for_response(question):
-                return
 
-        self.write_file(path, calendar)
+def register_writer(name: str, writer) -> None:
+    WRITERS[name] = writer
 
-    def to_directory(self, calendars: Iterable[Calendar]):
-        """Write out the calendars to a directory, one per calendar."""
-        os.makedirs(self.output, exist_ok=True)
-        for calendar in calendars:
-            path = os.path.join(self.output, self.calendar_filename(calendar))
-            self.to_file(calendar, path=path)
 
-    def write(self, calendars: Iterable[Calendar], *, flatten=False):
-        if flatten:
-            self.to_file(self.flatten(calendars))
-        else:
-            self.to_directory(calendars)
+def writer_class(name: str) -> type:
+    writer = WRITERS[name]
+    if isinstance(writer, str):
+        module, _, attr = writer.partition(':')
+        writer = WRITERS[name] = getattr(importlib.import_module(module), attr)
+    return writer
 
 
-class CSVWriter(FileWriter):
-    """Write the calendar out to a csv file."""
-    def to_csvdict(self, event: Event) -> Dict[str, str]:
-        return {
-            'Location': event.address,
-            'Description': event.venue,
-            'Start Date': event.start.strftime('%m/%d/%Y'),
-            'Start Time': event.start.strftime('%I:%M %p'),
-            'End Date': event.end.strftime('%m/%d/%Y'),
-            'End Time': event.end.strftime('%I%M %p'),
-            'All Day Event': 'False',
-            'Subject': event.artist,
-            'Private': 'False'
-        }
+def make_writers(args: argparse.Namespace) -> List[Writer]:
+    writers = (writer_class(name).from_args(args) for name in WRITERS)
+    return [writer for writer in writers if writer is not None]
 
-    def calendar_filename(self, calendar: Calendar) -> str:
-            return calendar.name.lower().replace('(', '').replace(')', '')\
-                   .replace('@', 'at')+'.csv'
 
-    def write_file(self, path: str, calendar: Calendar):
-        caldicts = [self.to_csvdict(e) for e in calendar]
-        fieldnames = list(caldicts[0])
-        with open(path, 'w') as fp:
-            writer = csv.DictWriter(fp, fieldnames)
-            writer.writeheader()
-            writer.writerows(caldicts)
+register_writer('stdout', StdoutWriter)
+register_writer('gcal', GoogleCalendarWriter)
+register_writer('googlecsv', CSVWriter)
+register_writer('ical', IcalWriter)
 
 
-class IcalWriter(FileWriter):
-    """Write the calendar out to an ical file."""
-    def calendar_filename(self, calendar: Calendar) -> str:
-            return calendar.name.lower().replace('(', '').replace(')', '')\
-                   .replace('@', 'at')+'.ical'
+class RenderedFeed:
+    __slots__ = ('etag', 'body', 'gzipped', 'content_type')
 
-    def to_ical_event(self, event: Event) -> icalendar.Event:
-        e = icalendar.Event()
-        e.add('dtstart', event.start)
-        e.add('dtend', event.end)
-        e.add('summary', event.artist)
-        e.add('location', icalendar.prop.vText('{}: {}'.format(
-            event.venue, event.address))
-        )
-        e.add('description', '[{}]({}) @ [{}]({})'.format(
-            event.artist, event.artist_url, event.venue, event.venue_url)
-        )
-        return e
+    def __init__(self, etag: str, body: bytes, content_type: str) -> None:
+        self.etag = etag
+        self.body = body
+        self.gzipped = gzip.compress(body)
+        self.content_type = content_type
 
-    def to_ical_calendar(self, calendar: Calendar) -> icalendar.Calendar:
-        c = icalendar.Calendar()
-        c.add('prodid', "-//Jakes awesome ums converter//Jacob Beck//")
-        c.add('version', '1.0')
-        c.add('name', calendar.name)
-        for event in calendar:
-            c.add_component(self.to_ical_event(event))
-        return c
 
-    def write_file(self, path: str, calendar: Calendar):
-        with open(path, 'wb') as fp:
-            fp.write(self.to_ical_calendar(calendar).to_ical())
+class FeedHandler(BaseHTTPRequestHandler):
+    server_version = 'ums'
+
+    def do_GET(self):
+        feeds = self.server.feeds
+        if self.path.split('?')[0] == '/':
+            body = '\n'.join(quote(p) for p in feeds.paths()).encode('utf-8')
+            feed = RenderedFeed('', body, 'text/plain; charset=utf-8')
+        else:
+            feed = feeds.feed(unquote(self.path.split('?')[0]))
+        if feed is None:
+            self.send_error(404)
+            return
+        if feed.etag and self.headers.get('If-None-Match') == feed.etag:
+            self.send_response(304)
+            self.send_header('ETag', feed.etag)
+            self.end_headers()
+            return
+        body = feed.body
+        self.send_response(200)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = feed.gzipped
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('Content-Type', feed.content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if feed.etag:
+            self.send_header('ETag', feed.etag)
+        self.end_headers()
+        self.wfile.write(body)
 
+    def log_message(self, format, *args):
+        if self.server.feeds.verbose:  # pragma: nocover
+            super().log_message(format, *args)
 
-class GoogleCalendarWriter(Writer):
-    """A little wrapper for a google calendar service to skip all the boring
-    stuff.
 
-    Warning: If you pass or set silently_destroy_data, you will not be
-    prompted before calendars are deleted!
+class PooledHTTPServer(HTTPServer):
+    """An HTTPServer that handles connections in a fixed pool of worker
+    threads, rather than starting a new thread for every one.
     """
-    SCOPE = 'https://www.googleapis.com/auth/calendar'
-    def __init__(self, secrets: str, *, silently_destroy_data=False) -> None:
-        self.service = self.get_service(secrets, appname='UMS Calendar app')
+    def __init__(self, address: Tuple[str, int], handler, *,
+                 workers: int=16) -> None:
+        super().__init__(address, handler)
+        self.pool = ThreadPoolExecutor(max_workers=workers)
 
-        self.calsvc = self.service.calendars()
-        self.esvc = self.service.events()
-        self.calendar_list = self.service.calendarList()
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
 
-        self._calendar_list_cache = None  #  type: Optional[Dict[str, dict]]
-        self.silently_destroy_data = silently_destroy_data
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
 
-    @classmethod
-    def get_service(cls, secrets: str, appname: str):
-        home_dir = os.path.expanduser('~')
-        credential_dir = os.path.join(home_dir, '.credentials')
-        if not os.path.exists(credential_dir):
-            os.makedirs(credential_dir)
-        credential_path = os.path.join(credential_dir,
-                                       'calendar-python-quickstart.json')
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=True)
 
-        store = oauth2client.file.Storage(credential_path)
-        credentials = store.get()
-        if not credentials or credentials.invalid:
-            flow = client.flow_from_clientsecrets(secrets, cls.SCOPE)
-            flow.user_agent = appname
-            credentials = tools.run_flow(flow, store, None)
-        http = credentials.authorize(httplib2.Http())
-        return discovery.build('calendar', 'v3', http=http)
+
+class FeedServer:
+    """Serves every venue's calendar, and the flattened one, as iCal and CSV
+    feeds over HTTP, from a pool of worker threads.
+
+    Bodies are rendered on first request and kept, with their gzipped form,
+    until the calendar they came from changes. The datasource is checked at
+    most every check_interval seconds. If its file hasn't changed (and its
+    cache hasn't expired) it isn't even parsed; otherwise calendars whose
+    digest is unchanged keep their rendered bodies and ETags, so polling
+    subscribers mostly get a 304 for the price of a dict lookup.
+    """
+    def __init__(self, source: Callable[[], DataSource], *, venue='all',
+                 start: datetime=None, end: datetime=None,
+                 check_interval: float=300.0, writers: List[FileWriter]=None,
+                 workers: int=16, verbose: bool=False) -> None:
+        self.source = source
+        self.venue = venue
+        self.start = start
+        self.end = end
+        self.check_interval = check_interval
+        if writers is None:
+            writers = [IcalWriter(None), CSVWriter(None)]
+        self.writers = writers
+        self.workers = workers
+        self.verbose = verbose
+        self.content_hash = None  # type: Optional[str]
+        self.reloads = 0
+        self._fingerprint = None  # type: Optional[Tuple[int, int]]
+        self._checked_at = None  # type: Optional[float]
+        self._calendars = {}  # type: Dict[str, Tuple[Calendar, str, FileWriter]]
+        self._rendered = {}  # type: Dict[str, RenderedFeed]
+        self._lock = threading.Lock()
 
     @staticmethod
-    def to_gcal(event: Event) -> Dict[str, Any]:
-        return {
-            'start': {'dateTime': event.start.strftime('%Y-%m-%dT%H:%M:%S-06:00')},
-            'end': {'dateTime': event.end.strftime('%Y-%m-%dT%H:%M:%S-06:00')},
-            'location': event.address,
-            'description': '[{}]({}) @ [{}]({})'.format(event.artist, event.artist_url, event.venue, event.venue_url),
-            'summary': event.artist,
-        }
+    def fingerprint(ds: DataSource) -> Optional[Tuple[int, int]]:
+        """The datasource file's modification time and size."""
+        if not ds.filepath:
+            return None
+        try:
+            stat = os.stat(ds.filepath)
+        except EnvironmentError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
 
-    @property
-    def calendar_list_cache(self) -> Dict[str, dict] :
-        if self._calendar_list_cache is None:
-            resp = self.calendar_list.list().execute()
-            self._calendar_list_cache = {c['summary']: c for c in resp['items']}
-        return self._calendar_list_cache
+    def unchanged(self) -> bool:
+        """Whether the datasource is just as it was at the last reload,
+        judging by its file and, if it can expire, its header alone.
+        """
+        ds = self.source()
+        fingerprint = self.fingerprint(ds)
+        if fingerprint is None or fingerprint != self._fingerprint:
+            return False
+        if ds.url and ds.max_age is not None:
+            try:
+                ds.readheader()
+            except (ValueError, EnvironmentError):
+                return False
+            return not ds.expired()
+        return True
 
-    @calendar_list_cache.setter
-    def calendar_list_cache(self, value: Dict[str, dict]):
-        self._calendar_list_cache = value
+    def reload(self) -> bool:
+        """Re-read the datasource, returning whether anything changed."""
+        ds = self.source()
+        # taken first, so a change while reading is caught next time.
+        self._fingerprint = self.fingerprint(ds)
+        calendars = list(ds.calendars(
+            venue=self.venue, start=self.start, end=self.end
+        ).values())
+        if calendars:
+            calendars.append(Writer.flatten(calendars))
+        digests = [calendar.digest() for calendar in calendars]
+        content_hash = hashlib.sha1(''.join(digests).encode('ascii')).hexdigest()
+        self._checked_at = time.monotonic()
+        if content_hash == self.content_hash:
+            return False
+        feeds = {}
+        for calendar, digest in zip(calendars, digests):
+            for writer in self.writers:
+                path = '/' + writer.calendar_filename(calendar)
+                feeds[path] = (calendar, digest, writer)
+        self._calendars = feeds
+        self._rendered = {
+            path: rendered for path, rendered in self._rendered.items()
+            if path in feeds and rendered.etag == self.etag(*feeds[path][1:])
+        }
+        self.content_hash = content_hash
+        self.reloads += 1
+        return True
 
-    def _new_calendar_named(self, name: str) -> str:
-        self.calendar_list_cache = None
-        created = self.calsvc.insert(body={'summary': name}).execute()
-        return created['id']
+    @staticmethod
+    def etag(digest: str, writer: FileWriter) -> str:
+        return '"{}-{}"'.format(digest[:20], type(writer).__name__.lower())
 
-    def _make_batch_request(self, all_requests: list):
-        batch = self.service.new_batch_http_request()
-        for req in all_requests:
-            batch.add(req)
-        batch.execute()
+    def check(self) -> None:
+        with self._lock:
+            if (self._checked_at is None or
+                    time.monotonic() - self._checked_at >= self.check_interval):
+                if self.unchanged():
+                    self._checked_at = time.monotonic()
+                else:
+                    self.reload()
 
-    def _clear_calendar(self, cal_id: str):
-        events = self.esvc.list(calendarId=cal_id).execute()['items']
-        all_deletes = []
-        for event in events:
-            all_deletes.append(self.esvc.delete(calendarId=cal_id, eventId=event['id']))
-            if len(all_deletes) == 1000:
-                self._make_batch_request(all_deletes)
-                all_deletes = []
-        if all_deletes:
-            self._make_batch_request(all_deletes)
+    def paths(self) -> List[str]:
+        self.check()
+        return list(self._calendars)
 
-    def _add_events(self, cal_id: str, events: Iterable[Event]):
-        all_adds = []
-        for event in events:
-            all_adds.append(self.esvc.insert(calendarId=cal_id, body=self.to_gcal(event)))
-            if len(all_adds) == 1000:
-                self._make_batch_request(all_adds)
-                all_adds = []
-        if all_adds:
-            self._make_batch_request(all_adds)
+    def feed(self, path: str) -> Optional[RenderedFeed]:
+        self.check()
+        rendered = self._rendered.get(path)
+        if rendered is not None:
+            return rendered
+        with self._lock:
+            if path not in self._calendars:
+                return None
+            if path not in self._rendered:
+                calendar, digest, writer = self._calendars[path]
+                self._rendered[path] = RenderedFeed(
+                    self.etag(digest, writer), writer.render(calendar),
+                    writer.content_type
+                )
+            return self._rendered[path]
 
-    def _get_empty_calendar_named(self, name: str) -> Optional[str]:
+    def make_server(self, host: str, port: int) -> PooledHTTPServer:
+        server = PooledHTTPServer((host, port), FeedHandler,
+                                  workers=self.workers)
+        server.feeds = self
+        return server
+
+    def serve(self, host: str, port: int):  # pragma: nocover
+        self.check()
+        server = self.make_server(host, port)
+        print('Serving {} feeds on http://{}:{}/'.format(
+            len(self._calendars), *server.server_address[:2]
+        ))
         try:
-            to_clear = self.calendar_list_cache[name]
-        except KeyError:
-            return self._new_calendar_named(name)
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
 
-        if not self.silently_destroy_data:
-            question = 'About to delete existing google calendar "{}". Ok?'
-            if not wait_for_response(question.format(to_clear['summary'])):
-                return None
 
-        self._clear_calendar(cal_id=to_clear['id'])
-        return to_clear['id']
+class Watcher:
+    """Polls the datasource and re-runs the writers, but only with the
+    calendars that changed since that writer last wrote them.
 
-    def _add_calendar(self, calendar: Calendar):
-        """Add a calendar entry."""
-        cal_id = self._get_empty_calendar_named(calendar.name)
-        if cal_id is None:
+    Each calendar's digest is remembered per writer (and in state_path, if
+    given, so a restart doesn't republish everything). A writer that fails
+    keeps its old digests and gets the same calendars again next time.
+    Calendars that drop out of the source are removed from writers that
+    wrote them. Overwriting anything a writer didn't write itself is still
+    confirmed as usual. Polls are spaced interval seconds apart, plus or
+    minus jitter (a fraction), and back off exponentially up to max_backoff
+    while they keep failing.
+    """
+    def __init__(self, source: Callable[[], DataSource], writers: List[Writer],
+                 *, venue='all', start: datetime=None, end: datetime=None,
+                 flatten: bool=False, interval: float=300.0,
+                 jitter: float=0.1, max_backoff: float=3600.0,
+                 state_path: str=None, sleep=time.sleep) -> None:
+        self.source = source
+        self.writers = writers
+        self.venue = venue
+        self.start = start
+        self.end = end
+        self.flatten = flatten
+        self.interval = interval
+        self.jitter = jitter
+        self.max_backoff = max_backoff
+        self.state_path = state_path
+        self.sleep = sleep
+        self.failures = 0
+        state = self.load_state(state_path)
+        self.published = state.get('published', {})  # type: Dict[str, Dict[str, str]]
+        names = Counter()  # type: Counter
+        self.keys = []  # type: List[str]
+        for writer in writers:
+            name = type(writer).__name__
+            names[name] += 1
+            if names[name] > 1:
+                name = '{}-{}'.format(name, names[name])
+            self.keys.append(name)
+            if hasattr(writer, 'owned'):
+                writer.owned.update(state.get('owned', {}).get(name, []))
+
+    @staticmethod
+    def load_state(path: Optional[str]) -> Dict[str, Any]:
+        return _load_json(path)
+
+    def save_state(self):
+        if not self.state_path:
             return
-        print('Importing {} events into calendar {}'.format(len(calendar), calendar.name))
-        self._add_events(cal_id=cal_id, events=calendar)
+        owned = {key: sorted(writer.owned)
+                 for key, writer in zip(self.keys, self.writers)
+                 if hasattr(writer, 'owned')}
+        _dump_json_atomically(self.state_path,
+                              {'published': self.published, 'owned': owned})
 
-    def write(self, calendars: Iterable[Calendar], *, flatten=False):
-        self._calendar_list_cache = None
-        if flatten:
-            calendars = [self.flatten(calendars)]
-        for calendar in calendars:
-            self._add_calendar(calendar)
+    def poll(self) -> Dict[str, List[str]]:
+        """Check the datasource once, returning the names of the calendars
+        each writer wrote.
+        """
+        calendars = list(self.source().calendars(
+            venue=self.venue, start=self.start, end=self.end
+        ).values())
+        digests = OrderedDict((c.name, c.digest()) for c in calendars)
+        written = {}  # type: Dict[str, List[str]]
+        errors = []  # type: List[Exception]
+        for key, writer in zip(self.keys, self.writers):
+            seen = self.published.get(key, {})
+            if seen == digests:
+                continue
+            gone = [] if self.flatten else [n for n in seen if n not in digests]
+            if self.flatten:
+                # any change at all changes the flattened calendar.
+                changed = calendars
+            else:
+                changed = [c for c in calendars if seen.get(c.name) != digests[c.name]]
+            try:
+                if changed:
+                    writer.write(changed, flatten=self.flatten)
+                if gone:
+                    writer.remove(gone)
+            except Exception as exc:
+                errors.append(exc)
+                continue
+            self.published[key] = dict(digests)
+            written[key] = [c.name for c in changed]
+        self.save_state()
+        if errors:
+            raise errors[0]
+        return written
 
+    def next_delay(self) -> float:
+        delay = self.interval
+        if self.failures:
+            delay = min(self.interval * 2 ** self.failures, self.max_backoff)
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
 
-class StdoutWriter(Writer):
-    def print_calendar(self, calendar: Calendar, flattened: bool):
-        print('{}:'.format(calendar.name))
-        for event in calendar:
-            if flattened:
-                to_print = event.str_with_venue()
+    def run(self, polls: int=None):
+        """Poll forever, or polls times."""
+        count = 0
+        while True:
+            try:
+                written = self.poll()
+            except Exception as exc:
+                self.failures += 1
+                print('Update failed: {}'.format(exc))
             else:
-                to_print = event.str_without_venue()
-            print('\t{}'.format(to_print))
-        print('')
+                self.failures = 0
+                for key, names in written.items():
+                    print('{}: updated {}'.format(key, ', '.join(names) or 'nothing'))
+            count += 1
+            if polls is not None and count >= polls:
+                return
+            self.sleep(self.next_delay())
 
-    def write(self, calendars: Iterable[Calendar], *, flatten=False):
-        if flatten:
-            calendars = [self.flatten(calendars)]
-        for calendar in calendars:
-            self.print_calendar(calendar, flatten)
+
+def overlaps(events: Iterable[Event]) -> Iterable[Tuple[Event, Event]]:
+    """Every pair of events at different venues whose times overlap, in
+    order of the later one's start.
+
+    Sweeps over the events in start order, keeping a heap of the ones still
+    going, so each event is only compared with those it actually overlaps.
+    """
+    active = []  # type: List[Tuple[int, int, Event]]
+    for seq, event in enumerate(sorted(events, key=_start_key)):
+        start = event.start_ts
+        while active and active[0][0] <= start:
+            heapq.heappop(active)
+        for _, _, other in sorted(active, key=lambda item: item[1]):
+            if other.venue != event.venue:
+                yield other, event
+        heapq.heappush(active, (event.end_ts, seq, event))
+
+
+def load_favourites(path: str) -> Dict[str, float]:
+    """Read a favourites file: one artist per line, optionally followed by a
+    comma and a weight (default 1). Blank lines and #comments are skipped.
+    """
+    favourites = {}  # type: Dict[str, float]
+    with open(path) as fp:
+        for line in fp:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            # only a weight if there is an artist before it; a line that is
+            # just a number is an artist called that.
+            artist, _, weight = line.rpartition(',')
+            if artist.strip():
+                try:
+                    favourites[artist.strip().lower()] = float(weight)
+                    continue
+                except ValueError:
+                    pass
+            favourites[line.lower()] = 1.0
+    return favourites
+
+
+def plan_itinerary(events: Iterable[Event], weights: Dict[str, float]=None,
+                   *, travel: int=0) -> Calendar:
+    """The set of non-overlapping events with the most total weight.
+
+    weights maps lowercased artists to how much seeing them is worth;
+    without it every event is worth 1. Moving between venues takes travel
+    seconds. This is weighted interval scheduling, in O(n log n): events
+    are taken in end order, and the best plan ending with each one builds
+    on the best plan that ends early enough, found by bisecting both over
+    all events (allowing for travel) and over the same venue's (without).
+    """
+    if weights is None:
+        candidates = [(e, 1.0) for e in events]
+    else:
+        candidates = [(e, weights.get(e.artist.lower(), 0.0)) for e in events]
+        candidates = [(e, w) for e, w in candidates if w > 0]
+    candidates.sort(key=lambda item: (item[0].end_ts, item[0].start_ts))
+
+    # ends[k] and best[k]: the end of the k-th event, and the (value, index)
+    # of the best plan ending with any of the first k+1 events.
+    ends = []  # type: List[int]
+    best = []  # type: List[Tuple[float, int]]
+    venue_ends = {}  # type: Dict[str, List[int]]
+    venue_best = {}  # type: Dict[str, List[Tuple[float, int]]]
+    previous = []  # type: List[int]
+    for index, (event, weight) in enumerate(candidates):
+        start = event.start_ts
+        before = (0.0, -1)
+        k = bisect.bisect_right(ends, start - travel)
+        if k:
+            before = best[k - 1]
+        same_ends = venue_ends.setdefault(event.venue, [])
+        same_best = venue_best.setdefault(event.venue, [])
+        k = bisect.bisect_right(same_ends, start)
+        if k and same_best[k - 1][0] > before[0]:
+            before = same_best[k - 1]
+        value = (before[0] + weight, index)
+        previous.append(before[1])
+        ends.append(event.end_ts)
+        best.append(max(best[-1], value, key=lambda v: v[0]) if best else value)
+        same_ends.append(event.end_ts)
+        same_best.append(max(same_best[-1], value, key=lambda v: v[0])
+                         if same_best else value)
+
+    chosen = []  # type: List[Event]
+    index = best[-1][1] if best else -1
+    while index >= 0:
+        chosen.append(candidates[index][0])
+        index = previous[index]
+    chosen.reverse()
+    return Calendar(VENUE_FMT.format('Itinerary'), items=chosen)
+
+
+def print_conflicts(calendars: Iterable[Calendar],
+                    favourites: Dict[str, float]=None):
+    events = list(itertools.chain.from_iterable(calendars))
+    if favourites is not None:
+        events = [e for e in events if e.artist.lower() in favourites]
+    pairs = list(overlaps(events))
+    print('{} conflicts:'.format(len(pairs)))
+    for first, second in pairs:
+        print('\t{}\n\t\tclashes with {}'.format(first.str_with_venue(),
+                                                   second.str_with_venue()))
+    print('')
+
+
+def parse_date(value: str) -> date:
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def parse_when(value: str) -> datetime:
+    if value == 'now':
+        return datetime.now().replace(microsecond=0)
+    for fmt in ('%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError('Invalid time: {!r}'.format(value))
+
+
+def print_now(index: EventIndex, venues, when: datetime):
+    """Print what is on now and next at each venue."""
+    if venues is None or venues == 'all':
+        names = sorted(index.store.strings[code] for code in index.venues)
+    else:
+        names = venues
+    for name in names:
+        current = index.now(name, when)
+        upcoming = index.next(name, when)
+        print('{}:'.format(VENUE_FMT.format(name)))
+        print('\tNow: {}'.format(
+            current.str_without_venue() if current else 'nothing'
+        ))
+        print('\tNext: {}'.format(
+            upcoming.str_without_venue() if upcoming else 'nothing'
+        ))
+        print('')
 
 
 def parse_args(args=None):
@@ -418,14 +3772,55 @@ def parse_args(args=None):
     ds_group = parser.add_argument_group('data source arguments')
     ds_group.add_argument('--force-refresh', action='store_true',
         dest='force_refresh')
-    ds_group.add_argument('--datasource', default='events.json',
+    ds_group.add_argument('--datasource', default=None,
         type=os.path.expanduser,
-        help="""'The place on disk to look for the datasource. If you use
+        help="""'The place on disk to look for the datasource (default:
+        events.json, or events.db with --backend sqlite). If you use
         --force-refresh, this file will be overwritten."""
     )
     ds_group.add_argument('--url', default='http://theums.com/myfeed/',
         help='The URL to use for refreshing.'
     )
+    ds_group.add_argument('--pull-start', default=None, dest='pull_start',
+        type=parse_date,
+        help='First day (YYYY-MM-DD) to fetch when refreshing.'
+    )
+    ds_group.add_argument('--pull-end', default=None, dest='pull_end',
+        type=parse_date,
+        help='Day (YYYY-MM-DD) to stop fetching at, exclusive.'
+    )
+    ds_group.add_argument('--window-days', default=None, type=int,
+        dest='window_days',
+        help="""Fetch the refresh range in windows of this many days, several
+        at a time, instead of in a single request."""
+    )
+    ds_group.add_argument('--fetch-workers', default=4, type=int,
+        dest='fetch_workers',
+        help='The maximum number of windows to fetch at once.'
+    )
+    ds_group.add_argument('--fetch-timeout', default=30.0, type=float,
+        dest='fetch_timeout',
+        help='Seconds to wait on a single window before retrying it.'
+    )
+    ds_group.add_argument('--max-age', default=None, type=float,
+        dest='max_age',
+        help="""Revalidate the datasource against the URL once it is older
+        than this many seconds. Unchanged feeds are not re-downloaded."""
+    )
+    ds_group.add_argument('--backend', default='json',
+        choices=('json', 'sqlite'),
+        help="""How the datasource is stored. 'sqlite' keeps every
+        retrieval's history and only writes the events that changed."""
+    )
+    ds_group.add_argument('--stream', action='store_true',
+        help="""If set, read the datasource one event at a time instead of
+        loading the whole file. Useful for very large archived feeds."""
+    )
+    ds_group.add_argument('--snapshot', action='store_true',
+        help="""If set, keep a pre-parsed binary copy of the datasource next
+        to it (with a .snap suffix) and start from that while the datasource
+        is unchanged."""
+    )
 
     gcal_group = parser.add_argument_group('Google Calendar API arguments')
     gcal_group.add_argument('--gsecrets',
@@ -440,11 +3835,43 @@ def parse_args(args=None):
     gcal_group.add_argument('--gappname', default='UMS Calendar app',
         help="The name of the app in the Google API setup."
     )
+    gcal_group.add_argument('--gworkers', default=4, type=int,
+        help='How many batch requests to send to google at once.'
+    )
+    gcal_group.add_argument('--grate', default=10.0, type=float,
+        help="""The most google API requests to make per second, to stay
+        under the API quota."""
+    )
+    gcal_group.add_argument('--gsync', action='store_true',
+        help="""If set, update google calendars in place, only sending the
+        changes since the last run instead of replacing every event."""
+    )
+    gcal_group.add_argument('--gmirror',
+        default='~/.credentials/ums-gcal-mirror.json',
+        type=os.path.expanduser,
+        help="""Where --gsync keeps its record of what is in each google
+        calendar."""
+    )
 
     modifiers = parser.add_argument_group('output modifier arguments')
 
-    modifiers.add_argument('--location', default='all',
-        help='The venue to filter by (default: all venues)'
+    modifiers.add_argument('--location', default=None, action='append',
+        help="""The venue to filter by (default: all venues). Pass more than
+        once for several venues."""
+    )
+    modifiers.add_argument('--from', default=None, type=parse_when,
+        dest='from_time',
+        help="""Only include events still going at or after this time
+        (YYYY-MM-DD or YYYY-MM-DDTHH:MM, festival local time)."""
+    )
+    modifiers.add_argument('--until', default=None, type=parse_when,
+        help="""Only include events that start before this time
+        (YYYY-MM-DD or YYYY-MM-DDTHH:MM, festival local time)."""
+    )
+    modifiers.add_argument('--now', default=None, nargs='?', const='now',
+        type=parse_when,
+        help="""Instead of writing calendars, print what is on now and next
+        at each venue. Takes an optional time to use instead of now."""
     )
     modifiers.add_argument('--flatten', action='store_true',
         help="""If set, don't convert UMS into one venue per calendar, but
@@ -476,8 +3903,118 @@ def parse_args(args=None):
             under the given directory that you can import into google
             calendar. If flatten is set, it will be a single iCal file."""
     )
+    output.add_argument('--jobs', default=1, type=int,
+        help="""Render per-venue CSV and iCal files in this many processes
+        at once."""
+    )
+    output.add_argument('--ical-serializer', default='stream',
+        choices=IcalWriter.SERIALIZERS, dest='ical_serializer',
+        help="""How to produce iCal output: 'stream' writes events straight
+        out, 'object' builds an icalendar object tree first."""
+    )
+    output.add_argument('--async', action='store_true', dest='use_async',
+        help="""Fetch and publish with asyncio: events are parsed as the
+        windows arrive, and every output is written at the same time."""
+    )
+    output.add_argument('--queue-size', default=4, type=int,
+        dest='queue_size',
+        help="""With --async, how many fetched windows, or calendars per
+        output, can be waiting at once."""
+    )
+    output.add_argument('--render-manifest', default=None,
+        type=os.path.expanduser, dest='render_manifest',
+        help="""If provided, remember here what was rendered into each CSV
+        and iCal file, and skip calendars whose files are already up to
+        date."""
+    )
+
+    serving = parser.add_argument_group('feed server arguments')
+    serving.add_argument('--serve', default=None, type=int, metavar='PORT',
+        help="""Instead of writing calendars, serve every venue's calendar
+        (and the flattened one) as iCal and CSV feeds on this port."""
+    )
+    serving.add_argument('--serve-host', default='127.0.0.1',
+        dest='serve_host',
+        help='The address to serve feeds on.'
+    )
+    serving.add_argument('--serve-workers', default=16, type=int,
+        dest='serve_workers',
+        help='How many requests to handle at once.'
+    )
+    serving.add_argument('--serve-interval', default=300.0, type=float,
+        dest='serve_interval',
+        help="""Seconds between checks of the datasource for changes. Use
+        with --max-age to also revalidate against the URL."""
+    )
+
+    watching = parser.add_argument_group('watch arguments')
+    watching.add_argument('--watch', default=None, type=float,
+        metavar='SECONDS',
+        help="""Keep running, checking the datasource this often and
+        re-running the outputs for just the calendars that changed."""
+    )
+    watching.add_argument('--watch-jitter', default=0.1, type=float,
+        dest='watch_jitter',
+        help='Randomly vary the interval by up to this fraction of it.'
+    )
+    watching.add_argument('--watch-max-backoff', default=3600.0, type=float,
+        dest='watch_max_backoff',
+        help='The longest to wait between checks while they keep failing.'
+    )
+    watching.add_argument('--watch-state', default=None,
+        type=os.path.expanduser, dest='watch_state',
+        help="""Where to remember what was last written, so restarting
+        doesn't rewrite everything."""
+    )
+
+    analysis = parser.add_argument_group('schedule analysis arguments')
+    analysis.add_argument('--conflicts', action='store_true',
+        help="""Instead of writing calendars, print every pair of sets at
+        different venues that overlap. With --favourites, only favourites'
+        sets are considered."""
+    )
+    analysis.add_argument('--itinerary', action='store_true',
+        help="""Instead of writing every venue's calendar, write one
+        calendar of the sets worth the most that can all be seen, to the
+        chosen outputs."""
+    )
+    analysis.add_argument('--favourites', default=None,
+        type=os.path.expanduser,
+        help="""A file of favourite artists, one per line, each optionally
+        followed by a comma and how much seeing them is worth (default 1).
+        Without it, every set is worth the same."""
+    )
+    analysis.add_argument('--travel', default=0, type=int,
+        metavar='MINUTES',
+        help="""With --itinerary, how long it takes to get from one venue
+        to another."""
+    )
+
+    profiling = parser.add_argument_group('profiling arguments')
+    profiling.add_argument('--profile', action='store_true',
+        help="""If set, print how long each stage took, and how many requests
+        and bytes were sent, to stderr at the end of the run."""
+    )
+    profiling.add_argument('--metrics-out', default=None,
+        type=os.path.expanduser, dest='metrics_out',
+        help='If provided, write the stage timings and counters here as JSON.'
+    )
 
     parsed = parser.parse_args(args)
+    if parsed.conflicts or parsed.itinerary:
+        analysis_flag = '--itinerary' if parsed.itinerary else '--conflicts'
+        modes = [('--now', parsed.now is not None),
+                 ('--serve', parsed.serve is not None),
+                 ('--watch', parsed.watch is not None),
+                 ('--async', parsed.use_async)]
+        for flag, given in modes:
+            if given:
+                parser.error('{} can not be used with {}'.format(
+                    analysis_flag, flag
+                ))
+    if parsed.datasource is None:
+        parsed.datasource = 'events.db' if parsed.backend == 'sqlite' \
+            else 'events.json'
     return parsed
 
 
@@ -487,41 +4024,137 @@ FLAT_NAME = 'UMS'
 
 def main():
     args = parse_args()
+    METRICS.enabled = args.profile or bool(args.metrics_out)
+    try:
+        with METRICS.timer('total'):
+            run(args)
+    except DatasourceError as exc:
+        sys.exit('Error: {}'.format(exc))
+    finally:
+        if args.profile:
+            print(METRICS.report(), file=sys.stderr)
+        if args.metrics_out:
+            METRICS.write(args.metrics_out)
+
+
+def make_datasource(args: argparse.Namespace, **overrides) -> DataSource:
+    source_cls = SqliteDataSource if args.backend == 'sqlite' else DataSource
+    kwargs = dict(
+        streaming=args.stream,
+        start=args.pull_start,
+        end=args.pull_end,
+        window_days=args.window_days,
+        workers=args.fetch_workers,
+        timeout=args.fetch_timeout,
+        max_age=args.max_age,
+        snapshot=args.snapshot,
+    )
+    kwargs.update(overrides)
+    return source_cls(args.datasource, args.url, **kwargs)
+
+
+async def run_async(args: argparse.Namespace, ds: DataSource, venue):
+    """Fetch and publish with asyncio: windows are parsed as they arrive,
+    the datasource is saved while the outputs are written, and the outputs
+    are all written at once.
+    """
+    loop = asyncio.get_running_loop()
+    # a SQLite connection can only be used by the thread that opened it, so
+    # everything that touches the datasource's storage runs on one thread.
+    storage = ThreadPoolExecutor(max_workers=1)
+
+    def on_storage(func, *args, **kwargs):
+        return loop.run_in_executor(storage,
+                                    functools.partial(func, *args, **kwargs))
+
+    try:
+        await on_storage(ds.load)
+        saving = None
+        if args.force_refresh or not ds.metadata:
+            await ds.pull_async(queue_size=args.queue_size)
+            saving = on_storage(ds._save)
+        else:
+            # a hit or a revalidation, which only sends conditional requests.
+            await on_storage(ds.get)
+        events_map = await on_storage(ds.calendars, venue=venue,
+                                      start=args.from_time, end=args.until)
+        jobs = []
+        if saving is not None:
+            jobs.append(saving)
+        if events_map:
+            jobs.append(export_async(events_map.values(), make_writers(args),
+                                     flatten=args.flatten,
+                                     queue_size=args.queue_size))
+        else:
+            print('No events')
+        await asyncio.gather(*jobs)
+    finally:
+        storage.shutdown(wait=True)
+
+
+def run(args: argparse.Namespace):
+    ds = make_datasource(args)
+    venue = args.location or 'all'
+    if args.use_async and args.now is None and args.serve is None and \
+            args.watch is None:
+        if len(venue) == 1 and venue != 'all':
+            venue = venue[0]
+        asyncio.run(run_async(args, ds, venue))
+        return
 
-    ds = DataSource(args.datasource, args.url)
     if args.force_refresh:
         ds.pull()
         ds.writefile()
 
-    events_map = ds.calendars(venue=args.location)
-    if not events_map:
-        print('No events')
+    if args.now is not None:
+        print_now(ds.index(), venue, args.now)
         return
 
-    writers = []
-    if args.print:
-        writers.append(StdoutWriter())
-
-    if args.gcal:
-        writers.append(GoogleCalendarWriter(
-            secrets=args.gsecrets,
-            silently_destroy_data=args.silently_destroy_data
-        ))
+    if len(venue) == 1 and venue != 'all':
+        venue = venue[0]
+    if args.serve is not None:
+        server = FeedServer(lambda: make_datasource(args), venue=venue,
+                            start=args.from_time, end=args.until,
+                            check_interval=args.serve_interval,
+                            workers=args.serve_workers)
+        server.serve(args.serve_host, args.serve)
+        return
+    if args.watch is not None:
+        # revalidate on every poll unless told otherwise; unchanged feeds
+        # only cost a 304 per window.
+        max_age = 0 if args.max_age is None else args.max_age
+        watcher = Watcher(lambda: make_datasource(args, max_age=max_age),
+                          make_writers(args), venue=venue,
+                          start=args.from_time, end=args.until,
+                          flatten=args.flatten, interval=args.watch,
+                          jitter=args.watch_jitter,
+                          max_backoff=args.watch_max_backoff,
+                          state_path=args.watch_state)
+        watcher.run()
+        return
 
-    if args.googlecsv:
-        writers.append(CSVWriter(
-            output=args.googlecsv,
-            silently_destroy_data=args.silently_destroy_data,
-        ))
+    events_map = ds.calendars(venue=venue, start=args.from_time,
+                              end=args.until)
+    if not events_map:
+        print('No events')
+        return
 
-    if args.ical:
-        writers.append(IcalWriter(
-            output=args.ical,
-            silently_destroy_data=args.silently_destroy_data,
-        ))
+    if args.conflicts or args.itinerary:
+        favourites = None
+        if args.favourites is not None:
+            favourites = load_favourites(args.favourites)
+        if args.conflicts:
+            print_conflicts(events_map.values(), favourites)
+        if not args.itinerary:
+            return
+        itinerary = plan_itinerary(
+            itertools.chain.from_iterable(events_map.values()), favourites,
+            travel=args.travel * 60
+        )
+        export([itinerary], make_writers(args))
+        return
 
-    for writer in writers:
-        writer.write(events_map.values(), flatten=args.flatten)
+    export(events_map.values(), make_writers(args), flatten=args.flatten)
 
 
 